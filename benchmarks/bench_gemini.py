@@ -0,0 +1,47 @@
+# benchmarks/bench_gemini.py
+"""Нагрузочный прогон GeminiClient против фейкового сервера.
+
+Запуск: python benchmarks/fake_gemini.py &  python benchmarks/bench_gemini.py --requests 500 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gemini_client import GeminiClient, HttpGeminiBackend  # noqa: E402
+
+
+async def run(base_url: str, total: int, concurrency: int) -> None:
+    client = GeminiClient(HttpGeminiBackend("fake", base_url=base_url, max_connections=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await client.generate(f"Промпт {i}", purpose="chat")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    await client.aclose()
+    latencies.sort()
+    print(f"Запросов: {total}, параллельно: {concurrency}, время: {elapsed:.2f} с, {total / elapsed:.1f} rps")
+    print(f"p50: {latencies[len(latencies) // 2] * 1000:.1f} мс, p95: {latencies[int(len(latencies) * 0.95)] * 1000:.1f} мс")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк клиента Gemini")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8089")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.base_url, args.requests, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
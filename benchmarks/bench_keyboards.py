@@ -0,0 +1,105 @@
+# benchmarks/bench_keyboards.py
+"""Накладные расходы ответа обработчика: клавиатура, собранная заново, против готовой из keyboards.py.
+
+Сессия из --messages сообщений повторяет типичный сценарий бота (меню, шесть оценок теста, открытые
+вопросы, выход в меню). Каждый ответ проходит настоящий путь Bot.send_message до сериализации
+запроса в JSON; сеть заменена запросом-заглушкой, поэтому измеряется только работа внутри процесса.
+
+Запуск: python benchmarks/bench_keyboards.py --messages 10000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Callable, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Bot, ReplyKeyboardMarkup  # noqa: E402
+from telegram.request import BaseRequest, RequestData  # noqa: E402
+
+import keyboards  # noqa: E402
+
+GET_ME = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+SENT = {
+    "message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"},
+    "from": GET_ME, "text": "ok",
+}
+
+
+class CapturingRequest(BaseRequest):
+    """Сериализует запрос как HTTPXRequest и отвечает без сети."""
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(
+        self, url: str, method: str, request_data: Optional[RequestData] = None, **kwargs
+    ) -> Tuple[int, bytes]:
+        if request_data is not None:
+            request_data.json_payload
+        result = GET_ME if url.endswith("/getMe") else SENT
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def rebuilt_session() -> List[Callable[[], ReplyKeyboardMarkup]]:
+    """Клавиатуры так, как их раньше собирал каждый обработчик."""
+    main = lambda: ReplyKeyboardMarkup(  # noqa: E731
+        [["Тест", "Ретроспектива"], ["Напоминание", "Помощь"]], resize_keyboard=True, one_time_keyboard=True
+    )
+    scores = lambda: ReplyKeyboardMarkup(  # noqa: E731
+        [[str(i) for i in range(1, 8)], ["Главное меню"]], resize_keyboard=True, one_time_keyboard=True
+    )
+    back = lambda: ReplyKeyboardMarkup([["Главное меню"]], resize_keyboard=True, one_time_keyboard=True)  # noqa: E731
+    return [main] + [scores] * 6 + [back] * 2 + [main]
+
+
+def prebuilt_session() -> List[Callable[[], ReplyKeyboardMarkup]]:
+    return (
+        [lambda: keyboards.MAIN_MENU_KEYBOARD]
+        + [lambda: keyboards.SCORE_KEYBOARD] * 6
+        + [lambda: keyboards.BACK_TO_MENU_KEYBOARD] * 2
+        + [lambda: keyboards.MAIN_MENU_KEYBOARD]
+    )
+
+
+async def run_session(bot: Bot, script: List[Callable[[], ReplyKeyboardMarkup]], messages: int) -> float:
+    """Возвращает среднее время одного ответа, микросекунды."""
+    started = time.perf_counter()
+    for i in range(messages):
+        await bot.send_message(chat_id=1, text="Вопрос дня", reply_markup=script[i % len(script)]())
+    return (time.perf_counter() - started) / messages * 1e6
+
+
+async def main_async(messages: int, rounds: int) -> None:
+    bot = Bot("123:bench", request=CapturingRequest(), get_updates_request=CapturingRequest())
+    await bot.initialize()
+    # Прогрев, затем чередующиеся замеры — чтобы шум распределился поровну
+    await run_session(bot, rebuilt_session(), 1000)
+    await run_session(bot, prebuilt_session(), 1000)
+    rebuilt, prebuilt = [], []
+    for _ in range(rounds):
+        rebuilt.append(await run_session(bot, rebuilt_session(), messages))
+        prebuilt.append(await run_session(bot, prebuilt_session(), messages))
+    await bot.shutdown()
+    before, after = min(rebuilt), min(prebuilt)
+    print(f"Сообщений в сессии: {messages}, лучший из {rounds} прогонов")
+    print(f"Клавиатура собирается заново: {before:.1f} мкс на ответ")
+    print(f"Готовая клавиатура:           {after:.1f} мкс на ответ ({(before - after) / before:.0%} быстрее)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Микробенчмарк готовых клавиатур")
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main_async(args.messages, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# benchmarks/bench_notifier.py
+"""Рассылка N напоминаний через фейковый Bot API: наивный asyncio.gather против NotificationOutbox.
+
+Запуск: python benchmarks/fake_bot_api.py --blocked 50 --error-rate 0.02 &
+        python benchmarks/bench_notifier.py --messages 300
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Bot  # noqa: E402
+from telegram.request import HTTPXRequest  # noqa: E402
+
+from notifier import FLOOD_WAITS, NotificationOutbox  # noqa: E402
+
+TEXT = "Напоминание: пришло время пройти ежедневный тест!"
+
+
+async def run_naive(bot: Bot, chat_ids: list) -> None:
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(bot.send_message(chat_id=chat_id, text=TEXT) for chat_id in chat_ids), return_exceptions=True
+    )
+    failed = sum(isinstance(r, Exception) for r in results)
+    print(
+        f"gather:  доставлено {len(chat_ids) - failed} из {len(chat_ids)}, ошибок {failed}, "
+        f"за {time.perf_counter() - started:.2f} с"
+    )
+
+
+async def run_outbox(bot: Bot, chat_ids: list, rate: float, workers: int) -> None:
+    outbox = NotificationOutbox(bot, rate_per_sec=rate, workers=workers, retry_base=0.2)
+    outbox.start()
+    started = time.perf_counter()
+    batch = outbox.submit("бенчмарк", chat_ids, TEXT)
+    await batch.done
+    elapsed = time.perf_counter() - started
+    await outbox.stop()
+    print(
+        f"outbox:  доставлено {batch.delivered} из {batch.total}, ошибок {batch.failed}, "
+        f"RetryAfter {FLOOD_WAITS.value:.0f}, за {elapsed:.2f} с ({batch.delivered / elapsed:.1f} сообщений/с)"
+    )
+
+
+async def run(base_url: str, messages: int, rate: float, workers: int, naive: bool) -> None:
+    bot = Bot("123:fake", base_url=base_url, request=HTTPXRequest(connection_pool_size=max(workers, 64)))
+    await bot.initialize()
+    chat_ids = list(range(1, messages + 1))
+    if naive:
+        await run_naive(bot, chat_ids)
+        # Даём окну лимита фейкового сервера освободиться
+        await asyncio.sleep(2)
+    await run_outbox(bot, chat_ids, rate, workers)
+    await bot.shutdown()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк очереди уведомлений")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8090/bot")
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--rate", type=float, default=25, help="лимит outbox, сообщений в секунду")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--skip-naive", action="store_true", help="не запускать прогон через asyncio.gather")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.ERROR)
+    asyncio.run(run(args.base_url, args.messages, args.rate, args.workers, not args.skip_naive))
+
+
+if __name__ == "__main__":
+    main()
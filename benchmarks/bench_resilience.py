@@ -0,0 +1,89 @@
+# benchmarks/bench_resilience.py
+"""Очередь Gemini против фейкового сервера со сбоями: дедлайны, повторы, хеджирование, circuit breaker.
+
+Запуск: python benchmarks/fake_gemini.py --latency 0.3 --error-rate 0.1 --slow-rate 0.05 --slow-latency 20 &
+        python benchmarks/bench_resilience.py --requests 300 --timeout 5 --hedging
+Для проверки breaker: --error-rate 1 у фейкового сервера — после первых ошибок запросы отклоняются сразу.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gemini_resilience  # noqa: E402
+from gemini_client import GeminiClient, HttpGeminiBackend  # noqa: E402
+from gemini_queue import GeminiRequestScheduler  # noqa: E402
+from gemini_resilience import CircuitBreaker, GeminiUnavailable  # noqa: E402
+
+
+async def run(opts: argparse.Namespace) -> None:
+    client = GeminiClient(HttpGeminiBackend("fake", base_url=opts.base_url, max_connections=opts.concurrency * 2))
+    scheduler = GeminiRequestScheduler(
+        client,
+        concurrency=opts.concurrency,
+        rate_per_sec=1_000_000,
+        burst=1_000_000,
+        max_queue=opts.requests,
+        attempt_timeout=opts.timeout,
+        max_attempts=opts.attempts,
+        hedging=opts.hedging,
+        breaker=CircuitBreaker(cooldown=opts.cooldown),
+    )
+    scheduler.start()
+    latencies: List[float] = []
+    outcomes = {"ok": 0, "error": 0, "rejected": 0}
+
+    async def one(i: int) -> None:
+        started = time.perf_counter()
+        try:
+            await scheduler.submit(i, f"Промпт {i}", purpose="chat")
+            outcomes["ok"] += 1
+        except GeminiUnavailable:
+            outcomes["rejected"] += 1
+        except Exception:
+            outcomes["error"] += 1
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    tasks = []
+    for i in range(opts.requests):
+        tasks.append(asyncio.create_task(one(i)))
+        await asyncio.sleep(1 / opts.rate)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    await client.aclose()
+
+    latencies.sort()
+    def q(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    print(
+        f"Запросов: {opts.requests} за {elapsed:.1f} с; успешно {outcomes['ok']}, ошибок {outcomes['error']}, "
+        f"отклонено breaker {outcomes['rejected']}"
+    )
+    print(f"p50 {q(0.5):.0f} мс, p95 {q(0.95):.0f} мс, p99 {q(0.99):.0f} мс, max {latencies[-1] * 1000:.0f} мс")
+    print(
+        f"Повторов {gemini_resilience.RETRIES.value:.0f}, таймаутов {gemini_resilience.TIMEOUTS.value:.0f}, "
+        f"дублей {gemini_resilience.HEDGES.value:.0f} (выиграли {gemini_resilience.HEDGE_WINS.value:.0f})"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк устойчивости запросов к Gemini")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8089")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--rate", type=float, default=50, help="запросов в секунду")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=5, help="дедлайн одной попытки, секунды")
+    parser.add_argument("--attempts", type=int, default=3)
+    parser.add_argument("--hedging", action="store_true")
+    parser.add_argument("--cooldown", type=float, default=5, help="пауза разомкнутого breaker, секунды")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# benchmarks/bench_settings_cache.py
+"""Чтение часового пояса пользователя: запрос к БД на каждое сообщение против SettingsCache.
+
+--reads чтений для --users пользователей с настройками; активные пользователи пишут чаще (распределение
+Ципфа), одновременно обрабатывается до --concurrency обновлений. Затем проверяется сброс между воркерами:
+два кэша с общим каналом, запись через первый должна сбросить значение во втором.
+
+Запуск: DATABASE_URL=postgresql://... python benchmarks/bench_settings_cache.py --reads 50000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from typing import Awaitable, Callable, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncpg  # noqa: E402
+
+import db  # noqa: E402
+from settings_cache import HITS, MISSES, SettingsCache  # noqa: E402
+
+# Пользователи бенчмарка не пересекаются с настоящими
+USER_ID_BASE = 9_000_000_000
+TIMEZONES = ["Europe/Moscow", "Asia/Yekaterinburg", "Asia/Novosibirsk", "Europe/Kaliningrad"]
+
+
+def hit_count() -> float:
+    return HITS.value
+
+
+async def run(label: str, read: Callable[[int], Awaitable[Optional[str]]], user_ids: List[int], concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def one(user_id: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await read(user_id)
+            latencies.append(time.perf_counter() - started)
+
+    hits_before, misses_before = hit_count(), MISSES.value
+    started = time.perf_counter()
+    await asyncio.gather(*(one(user_id) for user_id in user_ids))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    hits = hit_count() - hits_before
+    total = hits + MISSES.value - misses_before
+    print(
+        f"{label}: {len(user_ids)} чтений за {elapsed:.2f} с ({len(user_ids) / elapsed:.0f}/с), "
+        f"p50 {latencies[len(latencies) // 2] * 1e6:.0f} мкс, p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} мкс"
+        + (f", попаданий {hits / total:.1%}" if total else "")
+    )
+
+
+async def check_cross_worker(pool: asyncpg.pool.Pool, channel: str) -> None:
+    first = SettingsCache(pool, channel=channel)
+    second = SettingsCache(pool, channel=channel)
+    # В одном процессе оба кэша получили бы локальное уведомление; второй должен узнать о записи только по NOTIFY
+    for cache in (first, second):
+        cache.start()
+    db.remove_timezone_listener(second._on_local_change)
+    user_id = USER_ID_BASE
+    await asyncio.sleep(0.5)
+    before = await second.get_user_timezone(user_id)
+    await db.set_user_timezone(pool, user_id, "America/New_York")
+    started = time.perf_counter()
+    while await second.get_user_timezone(user_id) != "America/New_York":
+        if time.perf_counter() - started > 5:
+            print(f"Сброс между воркерами: НЕ получен за 5 с (было {before})")
+            break
+        await asyncio.sleep(0.001)
+    else:
+        print(f"Сброс между воркерами: {before} -> America/New_York за {(time.perf_counter() - started) * 1000:.1f} мс")
+    for cache in (first, second):
+        await cache.stop()
+
+
+async def main_async(opts: argparse.Namespace) -> None:
+    pool = await db.create_db_pool()
+    if pool is None:
+        return
+    db.logger.disabled = True
+    try:
+        async with pool.acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO user_settings (user_id, timezone) VALUES ($1, $2) "
+                "ON CONFLICT (user_id) DO UPDATE SET timezone = EXCLUDED.timezone",
+                [(USER_ID_BASE + i, TIMEZONES[i % len(TIMEZONES)]) for i in range(opts.users)],
+            )
+        rng = random.Random(1)
+        weights = [1 / (rank + 1) for rank in range(opts.users)]
+        user_ids = [USER_ID_BASE + i for i in rng.choices(range(opts.users), weights, k=opts.reads)]
+
+        await run("Запрос к БД  ", lambda user_id: db.get_user_timezone(pool, user_id), user_ids, opts.concurrency)
+        cache = SettingsCache(pool, entries=opts.entries, channel="")
+        cache.start()
+        await run("SettingsCache", cache.get_user_timezone, user_ids, opts.concurrency)
+        await cache.stop()
+        await check_cross_worker(pool, opts.channel)
+    finally:
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM user_settings WHERE user_id >= $1", USER_ID_BASE)
+        await pool.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк кэша настроек пользователей")
+    parser.add_argument("--reads", type=int, default=50_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--entries", type=int, default=10_000, help="SETTINGS_CACHE_ENTRIES")
+    parser.add_argument("--concurrency", type=int, default=32, help="одновременно обрабатываемых обновлений")
+    parser.add_argument("--channel", default="bench_settings_cache", help="канал LISTEN/NOTIFY для проверки сброса")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
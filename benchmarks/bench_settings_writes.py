@@ -0,0 +1,97 @@
+# benchmarks/bench_settings_writes.py
+"""Запись настроек напоминаний: отдельный upsert на каждое действие пользователя против пакетов SettingsWriter.
+
+Моделирует кампанию онбординга: --upserts пользователей почти одновременно настраивают ежедневное
+напоминание, одновременно обрабатывается до --concurrency обновлений (как UPDATE_CONCURRENCY).
+Каждая запись подтверждается после COMMIT. Пакет из одной таблицы — один запрос без явной транзакции,
+поэтому число вызовов по счётчику db_query_seconds равно числу обращений к серверу.
+
+Запуск: DATABASE_URL=postgresql://... python benchmarks/bench_settings_writes.py --upserts 10000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, time as dt_time, timedelta, timezone
+from typing import Awaitable, Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncpg  # noqa: E402
+
+import db  # noqa: E402
+import metrics  # noqa: E402
+from settings_writer import SettingsWriter  # noqa: E402
+
+# Пользователи бенчмарка не пересекаются с настоящими
+USER_ID_BASE = 9_000_000_000
+
+
+def query_calls(name: str) -> int:
+    return metrics.histogram("db_query_seconds", "", {"query": name}).count
+
+
+async def run(
+    label: str, pool: asyncpg.pool.Pool, upsert: Callable[[int], Awaitable[None]], opts: argparse.Namespace, query: str
+) -> None:
+    semaphore = asyncio.Semaphore(opts.concurrency)
+    latencies: List[float] = []
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await upsert(USER_ID_BASE + i)
+            latencies.append(time.perf_counter() - started)
+
+    calls_before = query_calls(query)
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(opts.upserts)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(
+        f"{label}: {opts.upserts} записей за {elapsed:.2f} с ({opts.upserts / elapsed:.0f}/с), "
+        f"обращений к БД {query_calls(query) - calls_before}, "
+        f"подтверждение p50 {latencies[len(latencies) // 2] * 1000:.1f} мс, "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} мс"
+    )
+
+
+async def main_async(opts: argparse.Namespace) -> None:
+    pool = await db.create_db_pool()
+    if pool is None:
+        return
+    fire = datetime.now(timezone.utc) + timedelta(days=1)
+    local = dt_time(8, 0)
+
+    async def direct(user_id: int) -> None:
+        await db.upsert_daily_reminder_settings(pool, user_id, local, "Europe/Moscow", fire, active=False)
+
+    writer = SettingsWriter(pool, delay_ms=opts.delay_ms)
+    writer.start()
+
+    async def batched(user_id: int) -> None:
+        await writer.upsert_daily_reminder(user_id, local, "Europe/Moscow", fire, active=False)
+
+    # Логи каждой записи не должны влиять на замер
+    db.logger.disabled = True
+    try:
+        await run("По одному upsert", pool, direct, opts, "upsert_daily_reminder_settings")
+        await run("SettingsWriter   ", pool, batched, opts, "write_settings")
+    finally:
+        await writer.stop()
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM daily_reminders WHERE user_id >= $1", USER_ID_BASE)
+        await pool.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк пакетной записи настроек")
+    parser.add_argument("--upserts", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=64, help="одновременно обрабатываемых обновлений")
+    parser.add_argument("--delay-ms", type=float, default=5, help="SETTINGS_BATCH_DELAY_MS")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
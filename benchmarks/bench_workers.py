@@ -0,0 +1,135 @@
+# benchmarks/bench_workers.py
+"""Масштабирование по воркерам: фейковый Bot API, N процессов bot.py и router.py, прогон replay_updates.
+
+Для каждого N из --workers поднимает воркеры в режиме webhook (BOT_WORKERS=N, у каждого свой
+порт и свой токен, чтобы фейковый API видел, какой воркер ответил), маршрутизатор перед ними
+и прогоняет одинаковый поток обновлений. Печатает пропускную способность, ускорение относительно
+одного воркера и число нарушений «липкости» (ответ одному пользователю от разных воркеров).
+
+Запуск: DATABASE_URL=... python benchmarks/bench_workers.py --workers 1 2 4 --updates 2000
+Без DATABASE_URL воркеры работают без БД (без persistence и рассылок).
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from replay_updates import replay, synthetic_updates  # noqa: E402
+
+SECRET = "bench-workers"
+FAKE_API_PORT = 8090
+ROUTER_PORT = 8443
+WORKER_BASE_PORT = 8500
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Порт {port} не открылся за {timeout} с")
+
+
+def start(args: List[str], env: Dict[str, str], log_name: str) -> subprocess.Popen:
+    log = open(os.path.join(ROOT, "logs", log_name), "w")
+    return subprocess.Popen([sys.executable, *args], cwd=ROOT, env={**os.environ, **env}, stdout=log, stderr=log)
+
+
+def stop(processes: List[subprocess.Popen]) -> None:
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run_cluster(workers: int, updates: List[dict], opts: argparse.Namespace) -> Dict[str, float]:
+    worker_urls = [f"http://127.0.0.1:{WORKER_BASE_PORT + i}/telegram" for i in range(workers)]
+    processes = []
+    try:
+        for i in range(workers):
+            processes.append(start(["bot.py"], {
+                "TELEGRAM_BOT_TOKEN": f"123:worker{i}",
+                "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{FAKE_API_PORT}/bot",
+                "BOT_MODE": "webhook",
+                "BOT_WORKERS": str(workers),
+                "WEBHOOK_URL": f"http://127.0.0.1:{ROUTER_PORT}",
+                "WEBHOOK_LISTEN": "127.0.0.1",
+                "WEBHOOK_PORT": str(WORKER_BASE_PORT + i),
+                "WEBHOOK_SECRET_TOKEN": SECRET,
+                "UPDATE_CONCURRENCY": str(opts.update_concurrency),
+                "GEMINI_API_KEY": os.getenv("GEMINI_API_KEY", "bench"),
+            }, f"bench_worker_{i}.log"))
+        processes.append(start(["router.py"], {
+            "ROUTER_LISTEN": "127.0.0.1",
+            "ROUTER_PORT": str(ROUTER_PORT),
+            "ROUTER_WORKER_URLS": ",".join(worker_urls),
+            "WEBHOOK_SECRET_TOKEN": SECRET,
+        }, "bench_router.log"))
+        for port in [WORKER_BASE_PORT + i for i in range(workers)] + [ROUTER_PORT]:
+            wait_for_port(port)
+        stats_url = f"http://127.0.0.1:{FAKE_API_PORT}/stats"
+        violations_before = httpx.get(stats_url).json().get("sticky_violations", 0)
+        throughput = asyncio.run(replay(
+            f"http://127.0.0.1:{ROUTER_PORT}/telegram", SECRET, updates, opts.concurrency, stats_url, None, opts.timeout
+        ))
+        violations = httpx.get(stats_url).json().get("sticky_violations", 0) - violations_before
+        return {"throughput": throughput, "violations": violations}
+    finally:
+        stop(processes)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк масштабирования по воркерам")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременных запросов к маршрутизатору")
+    parser.add_argument("--update-concurrency", type=int, default=32, help="UPDATE_CONCURRENCY каждого воркера")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="задержка ответа фейкового Bot API, секунды")
+    parser.add_argument("--timeout", type=float, default=300)
+    opts = parser.parse_args()
+
+    os.makedirs(os.path.join(ROOT, "logs"), exist_ok=True)
+    fake_api = start([
+        "benchmarks/fake_bot_api.py", "--port", str(FAKE_API_PORT), "--global-rate", "1000000",
+        "--per-chat-rate", "1000", "--latency", str(opts.api_latency),
+    ], {}, "bench_fake_bot_api.log")
+    try:
+        wait_for_port(FAKE_API_PORT)
+        results = {}
+        for workers in opts.workers:
+            print(f"--- воркеров: {workers}")
+            # Свежие user_id на каждый прогон, чтобы проверка липкости не смешивала прогоны
+            updates = synthetic_updates(opts.updates, opts.users, "Помощь")
+            for update in updates:
+                shifted = update["message"]["from"]["id"] + workers * 10_000_000
+                update["message"]["from"]["id"] = update["message"]["chat"]["id"] = shifted
+            results[workers] = run_cluster(workers, updates, opts)
+    finally:
+        stop([fake_api])
+
+    base = results[opts.workers[0]]["throughput"] / opts.workers[0]
+    print(f"\n{'воркеров':>8} {'обновлений/с':>13} {'ускорение':>10} {'нарушений липкости':>19}")
+    for workers, result in results.items():
+        print(
+            f"{workers:>8} {result['throughput']:>13.0f} {result['throughput'] / base:>10.2f} "
+            f"{result['violations']:>19.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
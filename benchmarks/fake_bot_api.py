@@ -0,0 +1,145 @@
+# benchmarks/fake_bot_api.py
+"""Локальный фейковый Telegram Bot API для бенчмарков рассылок.
+
+Отвечает на getMe, setWebhook/deleteWebhook и sendMessage, соблюдая лимиты настоящего API: не больше --global-rate
+сообщений в секунду на бота и --per-chat-rate в один чат. При превышении возвращает 429 с
+retry_after, как Telegram. Часть чатов (--blocked) отвечает 403, часть запросов (--error-rate) — 502.
+GET /stats возвращает счётчики ответов по кодам (их читает benchmarks/replay_updates.py) и
+sticky_violations — сколько раз в один чат писали с разными токенами (воркерами, см. bench_workers.py).
+
+Запуск: python benchmarks/fake_bot_api.py --port 8090
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency: float = 0.05
+    global_rate: int = 30
+    per_chat_rate: int = 1
+    blocked_every: int = 0
+    error_rate: float = 0.0
+
+    lock = threading.Lock()
+    sent: Deque[float] = deque()
+    per_chat: Dict[int, Deque[float]] = defaultdict(deque)
+    stats: Dict[str, int] = defaultdict(int)
+    chat_tokens: Dict[int, str] = {}
+
+    def _reply(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_params(self) -> dict:
+        length = int(self.headers.get("Content-Length", "0"))
+        raw = self.rfile.read(length).decode("utf-8")
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(raw or "{}")
+        from urllib.parse import parse_qsl
+        return dict(parse_qsl(raw))
+
+    def _too_many(self, window: Deque[float], limit: int, now: float) -> float:
+        while window and now - window[0] >= 1.0:
+            window.popleft()
+        if len(window) >= limit:
+            return 1.0 - (now - window[0])
+        return 0.0
+
+    def do_POST(self) -> None:
+        params = self._read_params()
+        method = self.path.rsplit("/", 1)[-1]
+        if method == "getMe":
+            self._reply(200, {"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False,
+            }})
+            return
+        if method in ("setWebhook", "deleteWebhook"):
+            self._reply(200, {"ok": True, "result": True})
+            return
+        if method != "sendMessage":
+            self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+        time.sleep(self.latency)
+        chat_id = int(params["chat_id"])
+        now = time.monotonic()
+        with self.lock:
+            wait = max(
+                self._too_many(self.sent, self.global_rate, now),
+                self._too_many(self.per_chat[chat_id], self.per_chat_rate, now),
+            )
+            if wait > 0:
+                self.stats["429"] += 1
+                retry_after = max(1, round(wait))
+            else:
+                self.sent.append(now)
+                self.per_chat[chat_id].append(now)
+                token = self.path.split("/")[-2]
+                if self.chat_tokens.setdefault(chat_id, token) != token:
+                    self.stats["sticky_violations"] += 1
+        if wait > 0:
+            self._reply(429, {
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            })
+            return
+        if self.blocked_every and chat_id % self.blocked_every == 0:
+            self.stats["403"] += 1
+            self._reply(403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"})
+            return
+        if random.random() < self.error_rate:
+            self.stats["502"] += 1
+            self._reply(502, {"ok": False, "error_code": 502, "description": "Bad Gateway"})
+            return
+        self.stats["200"] += 1
+        self._reply(200, {"ok": True, "result": {
+            "message_id": self.stats["200"], "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", ""),
+        }})
+
+    def do_GET(self) -> None:
+        if self.path != "/stats":
+            self._reply(404, {"ok": False})
+            return
+        with self.lock:
+            self._reply(200, dict(self.stats))
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа, секунды")
+    parser.add_argument("--global-rate", type=int, default=30, help="сообщений в секунду на бота")
+    parser.add_argument("--per-chat-rate", type=int, default=1, help="сообщений в секунду в один чат")
+    parser.add_argument("--blocked", type=int, default=0, help="каждый N-й chat_id отвечает 403")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 502")
+    args = parser.parse_args()
+    FakeBotApiHandler.latency = args.latency
+    FakeBotApiHandler.global_rate = args.global_rate
+    FakeBotApiHandler.per_chat_rate = args.per_chat_rate
+    FakeBotApiHandler.blocked_every = args.blocked
+    FakeBotApiHandler.error_rate = args.error_rate
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeBotApiHandler)
+    print(f"Фейковый Bot API слушает http://127.0.0.1:{args.port}/bot<token>/ (лимит {args.global_rate} сообщений/с)")
+    try:
+        server.serve_forever()
+    finally:
+        print(f"Ответы: {dict(FakeBotApiHandler.stats)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# benchmarks/fake_gemini.py
+"""Локальный фейковый сервер Gemini REST API для бенчмарков.
+
+Запуск: python benchmarks/fake_gemini.py --port 8089 --latency 0.5
+Сбои: --error-rate 0.2 (доля ответов 503), --slow-rate 0.05 --slow-latency 10 (доля «зависших» ответов)
+Бот: GEMINI_BASE_URL=http://127.0.0.1:8089 GEMINI_API_KEY=fake python bot.py
+"""
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_TEXT = "Это тестовый ответ фейкового сервера Gemini. " * 8
+
+
+def _payload(text: str) -> bytes:
+    return json.dumps({
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}],
+    }).encode("utf-8")
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    latency: float = 0.0
+    chunk_delay: float = 0.05
+    error_rate: float = 0.0
+    slow_rate: float = 0.0
+    slow_latency: float = 10.0
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", "0"))
+        self.rfile.read(length)
+        time.sleep(self.slow_latency if random.random() < self.slow_rate else self.latency)
+        if random.random() < self.error_rate:
+            body = b'{"error": {"code": 503, "message": "fake overload"}}'
+            self.send_response(503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if "streamGenerateContent" in self.path:
+            self._stream()
+            return
+        body = _payload(FAKE_TEXT)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for word in FAKE_TEXT.split(" "):
+            event = b"data: " + _payload(word + " ") + b"\r\n\r\n"
+            self.wfile.write(f"{len(event):X}\r\n".encode() + event + b"\r\n")
+            self.wfile.flush()
+            time.sleep(self.chunk_delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Фейковый Gemini API")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5, help="задержка ответа, секунды")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="пауза между кусками потокового ответа")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="доля ответов с задержкой --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=10.0)
+    args = parser.parse_args()
+    FakeGeminiHandler.latency = args.latency
+    FakeGeminiHandler.chunk_delay = args.chunk_delay
+    FakeGeminiHandler.error_rate = args.error_rate
+    FakeGeminiHandler.slow_rate = args.slow_rate
+    FakeGeminiHandler.slow_latency = args.slow_latency
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeGeminiHandler)
+    print(f"Фейковый Gemini слушает http://127.0.0.1:{args.port} (задержка {args.latency} с)")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# benchmarks/replay_updates.py
+"""Прогон записанных обновлений через вебхук бота: время подтверждения (ack) и сквозная пропускная способность.
+
+Обновления берутся из файла JSONL (по одному объекту Update в строке) или генерируются:
+сообщения «Помощь» от --users разных пользователей. Каждое такое обновление бот обрабатывает
+одним sendMessage, поэтому конец обработки виден по счётчику фейкового Bot API (GET /stats).
+
+Запуск: python benchmarks/fake_bot_api.py --global-rate 100000 &
+        TELEGRAM_BOT_TOKEN=123:fake TELEGRAM_API_BASE_URL=http://127.0.0.1:8090/bot BOT_MODE=webhook \\
+            WEBHOOK_URL=http://127.0.0.1:8443 WEBHOOK_SECRET_TOKEN=replay UPDATE_CONCURRENCY=64 python bot.py &
+        python benchmarks/replay_updates.py --updates 2000 --secret replay
+"""
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import httpx
+
+
+def synthetic_updates(count: int, users: int, text: str) -> List[dict]:
+    now = int(datetime.now(timezone.utc).timestamp())
+    updates = []
+    for i in range(count):
+        user_id = 1_000_000 + i % users
+        updates.append({
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1,
+                "date": now,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Replay"},
+                "text": text,
+            },
+        })
+    return updates
+
+
+def load_updates(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def sent_messages(client: httpx.AsyncClient, stats_url: str) -> int:
+    response = await client.get(stats_url)
+    return response.json().get("200", 0)
+
+
+async def replay(
+    url: str, secret: str, updates: List[dict], concurrency: int, stats_url: str, expected: Optional[int], timeout: float
+) -> float:
+    """Возвращает сквозную пропускную способность, обновлений в секунду."""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    latencies: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        rejected = await client.post(url, json=updates[0], headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        print(f"Запрос с неверным секретом: HTTP {rejected.status_code}")
+        sent_before = await sent_messages(client, stats_url)
+
+        async def post(update: dict) -> None:
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(url, json=update, headers=headers)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+        acked = time.perf_counter() - started
+
+        expected = len(updates) if expected is None else expected
+        sent = 0
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            sent = await sent_messages(client, stats_url) - sent_before
+            if sent >= expected:
+                break
+            await asyncio.sleep(0.05)
+        processed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f"Подтверждено {len(updates) - errors} из {len(updates)} за {acked:.2f} с "
+        f"({len(updates) / acked:.0f} обновлений/с), ack p50 {p50 * 1000:.1f} мс, p95 {p95 * 1000:.1f} мс, "
+        f"max {latencies[-1] * 1000:.1f} мс"
+    )
+    print(f"Обработано (ответов бота) {sent} из {expected} за {processed:.2f} с ({sent / processed:.0f} обновлений/с)")
+    return sent / processed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Воспроизведение обновлений через вебхук бота")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET_TOKEN бота")
+    parser.add_argument("--file", help="JSONL с записанными обновлениями")
+    parser.add_argument("--updates", type=int, default=1000, help="число сгенерированных обновлений")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--text", default="Помощь")
+    parser.add_argument("--concurrency", type=int, default=40, help="одновременных запросов, как max_connections у Telegram")
+    parser.add_argument("--stats-url", default="http://127.0.0.1:8090/stats")
+    parser.add_argument("--expect", type=int, help="сколько sendMessage ждать (по умолчанию — по одному на обновление)")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+    updates = load_updates(args.file) if args.file else synthetic_updates(args.updates, args.users, args.text)
+    asyncio.run(replay(args.url, args.secret, updates, args.concurrency, args.stats_url, args.expect, args.timeout))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# chat_memory.py
+# Память чата с ИИ-психологом. В промпт попадает краткое содержание ранней части беседы и последние
+# реплики целиком в пределах бюджета токенов, поэтому размер промпта не растёт с длиной беседы.
+# Реплики старше последних CHAT_RECENT_TURNS в фоне сворачиваются в краткое содержание отдельным
+# коротким запросом к модели (purpose="summary", самый низкий приоритет в очереди Gemini).
+# История хранится в user_data: вместе с ним она переживает перезапуск (persistence.py)
+# и сбрасывается по «Главное меню».
+import logging
+import os
+from typing import Any, Dict, List, Set, Tuple
+
+from telegram.ext import Application
+
+import metrics
+from gemini_client import estimate_tokens
+from gemini_queue import GeminiQueueFull, GeminiRequestScheduler
+from gemini_resilience import GeminiUnavailable
+
+logger = logging.getLogger(__name__)
+
+# Бюджет токенов на историю в одном промпте: краткое содержание плюс последние реплики
+CHAT_HISTORY_TOKEN_BUDGET: int = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "2000"))
+# Сколько последних пар «вопрос — ответ» хранится дословно, остальные сворачиваются
+CHAT_RECENT_TURNS: int = int(os.getenv("CHAT_RECENT_TURNS", "4"))
+CHAT_SUMMARY_MAX_TOKENS: int = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "300"))
+
+COMPACTIONS = metrics.counter("chat_memory_compactions_total", "Свёртки ранних реплик чата в краткое содержание")
+COMPACTION_ERRORS = metrics.counter("chat_memory_compaction_errors_total", "Неудачные свёртки истории чата")
+HISTORY_TOKENS = metrics.histogram(
+    "chat_memory_prompt_tokens", "Оценка токенов истории, попавшей в промпт", buckets=(100, 250, 500, 1000, 2000, 4000)
+)
+
+
+def _turn_text(turn: List[str]) -> str:
+    return f"Клиент: {turn[0]}\nПсихолог: {turn[1]}"
+
+
+def chat_history(user_data: Dict[str, Any], name: str) -> Dict[str, Any]:
+    """История чата name в user_data: {"summary": краткое содержание, "turns": [[вопрос, ответ], ...]}."""
+    memory = user_data.setdefault("chat_memory", {})
+    history = memory.get(name)
+    if history is None:
+        history = memory[name] = {"summary": "", "turns": []}
+    return history
+
+
+def reset_chat_history(user_data: Dict[str, Any], name: str) -> None:
+    """Новый контекст (пройден тест, построена ретроспектива) — беседа начинается заново."""
+    user_data.setdefault("chat_memory", {})[name] = {"summary": "", "turns": []}
+
+
+def record_turn(history: Dict[str, Any], question: str, answer: str) -> None:
+    history["turns"].append([question, answer])
+
+
+def format_history(history: Dict[str, Any], budget: int = CHAT_HISTORY_TOKEN_BUDGET) -> str:
+    """Текст истории для промпта: не больше budget токенов при любой длине беседы.
+
+    Берутся самые свежие реплики, пока они помещаются; если свёртка ещё не успела (или не удалась),
+    лишние старые реплики просто не попадают в промпт.
+    """
+    summary: str = history.get("summary", "")
+    parts: List[str] = []
+    used = 0
+    if summary:
+        summary_block = "Краткое содержание предыдущей беседы: " + summary
+        parts.append(summary_block)
+        used = estimate_tokens(summary_block)
+    recent: List[str] = []
+    for turn in reversed(history.get("turns", [])):
+        text = _turn_text(turn)
+        tokens = estimate_tokens(text)
+        if used + tokens > budget:
+            break
+        recent.append(text)
+        used += tokens
+    if recent:
+        parts.append("Последние реплики беседы:\n" + "\n".join(reversed(recent)))
+    HISTORY_TOKENS.observe(used)
+    return "\n\n".join(parts)
+
+
+def build_summary_prompt(summary: str, turns: List[List[str]]) -> str:
+    prompt = (
+        "Сожмите беседу психолога с клиентом в краткое содержание "
+        f"(не более {CHAT_SUMMARY_MAX_TOKENS // 2} слов, от третьего лица). "
+        "Сохраните факты о клиенте, его состояние, обсуждённые темы и данные рекомендации; "
+        "приветствия и повторы опустите.\n\n"
+    )
+    if summary:
+        prompt += "Краткое содержание более ранней части беседы: " + summary + "\n\n"
+    prompt += "Новые реплики:\n" + "\n".join(_turn_text(turn) for turn in turns)
+    return prompt
+
+
+def turns_to_fold(history: Dict[str, Any], budget: int = CHAT_HISTORY_TOKEN_BUDGET) -> int:
+    """Сколько старых реплик пора свернуть: всё сверх CHAT_RECENT_TURNS и то, что не помещается в бюджет."""
+    turns = history["turns"]
+    count = max(0, len(turns) - CHAT_RECENT_TURNS)
+    turns_budget = budget - CHAT_SUMMARY_MAX_TOKENS
+    # Последнюю реплику оставляем дословно, даже если она одна больше бюджета
+    while count < len(turns) - 1 and sum(estimate_tokens(_turn_text(t)) for t in turns[count:]) > turns_budget:
+        count += 1
+    return count
+
+
+class ChatHistoryCompactor:
+    """Фоновая свёртка истории: не больше одной свёртки на чат пользователя одновременно."""
+
+    def __init__(self, application: Application, scheduler: GeminiRequestScheduler) -> None:
+        self.application = application
+        self.scheduler = scheduler
+        self._running: Set[Tuple[int, str]] = set()
+
+    def maybe_compact(self, user_id: int, name: str, history: Dict[str, Any]) -> None:
+        if (user_id, name) in self._running or not turns_to_fold(history):
+            return
+        self._running.add((user_id, name))
+        self.application.create_task(self._compact(user_id, name, history))
+
+    async def _compact(self, user_id: int, name: str, history: Dict[str, Any]) -> None:
+        try:
+            count = turns_to_fold(history)
+            prompt = build_summary_prompt(history["summary"], history["turns"][:count])
+            try:
+                summary = await self.scheduler.submit(
+                    user_id, prompt, purpose="summary", max_tokens=CHAT_SUMMARY_MAX_TOKENS
+                )
+            except (GeminiQueueFull, GeminiUnavailable):
+                # Очередь занята живыми запросами или Gemini недоступен — свернём после следующей реплики
+                COMPACTION_ERRORS.inc()
+                return
+            except Exception:
+                COMPACTION_ERRORS.inc()
+                logger.exception(f"Не удалось свернуть историю чата {name} пользователя {user_id}:")
+                return
+            if not summary:
+                COMPACTION_ERRORS.inc()
+                return
+            # Новые реплики добавляются только в конец, поэтому первые count — ровно те, что свёрнуты.
+            # Если историю за это время сбросили, history уже не связан с user_data и правка ни на что не влияет
+            history["summary"] = summary.strip()
+            del history["turns"][:count]
+            COMPACTIONS.inc()
+            self.application.mark_data_for_update_persistence(user_ids=user_id)
+            logger.info(f"История чата {name} пользователя {user_id}: свёрнуто реплик {count}")
+        finally:
+            self._running.discard((user_id, name))
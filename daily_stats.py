@@ -0,0 +1,122 @@
+# daily_stats.py
+# Скользящие средние для ретроспектив по дневным корзинам user_daily_stats:
+# ретроспектива читает не больше period_days строк, сколько бы тестов ни было в истории.
+import logging
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import asyncpg
+
+from db import FIXED_KEYS, RETRO_SCALES, get_daily_stats
+
+logger = logging.getLogger(__name__)
+
+# Самая длинная ретроспектива — две недели; столько дней держим в памяти на пользователя
+STATS_WINDOW_DAYS: int = 14
+STATS_CACHE_USERS: int = int(os.getenv("STATS_CACHE_USERS", "10000"))
+
+
+def stats_day(moment: datetime) -> date:
+    """День корзины: дата по UTC, как в user_daily_stats."""
+    return moment.astimezone(timezone.utc).date()
+
+
+@dataclass
+class DayBucket:
+    test_count: int = 0
+    sums: List[int] = field(default_factory=lambda: [0] * len(FIXED_KEYS))
+    counts: List[int] = field(default_factory=lambda: [0] * len(FIXED_KEYS))
+
+    @classmethod
+    def from_record(cls, record: asyncpg.Record) -> "DayBucket":
+        return cls(
+            record["test_count"],
+            [record[f"sum_{i}"] for i in range(1, len(FIXED_KEYS) + 1)],
+            [record[f"cnt_{i}"] for i in range(1, len(FIXED_KEYS) + 1)],
+        )
+
+    def add_answers(self, answers: Dict[str, Any]) -> None:
+        self.test_count += 1
+        for i, key in enumerate(FIXED_KEYS):
+            try:
+                value = int(answers.get(key))
+            except (ValueError, TypeError):
+                continue
+            self.sums[i] += value
+            self.counts[i] += 1
+
+
+def scale_averages(buckets: Iterable[DayBucket]) -> Tuple[int, Dict[str, Optional[float]]]:
+    """Сворачивает корзины в число тестов и средние по шкалам ретроспективы."""
+    test_count = 0
+    sums = [0] * len(FIXED_KEYS)
+    counts = [0] * len(FIXED_KEYS)
+    for bucket in buckets:
+        test_count += bucket.test_count
+        for i in range(len(FIXED_KEYS)):
+            sums[i] += bucket.sums[i]
+            counts[i] += bucket.counts[i]
+    means = {key: sums[i] / counts[i] if counts[i] else None for i, key in enumerate(FIXED_KEYS)}
+    averages: Dict[str, Optional[float]] = {}
+    for scale, (a, b) in RETRO_SCALES.items():
+        averages[scale] = round((means[a] + means[b]) / 2, 2) if means[a] is not None and means[b] is not None else None
+    return test_count, averages
+
+
+class DailyStatsCache:
+    """Кэш дневных корзин за последние STATS_WINDOW_DAYS дней для недавно активных пользователей.
+
+    Корзины пользователя загружаются из БД при первой ретроспективе, а новые тесты
+    добавляются через record() сразу после сохранения, без повторного чтения.
+    """
+
+    def __init__(
+        self, pool: asyncpg.pool.Pool, max_users: int = STATS_CACHE_USERS, window_days: int = STATS_WINDOW_DAYS
+    ) -> None:
+        self.pool = pool
+        self.max_users = max_users
+        self.window_days = window_days
+        self._users: "OrderedDict[int, Dict[date, DayBucket]]" = OrderedDict()
+
+    def record(self, user_id: int, created_at: datetime, answers: Dict[str, Any]) -> None:
+        """Учитывает только что сохранённый тест, если корзины пользователя уже в памяти."""
+        buckets = self._users.get(user_id)
+        if buckets is None:
+            return
+        day = stats_day(created_at)
+        bucket = buckets.get(day)
+        if bucket is None:
+            bucket = buckets[day] = DayBucket()
+        bucket.add_answers(answers)
+
+    async def _load(self, user_id: int, since: date) -> Dict[date, DayBucket]:
+        records = await get_daily_stats(self.pool, user_id, since)
+        return {r["day"]: DayBucket.from_record(r) for r in records}
+
+    async def _window(self, user_id: int, today: date) -> Dict[date, DayBucket]:
+        window_start = today - timedelta(days=self.window_days - 1)
+        buckets = self._users.get(user_id)
+        if buckets is None:
+            buckets = await self._load(user_id, window_start)
+            self._users[user_id] = buckets
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+            for day in [d for d in buckets if d < window_start]:
+                del buckets[day]
+        return buckets
+
+    async def averages(
+        self, user_id: int, period_days: int, now: Optional[datetime] = None
+    ) -> Tuple[int, Dict[str, Optional[float]]]:
+        """Число тестов и средние по шкалам за последние period_days дней, включая сегодняшний."""
+        today = stats_day(now or datetime.now(timezone.utc))
+        since = today - timedelta(days=period_days - 1)
+        if period_days > self.window_days:
+            return scale_averages((await self._load(user_id, since)).values())
+        buckets = await self._window(user_id, today)
+        return scale_averages(bucket for day, bucket in buckets.items() if day >= since)
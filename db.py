@@ -1,146 +1,544 @@
 # db.py
 import asyncpg
+import json
 import os
-from datetime import date, time
-from typing import List, Dict, Any, Optional
+from contextlib import asynccontextmanager
+from datetime import date, datetime, time
+from time import perf_counter
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Any, Optional, Sequence, Set, Tuple, Union
 import logging
 
+import metrics
+
 logger = logging.getLogger(__name__)
 
 DATABASE_URL: str = os.getenv("DATABASE_URL", "")
+# Размер пула: обработчики обновлений, запись состояния диалогов и диспетчер напоминаний берут соединения
+# из одного пула, поэтому DB_POOL_MAX_SIZE стоит подбирать по db_pool_wait_seconds на /metrics
+DB_POOL_MIN_SIZE: int = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE: int = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Соединение, простаивающее дольше, закрывается (до DB_POOL_MIN_SIZE)
+DB_POOL_MAX_INACTIVE_LIFETIME: float = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
+# Кэш подготовленных запросов на соединение: каждый текст запроса разбирается и планируется сервером
+# один раз, дальше отправляются только параметры. Размер должен покрывать все запросы модуля;
+# 0 — для pgbouncer в режиме transaction без поддержки prepared statements
+DB_STATEMENT_CACHE_SIZE: int = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+# Таймауты, секунды: ожидание свободного соединения, запросы из обработчиков пользователя
+# и фоновые пакетные запросы (рассылки, запись состояния, загрузка архива)
+DB_ACQUIRE_TIMEOUT: float = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))
+DB_QUERY_TIMEOUT: float = float(os.getenv("DB_QUERY_TIMEOUT", "5"))
+DB_BATCH_TIMEOUT: float = float(os.getenv("DB_BATCH_TIMEOUT", "60"))
+
+POOL_WAIT = metrics.histogram("db_pool_wait_seconds", "Ожидание свободного соединения пула PostgreSQL")
+
+# Ключи advisory-блокировок: при одновременном запуске нескольких воркеров миграции применяет
+# и время срабатывания старым записям назначает только один из них, остальные ждут
+SCHEMA_LOCK_KEY: int = 7_140_001
+FIRE_TIMES_LOCK_KEY: int = 7_140_002
+
+# Применённые миграции. Проверка при запуске — один SELECT без блокировки, если схема актуальна
+MIGRATIONS_TABLE_SQL: str = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+# Миграция 1: таблицы напоминаний прежней версии бота хранят время в reminder_time/local_time и не имеют
+# target_local_time, timezone, active (и у ретроспектив — retrospective_type). CREATE TABLE IF NOT EXISTS
+# такие таблицы пропускает, а индексы следующих миграций ссылаются на новые столбцы, поэтому столбцы
+# добавляются первыми и заполняются по прежним (_upgrade_legacy_schedule_tables); прежние удаляет миграция 4
+LEGACY_SCHEDULE_COLUMNS_SQL: str = """
+ALTER TABLE IF EXISTS daily_reminders
+    ADD COLUMN IF NOT EXISTS target_local_time TIME,
+    ADD COLUMN IF NOT EXISTS timezone VARCHAR(64) NOT NULL DEFAULT 'UTC',
+    ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT true;
+ALTER TABLE IF EXISTS scheduled_retrospectives
+    ADD COLUMN IF NOT EXISTS scheduled_day SMALLINT,
+    ADD COLUMN IF NOT EXISTS target_local_time TIME,
+    ADD COLUMN IF NOT EXISTS timezone VARCHAR(64) NOT NULL DEFAULT 'UTC',
+    ADD COLUMN IF NOT EXISTS retrospective_type VARCHAR(16) NOT NULL DEFAULT 'weekly',
+    ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT true;
+"""
+
+# Таблица -> (прежний столбец со временем, из которого заполняется target_local_time;
+# добавленные столбцы без значения по умолчанию, которые в новой схеме NOT NULL)
+LEGACY_SCHEDULE_TABLES: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    "daily_reminders": ("reminder_time", ("target_local_time",)),
+    "scheduled_retrospectives": ("local_time", ("scheduled_day", "target_local_time")),
+}
+
+# Миграция 2: схема на момент появления миграций. Все команды идемпотентны, поэтому она же
+# безопасно применяется к базам, созданным раньше прежним setup_database
+SCHEMA_SQL: str = """
+CREATE TABLE IF NOT EXISTS test_results (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL,
+    answers JSONB NOT NULL,
+    interpretation TEXT
+);
+-- Выборки за период — это range scan по (user_id, created_at)
+CREATE UNIQUE INDEX IF NOT EXISTS test_results_user_created_idx ON test_results (user_id, created_at);
+
+CREATE TABLE IF NOT EXISTS retrospective_results (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL,
+    period_days SMALLINT NOT NULL,
+    test_count INTEGER NOT NULL,
+    averages JSONB NOT NULL,
+    open_answers JSONB NOT NULL,
+    interpretation TEXT
+);
+CREATE INDEX IF NOT EXISTS retrospective_results_user_created_idx ON retrospective_results (user_id, created_at);
+
+CREATE TABLE IF NOT EXISTS user_settings (
+    user_id BIGINT PRIMARY KEY,
+    timezone VARCHAR(64) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS daily_reminders (
+    user_id BIGINT PRIMARY KEY,
+    target_local_time TIME NOT NULL,
+    timezone VARCHAR(64) NOT NULL DEFAULT 'UTC',
+    active BOOLEAN NOT NULL DEFAULT true
+);
+-- Ближайший момент срабатывания по UTC; диспетчер раз в минуту выбирает по нему всё, что наступило,
+-- и сдвигает на следующий раз
+ALTER TABLE daily_reminders ADD COLUMN IF NOT EXISTS next_fire_utc TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS daily_reminders_next_fire_idx ON daily_reminders (next_fire_utc) WHERE active;
+
+CREATE TABLE IF NOT EXISTS scheduled_retrospectives (
+    user_id BIGINT PRIMARY KEY,
+    scheduled_day SMALLINT NOT NULL,
+    target_local_time TIME NOT NULL,
+    timezone VARCHAR(64) NOT NULL DEFAULT 'UTC',
+    retrospective_type VARCHAR(16) NOT NULL DEFAULT 'weekly',
+    active BOOLEAN NOT NULL DEFAULT true
+);
+ALTER TABLE scheduled_retrospectives ADD COLUMN IF NOT EXISTS next_fire_utc TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS scheduled_retrospectives_next_fire_idx
+    ON scheduled_retrospectives (next_fire_utc) WHERE active;
+
+-- Дневные корзины по каждому пользователю (день по UTC): число тестов, суммы и количества
+-- числовых ответов на фиксированные вопросы. Обновляются при каждом сохранении теста.
+CREATE TABLE IF NOT EXISTS user_daily_stats (
+    user_id BIGINT NOT NULL,
+    day DATE NOT NULL,
+    test_count INTEGER NOT NULL DEFAULT 0,
+    sum_1 INTEGER NOT NULL DEFAULT 0, cnt_1 INTEGER NOT NULL DEFAULT 0,
+    sum_2 INTEGER NOT NULL DEFAULT 0, cnt_2 INTEGER NOT NULL DEFAULT 0,
+    sum_3 INTEGER NOT NULL DEFAULT 0, cnt_3 INTEGER NOT NULL DEFAULT 0,
+    sum_4 INTEGER NOT NULL DEFAULT 0, cnt_4 INTEGER NOT NULL DEFAULT 0,
+    sum_5 INTEGER NOT NULL DEFAULT 0, cnt_5 INTEGER NOT NULL DEFAULT 0,
+    sum_6 INTEGER NOT NULL DEFAULT 0, cnt_6 INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day)
+);
+
+-- Состояние диалогов бота (persistence.py): context.user_data и состояния ConversationHandler,
+-- чтобы незавершённый тест или ретроспектива переживали перезапуск
+CREATE TABLE IF NOT EXISTS bot_user_data (
+    user_id BIGINT PRIMARY KEY,
+    data JSONB NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS bot_conversations (
+    name VARCHAR(64) NOT NULL,
+    key TEXT NOT NULL,
+    state INTEGER NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (name, key)
+);
+
+-- Кэш ответов Gemini (gemini_cache.py): ключ — sha256 модели, параметров генерации и нормализованного промпта
+CREATE TABLE IF NOT EXISTS gemini_response_cache (
+    key BYTEA PRIMARY KEY,
+    answer TEXT NOT NULL,
+    generation_seconds REAL NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    last_hit_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS gemini_response_cache_last_hit_idx ON gemini_response_cache (last_hit_at);
+"""
+
+# Миграция 3: записи без next_fire_utc ищутся при каждом запуске каждого воркера
+# (assign_missing_fire_times). Частичные индексы по (target_local_time, timezone) среди активных
+# записей без next_fire_utc превращают полный просмотр таблицы в чтение нескольких строк индекса,
+# а записи с назначенным временем в них не попадают и вставку не замедляют. Неактивным записям
+# время назначает upsert при повторном включении
+UNSCHEDULED_INDEXES_SQL: str = """
+CREATE INDEX IF NOT EXISTS daily_reminders_unscheduled_idx
+    ON daily_reminders (target_local_time, timezone) WHERE active AND next_fire_utc IS NULL;
+CREATE INDEX IF NOT EXISTS scheduled_retrospectives_unscheduled_idx
+    ON scheduled_retrospectives (scheduled_day, target_local_time, timezone, retrospective_type)
+    WHERE active AND next_fire_utc IS NULL;
+"""
+
+# Миграция 4: столбцы прежнего планировщика. Время срабатывания теперь считается по next_fire_utc,
+# а оставшиеся NOT NULL-столбцы без значений по умолчанию ломали бы вставку новых настроек
+DROP_LEGACY_SCHEDULE_COLUMNS_SQL: str = """
+ALTER TABLE daily_reminders DROP COLUMN IF EXISTS last_sent, DROP COLUMN IF EXISTS reminder_time;
+ALTER TABLE scheduled_retrospectives
+    DROP COLUMN IF EXISTS local_time, DROP COLUMN IF EXISTS server_time, DROP COLUMN IF EXISTS last_sent;
+"""
+
+def _timed(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Время и ошибки запроса — в гистограмму с меткой query=<имя функции>. Метрики создаются
+    один раз при импорте модуля, на вызов остаются только замер времени и сложение."""
+    labels = {"query": func.__name__}
+    return metrics.instrument(
+        func,
+        metrics.histogram("db_query_seconds", "Время запросов к PostgreSQL, включая ожидание соединения", labels),
+        metrics.counter("db_query_errors_total", "Запросы к PostgreSQL, завершившиеся исключением", labels),
+    )
+
+class BotConnection(asyncpg.Connection):
+    """Соединение пула, которое при возврате в пул не сбрасывается запросом RESET ALL/UNLISTEN/CLOSE ALL.
+    Функции этого модуля не меняют настройки сессии, не держат курсоры и сессионные блокировки,
+    поэтому сброс был бы лишним обращением к серверу на каждый запрос. Незавершённая транзакция
+    по-прежнему откатывается пулом."""
+
+    __slots__ = ()
+
+    def get_reset_query(self) -> str:
+        return ""
+
+@asynccontextmanager
+async def _acquire(pool: asyncpg.pool.Pool) -> AsyncIterator[BotConnection]:
+    """pool.acquire() с таймаутом и замером ожидания свободного соединения."""
+    started = perf_counter()
+    async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+        POOL_WAIT.observe(perf_counter() - started)
+        yield conn
+
+def _encode_jsonb(value: Any) -> bytes:
+    # Бинарный формат JSONB: байт версии 1, затем текст JSON
+    return b"\x01" + json.dumps(value).encode("utf-8")
+
+def _decode_jsonb(data: bytes) -> Any:
+    return json.loads(data[1:])
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    """Настраивает новое соединение пула: JSONB читается и пишется как объекты Python.
+    Кодек бинарный, потому что COPY (copy_records_to_table) работает только в бинарном формате."""
+    await conn.set_type_codec(
+        "jsonb", encoder=_encode_jsonb, decoder=_decode_jsonb, schema="pg_catalog", format="binary"
+    )
 
 async def create_db_pool() -> Optional[asyncpg.pool.Pool]:
-    """Создаёт пул соединений с PostgreSQL."""
+    """Создаёт пул соединений с PostgreSQL и применяет миграции схемы. Недоступная БД — None
+    (бот работает без неё); ошибка миграции пробрасывается и останавливает запуск."""
     if not DATABASE_URL:
         logger.error("DATABASE_URL не задан в переменных окружения!")
         return None
     try:
-        pool = await asyncpg.create_pool(DATABASE_URL)
-        logger.info("Пул соединений с БД успешно создан.")
-        # TODO (DB Schema): Добавить проверку и создание таблиц, если их нет
-        # await setup_database(pool)
-        return pool
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            # Схема меняется только при запуске, поэтому подготовленные запросы не устаревают по времени
+            max_cached_statement_lifetime=0,
+            connection_class=BotConnection,
+            init=_init_connection,
+            server_settings={"application_name": "telegram-bot"},
+        )
     except Exception as e:
         logger.exception("Ошибка при создании пула соединений с БД.")
         return None
+    logger.info(f"Пул соединений с БД успешно создан ({DB_POOL_MIN_SIZE}–{DB_POOL_MAX_SIZE} соединений).")
+    try:
+        await setup_database(pool)
+    except Exception:
+        # Со схемой, не дошедшей до нужной версии, запросы бота падали бы по одному — запуск прерываем
+        logger.exception("Не удалось применить миграции схемы БД, запуск остановлен.")
+        await pool.close()
+        raise
+    return pool
+
+# --- Изменение часового пояса ---
+# Подписчики (кэш часовых поясов, settings_cache.py) получают user_id после COMMIT каждой записи
+# часового пояса — и из set_user_timezone, и из пакетной write_settings
+TimezoneListener = Callable[[Sequence[int]], None]
+TIMEZONE_LISTENERS: List[TimezoneListener] = []
 
-# TODO (DB Schema): Пересмотреть схему БД и обновить функции ниже
-# для поддержки хранения часовых поясов и локального времени пользователя.
+def add_timezone_listener(listener: TimezoneListener) -> None:
+    TIMEZONE_LISTENERS.append(listener)
+
+def remove_timezone_listener(listener: TimezoneListener) -> None:
+    if listener in TIMEZONE_LISTENERS:
+        TIMEZONE_LISTENERS.remove(listener)
+
+def _timezones_changed(user_ids: Sequence[int]) -> None:
+    for listener in TIMEZONE_LISTENERS:
+        listener(user_ids)
 
 # --- Настройки Пользователя (Часовой пояс) ---
 
+@_timed
 async def set_user_timezone(pool: asyncpg.pool.Pool, user_id: int, timezone: str) -> None:
     """Сохраняет или обновляет часовой пояс пользователя."""
-    # TODO (DB Schema): Нужна таблица user_settings(user_id PK, timezone VARCHAR)
-    # или добавить столбец timezone в существующую таблицу пользователей.
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         try:
-            # Пример запроса (нужно адаптировать под вашу схему)
             await conn.execute(
                  """
                  INSERT INTO user_settings (user_id, timezone) VALUES ($1, $2)
                  ON CONFLICT (user_id) DO UPDATE SET timezone = EXCLUDED.timezone
                  """,
-                 user_id, timezone
+                 user_id, timezone, timeout=DB_QUERY_TIMEOUT
             )
             logger.info(f"Часовой пояс '{timezone}' установлен для пользователя {user_id}")
         except Exception as e:
             logger.exception(f"Ошибка при установке часового пояса для {user_id}")
             raise
+    _timezones_changed((user_id,))
 
+@_timed
 async def get_user_timezone(pool: asyncpg.pool.Pool, user_id: int) -> Optional[str]:
-    """Получает часовой пояс пользователя."""
-    # TODO (DB Schema): Адаптировать запрос под вашу схему.
-    async with pool.acquire() as conn:
-        try:
-            result = await conn.fetchval(
-                "SELECT timezone FROM user_settings WHERE user_id = $1",
-                user_id
-            )
-            return result
-        except Exception as e:
-            logger.exception(f"Ошибка при получении часового пояса для {user_id}")
-            return None # Важно возвращать None при ошибке
+    """Получает часовой пояс пользователя (None — не задан). Ошибка БД пробрасывается, чтобы кэш
+    не запомнил её как отсутствие настройки; обработчикам None при ошибке возвращает
+    SettingsCache.get_user_timezone."""
+    async with _acquire(pool) as conn:
+        return await conn.fetchval(
+            "SELECT timezone FROM user_settings WHERE user_id = $1",
+            user_id, timeout=DB_QUERY_TIMEOUT
+        )
 
 # --- Ежедневные напоминания ---
-# TODO (DB Schema): Изменить схему daily_reminders:
-# user_id PK, target_local_time TIME, timezone VARCHAR, active BOOLEAN
-# Удалить last_sent, reminder_time (старое)
 
+@_timed
 async def upsert_daily_reminder_settings(
-    pool: asyncpg.pool.Pool, user_id: int, target_local_time: time, timezone: str, active: bool = True
+    pool: asyncpg.pool.Pool, user_id: int, target_local_time: time, timezone: str,
+    next_fire_utc: datetime, active: bool = True
 ) -> None:
-    """Сохраняет настройки ежедневного напоминания."""
-    async with pool.acquire() as conn:
+    """Сохраняет настройки ежедневного напоминания и момент его первого срабатывания."""
+    async with _acquire(pool) as conn:
         try:
             await conn.execute(
                 """
-                INSERT INTO daily_reminders (user_id, target_local_time, timezone, active)
-                VALUES ($1, $2, $3, $4)
+                INSERT INTO daily_reminders (user_id, target_local_time, timezone, next_fire_utc, active)
+                VALUES ($1, $2, $3, $4, $5)
                 ON CONFLICT (user_id) DO UPDATE
                 SET target_local_time = EXCLUDED.target_local_time,
                     timezone = EXCLUDED.timezone,
+                    next_fire_utc = EXCLUDED.next_fire_utc,
                     active = EXCLUDED.active
                 """,
-                user_id, target_local_time, timezone, active
+                user_id, target_local_time, timezone, next_fire_utc, active, timeout=DB_QUERY_TIMEOUT
             )
             logger.info(f"Настройки ежедневного напоминания обновлены для {user_id}")
         except Exception as e:
             logger.exception(f"Ошибка в upsert_daily_reminder_settings для {user_id}")
             raise
 
+@_timed
 async def get_active_daily_reminders(pool: asyncpg.pool.Pool) -> List[asyncpg.Record]:
     """Получает список активных ежедневных напоминаний (данные для пересчета)."""
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         # Возвращаем данные, нужные для расчета следующего запуска в scheduler.py
         return await conn.fetch(
-            "SELECT user_id, target_local_time, timezone FROM daily_reminders WHERE active = true"
+            "SELECT user_id, target_local_time, timezone FROM daily_reminders WHERE active = true",
+            timeout=DB_BATCH_TIMEOUT
         )
 
+def _drop_disabled(records: List[asyncpg.Record], fires: List[Optional[datetime]]) -> List[asyncpg.Record]:
+    """Убирает из результата записи, выключенные при сдвиге next_fire_utc."""
+    if None not in fires:
+        return records
+    return [r for r, fire in zip(records, fires) if fire is not None]
+
+@_timed
+async def claim_due_daily_reminders(
+    pool: asyncpg.pool.Pool, now: datetime, advance: Callable[[asyncpg.Record], Optional[datetime]],
+    batch_size: int = 1000
+) -> Tuple[List[asyncpg.Record], int]:
+    """Забирает до batch_size наступивших напоминаний и в той же транзакции сдвигает их
+    next_fire_utc на advance(запись). Возвращает записи с прежним next_fire_utc и число забранных строк.
+    Заблокированные другой транзакцией строки пропускаются (SKIP LOCKED).
+    Если advance вернул None (следующий момент не вычисляется, например из-за неизвестного
+    часового пояса), запись выключается и не возвращается — остальная пачка сохраняется. Поэтому
+    исчерпанность наступивших записей проверяется по числу забранных строк, а не по длине списка."""
+    async with _acquire(pool) as conn:
+        async with conn.transaction():
+            records = await conn.fetch(
+                """
+                SELECT user_id, target_local_time, timezone, next_fire_utc FROM daily_reminders
+                WHERE active = true AND next_fire_utc <= $1
+                ORDER BY next_fire_utc
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+                """,
+                now, batch_size, timeout=DB_BATCH_TIMEOUT
+            )
+            fires = [advance(r) for r in records]
+            if records:
+                await conn.execute(
+                    """
+                    UPDATE daily_reminders d SET next_fire_utc = s.next_fire_utc, active = s.next_fire_utc IS NOT NULL
+                    FROM unnest($1::bigint[], $2::timestamptz[]) AS s(user_id, next_fire_utc)
+                    WHERE d.user_id = s.user_id
+                    """,
+                    [r["user_id"] for r in records], fires, timeout=DB_BATCH_TIMEOUT
+                )
+    return _drop_disabled(records, fires), len(records)
+
+@_timed
+async def get_unscheduled_daily_reminder_groups(pool: asyncpg.pool.Pool) -> List[asyncpg.Record]:
+    """Различные (target_local_time, timezone) у активных напоминаний без next_fire_utc
+    (созданных до появления диспетчера)."""
+    async with _acquire(pool) as conn:
+        return await conn.fetch(
+            "SELECT DISTINCT target_local_time, timezone FROM daily_reminders "
+            "WHERE active = true AND next_fire_utc IS NULL",
+            timeout=DB_BATCH_TIMEOUT
+        )
+
+@_timed
+async def set_daily_reminder_next_fire(
+    pool: asyncpg.pool.Pool, groups: List[Tuple[time, str, Optional[datetime]]]
+) -> int:
+    """groups: (target_local_time, timezone, next_fire_utc) — момент назначается всей группе сразу.
+    Группа с next_fire_utc = None выключается. Возвращает число выключенных записей."""
+    times, timezones, fires = zip(*groups)
+    async with _acquire(pool) as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", FIRE_TIMES_LOCK_KEY, timeout=DB_BATCH_TIMEOUT)
+            # Одним UPDATE с хэш-соединением по группам, а не отдельным проходом по таблице на каждую группу
+            disabled = await conn.fetchval(
+                """
+                WITH updated AS (
+                    UPDATE daily_reminders d SET next_fire_utc = s.next_fire_utc, active = s.next_fire_utc IS NOT NULL
+                    FROM unnest($1::time[], $2::text[], $3::timestamptz[]) AS s(target_local_time, timezone, next_fire_utc)
+                    WHERE d.active AND d.next_fire_utc IS NULL AND d.target_local_time = s.target_local_time AND d.timezone = s.timezone
+                    RETURNING d.active
+                )
+                SELECT count(*) FROM updated WHERE NOT active
+                """,
+                times, timezones, fires, timeout=DB_BATCH_TIMEOUT
+            )
+    return disabled
+
 # Функции update_last_sent_daily больше не нужны для планирования
 
 # --- Запланированные ретроспективы ---
-# TODO (DB Schema): Изменить схему scheduled_retrospectives:
-# user_id PK, scheduled_day SMALLINT, target_local_time TIME, timezone VARCHAR,
-# retrospective_type VARCHAR, active BOOLEAN
-# Удалить local_time, server_time, last_sent
 
+@_timed
 async def upsert_scheduled_retrospective_settings(
     pool: asyncpg.pool.Pool, user_id: int, scheduled_day: int, target_local_time: time,
-    timezone: str, retrospective_type: str, active: bool = True
+    timezone: str, retrospective_type: str, next_fire_utc: datetime, active: bool = True
 ) -> None:
-    """Сохраняет настройки запланированной ретроспективы."""
-    async with pool.acquire() as conn:
+    """Сохраняет настройки запланированной ретроспективы и момент её первого срабатывания."""
+    async with _acquire(pool) as conn:
         try:
             await conn.execute(
                 """
                 INSERT INTO scheduled_retrospectives
-                    (user_id, scheduled_day, target_local_time, timezone, retrospective_type, active)
-                VALUES ($1, $2, $3, $4, $5, $6)
+                    (user_id, scheduled_day, target_local_time, timezone, retrospective_type, next_fire_utc, active)
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
                 ON CONFLICT (user_id) DO UPDATE
                 SET scheduled_day = EXCLUDED.scheduled_day,
                     target_local_time = EXCLUDED.target_local_time,
                     timezone = EXCLUDED.timezone,
                     retrospective_type = EXCLUDED.retrospective_type,
+                    next_fire_utc = EXCLUDED.next_fire_utc,
                     active = EXCLUDED.active
                 """,
-                user_id, scheduled_day, target_local_time, timezone, retrospective_type, active
+                user_id, scheduled_day, target_local_time, timezone, retrospective_type, next_fire_utc, active,
+                timeout=DB_QUERY_TIMEOUT
             )
             logger.info(f"Настройки запланированной ретроспективы обновлены для {user_id}")
         except Exception as e:
             logger.exception(f"Ошибка в upsert_scheduled_retrospective_settings для {user_id}")
             raise
 
+@_timed
 async def get_active_scheduled_retrospectives(pool: asyncpg.pool.Pool) -> List[asyncpg.Record]:
     """Получает список активных запланированных ретроспектив (данные для пересчета)."""
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         return await conn.fetch(
             """
             SELECT user_id, scheduled_day, target_local_time, timezone, retrospective_type
             FROM scheduled_retrospectives WHERE active = true
+            """,
+            timeout=DB_BATCH_TIMEOUT
+        )
+
+@_timed
+async def claim_due_scheduled_retrospectives(
+    pool: asyncpg.pool.Pool, now: datetime, advance: Callable[[asyncpg.Record], Optional[datetime]],
+    batch_size: int = 1000
+) -> Tuple[List[asyncpg.Record], int]:
+    """То же, что claim_due_daily_reminders, для запланированных ретроспектив."""
+    async with _acquire(pool) as conn:
+        async with conn.transaction():
+            records = await conn.fetch(
+                """
+                SELECT user_id, scheduled_day, target_local_time, timezone, retrospective_type, next_fire_utc
+                FROM scheduled_retrospectives
+                WHERE active = true AND next_fire_utc <= $1
+                ORDER BY next_fire_utc
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+                """,
+                now, batch_size, timeout=DB_BATCH_TIMEOUT
+            )
+            fires = [advance(r) for r in records]
+            if records:
+                await conn.execute(
+                    """
+                    UPDATE scheduled_retrospectives r
+                    SET next_fire_utc = s.next_fire_utc, active = s.next_fire_utc IS NOT NULL
+                    FROM unnest($1::bigint[], $2::timestamptz[]) AS s(user_id, next_fire_utc)
+                    WHERE r.user_id = s.user_id
+                    """,
+                    [r["user_id"] for r in records], fires, timeout=DB_BATCH_TIMEOUT
+                )
+    return _drop_disabled(records, fires), len(records)
+
+@_timed
+async def get_unscheduled_retrospective_groups(pool: asyncpg.pool.Pool) -> List[asyncpg.Record]:
+    """Различные настройки активных ретроспектив без next_fire_utc."""
+    async with _acquire(pool) as conn:
+        return await conn.fetch(
             """
+            SELECT DISTINCT scheduled_day, target_local_time, timezone, retrospective_type
+            FROM scheduled_retrospectives WHERE active = true AND next_fire_utc IS NULL
+            """,
+            timeout=DB_BATCH_TIMEOUT
         )
 
+@_timed
+async def set_scheduled_retrospective_next_fire(
+    pool: asyncpg.pool.Pool, groups: List[Tuple[int, time, str, str, Optional[datetime]]]
+) -> int:
+    """groups: (scheduled_day, target_local_time, timezone, retrospective_type, next_fire_utc);
+    None выключает группу, как в set_daily_reminder_next_fire."""
+    days, times, timezones, types, fires = zip(*groups)
+    async with _acquire(pool) as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", FIRE_TIMES_LOCK_KEY, timeout=DB_BATCH_TIMEOUT)
+            disabled = await conn.fetchval(
+                """
+                WITH updated AS (
+                    UPDATE scheduled_retrospectives r
+                    SET next_fire_utc = s.next_fire_utc, active = s.next_fire_utc IS NOT NULL
+                    FROM unnest($1::smallint[], $2::time[], $3::text[], $4::text[], $5::timestamptz[])
+                        AS s(scheduled_day, target_local_time, timezone, retrospective_type, next_fire_utc)
+                    WHERE r.active AND r.next_fire_utc IS NULL AND r.scheduled_day = s.scheduled_day
+                      AND r.target_local_time = s.target_local_time AND r.timezone = s.timezone
+                      AND r.retrospective_type = s.retrospective_type
+                    RETURNING r.active
+                )
+                SELECT count(*) FROM updated WHERE NOT active
+                """,
+                days, times, timezones, types, fires, timeout=DB_BATCH_TIMEOUT
+            )
+    return disabled
+
 # Функции update_last_sent_scheduled_retrospective больше не нужны для планирования
 
 # Старые функции weekly_retrospectives можно удалить, если они больше не используются.
@@ -148,9 +546,450 @@ async def get_active_scheduled_retrospectives(pool: asyncpg.pool.Pool) -> List[a
 # async def get_active_weekly_retrospectives(...)
 # async def update_last_sent_weekly(...)
 
-# --- Функции для сохранения/чтения данных тестов/ретроспектив ---
-# TODO (Data Storage): Эти функции нужно будет добавить/изменить при переносе
-# данных из JSON в БД. Пока оставляем как есть (работа с файлами будет в хендлерах).
-# async def save_test_results(pool, user_id, timestamp, answers, interpretation): ...
-# async def get_test_results_for_period(pool, user_id, start_date, end_date): ...
-# async def save_retrospective_results(pool, user_id, timestamp, period_days, averages, open_answers, interpretation): ...
+# --- Пакетная запись настроек ---
+
+# Строки пакетов: (user_id, timezone); аргументы upsert_daily_reminder_settings
+# и upsert_scheduled_retrospective_settings без pool, в том же порядке
+TimezoneRow = Tuple[int, str]
+DailyReminderRow = Tuple[int, time, str, datetime, bool]
+RetrospectiveRow = Tuple[int, int, time, str, str, datetime, bool]
+
+@_timed
+async def write_settings(
+    pool: asyncpg.pool.Pool,
+    timezones: List[TimezoneRow],
+    daily_reminders: List[DailyReminderRow],
+    retrospectives: List[RetrospectiveRow],
+) -> None:
+    """Пишет накопленные настройки пользователей по одному многострочному upsert на таблицу.
+    user_id внутри каждого списка не повторяются. Если непуст только один список, запрос идёт
+    без явной транзакции — одним обращением к серверу."""
+    statements: List[Tuple[str, List[Tuple[Any, ...]]]] = []
+    if timezones:
+        statements.append((
+            """
+            INSERT INTO user_settings (user_id, timezone)
+            SELECT * FROM unnest($1::bigint[], $2::text[])
+            ON CONFLICT (user_id) DO UPDATE SET timezone = EXCLUDED.timezone
+            """,
+            timezones,
+        ))
+    if daily_reminders:
+        statements.append((
+            """
+            INSERT INTO daily_reminders (user_id, target_local_time, timezone, next_fire_utc, active)
+            SELECT * FROM unnest($1::bigint[], $2::time[], $3::text[], $4::timestamptz[], $5::bool[])
+            ON CONFLICT (user_id) DO UPDATE
+            SET target_local_time = EXCLUDED.target_local_time,
+                timezone = EXCLUDED.timezone,
+                next_fire_utc = EXCLUDED.next_fire_utc,
+                active = EXCLUDED.active
+            """,
+            daily_reminders,
+        ))
+    if retrospectives:
+        statements.append((
+            """
+            INSERT INTO scheduled_retrospectives
+                (user_id, scheduled_day, target_local_time, timezone, retrospective_type, next_fire_utc, active)
+            SELECT * FROM unnest(
+                $1::bigint[], $2::smallint[], $3::time[], $4::text[], $5::text[], $6::timestamptz[], $7::bool[]
+            )
+            ON CONFLICT (user_id) DO UPDATE
+            SET scheduled_day = EXCLUDED.scheduled_day,
+                target_local_time = EXCLUDED.target_local_time,
+                timezone = EXCLUDED.timezone,
+                retrospective_type = EXCLUDED.retrospective_type,
+                next_fire_utc = EXCLUDED.next_fire_utc,
+                active = EXCLUDED.active
+            """,
+            retrospectives,
+        ))
+    if not statements:
+        return
+    async with _acquire(pool) as conn:
+        if len(statements) == 1:
+            sql, rows = statements[0]
+            await conn.execute(sql, *zip(*rows), timeout=DB_QUERY_TIMEOUT)
+        else:
+            async with conn.transaction():
+                for sql, rows in statements:
+                    await conn.execute(sql, *zip(*rows), timeout=DB_QUERY_TIMEOUT)
+    if timezones:
+        _timezones_changed([user_id for user_id, _ in timezones])
+
+# --- Схема ---
+
+async def _upgrade_legacy_schedule_tables(conn: asyncpg.Connection) -> None:
+    columns = {
+        (r["table_name"], r["column_name"])
+        for r in await conn.fetch(
+            "SELECT table_name::text, column_name::text FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = ANY($1::text[])",
+            [*LEGACY_SCHEDULE_TABLES, "user_settings"],
+        )
+    }
+    await conn.execute(LEGACY_SCHEDULE_COLUMNS_SQL)
+    for table, (legacy_time, required) in LEGACY_SCHEDULE_TABLES.items():
+        # Таблицы ещё нет (её создаст миграция 2) или она уже в новом формате
+        if not any(t == table for t, _ in columns) or (table, "target_local_time") in columns:
+            continue
+        if (table, legacy_time) in columns:
+            # Прежнее время хранилось как TIME или как строка 'ЧЧ:ММ[:СС]'
+            await conn.execute(
+                rf"UPDATE {table} SET target_local_time = "
+                rf"substring({legacy_time}::text FROM '\d{{1,2}}:\d{{2}}(?::\d{{2}})?')::time"
+            )
+        if (table, "timezone") not in columns and ("user_settings", "timezone") in columns:
+            await conn.execute(
+                f"UPDATE {table} t SET timezone = s.timezone FROM user_settings s WHERE s.user_id = t.user_id"
+            )
+        # Без времени (у ретроспектив и без дня недели) срабатывание не вычислить
+        removed = await conn.fetchval(
+            f"WITH d AS (DELETE FROM {table} WHERE {' OR '.join(f'{c} IS NULL' for c in required)} RETURNING 1) "
+            "SELECT count(*) FROM d"
+        )
+        if removed:
+            logger.warning(f"Из {table} удалено {removed} записей прежнего формата без времени срабатывания.")
+        await conn.execute(
+            f"ALTER TABLE {table} " + ", ".join(f"ALTER COLUMN {c} SET NOT NULL" for c in required)
+        )
+        logger.info(f"Таблица {table} прежнего формата дополнена новыми столбцами.")
+
+async def _create_base_schema(conn: asyncpg.Connection) -> None:
+    stats_missing = await conn.fetchval("SELECT to_regclass('user_daily_stats') IS NULL")
+    await conn.execute(SCHEMA_SQL)
+    if stats_missing:
+        # Таблица агрегатов появилась впервые — заполняем её по уже сохранённым тестам
+        await conn.execute(_daily_stats_upsert_sql("test_results"))
+        logger.info("Таблица user_daily_stats заполнена по истории тестов.")
+
+# (версия, название, SQL или функция от соединения). Версии только добавляются в конец;
+# применённую миграцию не меняют — изменение схемы оформляется новой миграцией
+MIGRATIONS: List[Tuple[int, str, Union[str, Callable[[asyncpg.Connection], Awaitable[None]]]]] = [
+    (1, "legacy_schedule_columns", _upgrade_legacy_schedule_tables),
+    (2, "base_schema", _create_base_schema),
+    (3, "unscheduled_reminder_indexes", UNSCHEDULED_INDEXES_SQL),
+    (4, "drop_legacy_schedule_columns", DROP_LEGACY_SCHEDULE_COLUMNS_SQL),
+]
+
+async def _applied_migrations(conn: asyncpg.Connection) -> Set[int]:
+    if await conn.fetchval("SELECT to_regclass('schema_migrations') IS NULL"):
+        return set()
+    return {r["version"] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+
+@_timed
+async def setup_database(pool: asyncpg.pool.Pool) -> None:
+    """Применяет недостающие миграции. Если схема актуальна, это одно чтение schema_migrations;
+    иначе миграции применяются одной транзакцией под advisory-блокировкой, и воркеры, запущенные
+    одновременно, дожидаются первого, а затем видят, что применять уже нечего."""
+    async with _acquire(pool) as conn:
+        pending = {version for version, _, _ in MIGRATIONS} - await _applied_migrations(conn)
+        if not pending:
+            logger.info(f"Схема БД актуальна (версия {MIGRATIONS[-1][0]}).")
+            return
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_KEY)
+            await conn.execute(MIGRATIONS_TABLE_SQL)
+            applied = await _applied_migrations(conn)
+            pending = [m for m in MIGRATIONS if m[0] not in applied]
+            for version, name, migration in pending:
+                started = perf_counter()
+                if isinstance(migration, str):
+                    await conn.execute(migration)
+                else:
+                    await migration(conn)
+                await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+                logger.info(f"Применена миграция {version} ({name}) за {perf_counter() - started:.2f} с.")
+    if pending:
+        logger.info(f"Схема БД обновлена до версии {MIGRATIONS[-1][0]}.")
+    else:
+        # Миграции, пока мы ждали блокировку, применил другой воркер
+        logger.info(f"Схема БД актуальна (версия {MIGRATIONS[-1][0]}).")
+
+# --- Состояние диалогов (persistence) ---
+
+@_timed
+async def get_bot_user_data(pool: asyncpg.pool.Pool, user_id: int) -> Optional[Dict[str, Any]]:
+    async with _acquire(pool) as conn:
+        return await conn.fetchval(
+            "SELECT data FROM bot_user_data WHERE user_id = $1", user_id, timeout=DB_QUERY_TIMEOUT
+        )
+
+@_timed
+async def get_bot_conversations(pool: asyncpg.pool.Pool, name: str, since: datetime) -> List[asyncpg.Record]:
+    """Состояния диалога name, менявшиеся после since (более старые считаются брошенными)."""
+    async with _acquire(pool) as conn:
+        return await conn.fetch(
+            "SELECT key, state FROM bot_conversations WHERE name = $1 AND updated_at >= $2", name, since,
+            timeout=DB_BATCH_TIMEOUT
+        )
+
+@_timed
+async def write_bot_state(
+    pool: asyncpg.pool.Pool,
+    user_data: List[Tuple[int, Optional[Dict[str, Any]]]],
+    conversations: List[Tuple[str, str, Optional[int]]],
+) -> None:
+    """Пишет накопленные изменения одной транзакцией: по одному многострочному upsert и delete
+    на таблицу. None вместо данных или состояния означает удаление записи."""
+    upserts = [(user_id, data) for user_id, data in user_data if data is not None]
+    drops = [user_id for user_id, data in user_data if data is None]
+    states = [(name, key, state) for name, key, state in conversations if state is not None]
+    ended = [(name, key) for name, key, state in conversations if state is None]
+    async with _acquire(pool) as conn:
+        async with conn.transaction():
+            if upserts:
+                await conn.execute(
+                    """
+                    INSERT INTO bot_user_data (user_id, data)
+                    SELECT * FROM unnest($1::bigint[], $2::jsonb[])
+                    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                    """,
+                    *zip(*upserts), timeout=DB_BATCH_TIMEOUT
+                )
+            if drops:
+                await conn.execute(
+                    "DELETE FROM bot_user_data WHERE user_id = ANY($1::bigint[])", drops, timeout=DB_BATCH_TIMEOUT
+                )
+            if states:
+                await conn.execute(
+                    """
+                    INSERT INTO bot_conversations (name, key, state)
+                    SELECT * FROM unnest($1::text[], $2::text[], $3::int[])
+                    ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state, updated_at = now()
+                    """,
+                    *zip(*states), timeout=DB_BATCH_TIMEOUT
+                )
+            if ended:
+                await conn.execute(
+                    """
+                    DELETE FROM bot_conversations c
+                    USING unnest($1::text[], $2::text[]) AS e(name, key)
+                    WHERE c.name = e.name AND c.key = e.key
+                    """,
+                    *zip(*ended), timeout=DB_BATCH_TIMEOUT
+                )
+
+# --- Кэш ответов Gemini ---
+
+@_timed
+async def get_cached_gemini_response(
+    pool: asyncpg.pool.Pool, key: bytes, fresh_since: datetime
+) -> Optional[asyncpg.Record]:
+    """Ответ из кэша, если он сохранён не раньше fresh_since; заодно отмечает попадание."""
+    async with _acquire(pool) as conn:
+        return await conn.fetchrow(
+            """
+            UPDATE gemini_response_cache SET hits = hits + 1, last_hit_at = now()
+            WHERE key = $1 AND created_at >= $2
+            RETURNING answer, generation_seconds, created_at
+            """,
+            key, fresh_since, timeout=DB_QUERY_TIMEOUT
+        )
+
+@_timed
+async def put_cached_gemini_response(
+    pool: asyncpg.pool.Pool, key: bytes, answer: str, generation_seconds: float
+) -> None:
+    async with _acquire(pool) as conn:
+        await conn.execute(
+            """
+            INSERT INTO gemini_response_cache (key, answer, generation_seconds) VALUES ($1, $2, $3)
+            ON CONFLICT (key) DO UPDATE SET answer = EXCLUDED.answer,
+                generation_seconds = EXCLUDED.generation_seconds, created_at = now(), last_hit_at = now()
+            """,
+            key, answer, generation_seconds, timeout=DB_QUERY_TIMEOUT
+        )
+
+@_timed
+async def evict_gemini_response_cache(pool: asyncpg.pool.Pool, expired_before: datetime, max_rows: int) -> int:
+    """Удаляет устаревшие записи и самые давно не использованные сверх max_rows. Возвращает число удалённых."""
+    async with _acquire(pool) as conn:
+        expired = await conn.execute(
+            "DELETE FROM gemini_response_cache WHERE created_at < $1", expired_before, timeout=DB_BATCH_TIMEOUT
+        )
+        overflow = await conn.execute(
+            """
+            DELETE FROM gemini_response_cache WHERE last_hit_at <= (
+                SELECT last_hit_at FROM gemini_response_cache ORDER BY last_hit_at DESC OFFSET $1 LIMIT 1
+            )
+            """,
+            max_rows, timeout=DB_BATCH_TIMEOUT
+        )
+    return int(expired.split()[-1]) + int(overflow.split()[-1])
+
+# --- Результаты тестов и ретроспектив ---
+
+# Шкалы ретроспективы: каждая — среднее двух фиксированных вопросов теста
+RETRO_SCALES: Dict[str, Tuple[str, str]] = {
+    "Самочувствие": ("fixed_1", "fixed_2"),
+    "Активность": ("fixed_3", "fixed_4"),
+    "Настроение": ("fixed_5", "fixed_6"),
+}
+
+FIXED_KEYS: List[str] = [key for pair in RETRO_SCALES.values() for key in pair]
+
+def _answer_filter_sql(key: str) -> str:
+    # Нечисловые ответы не учитываются, как и раньше при разборе int() в Python
+    return f"(answers->>'{key}') ~ '^\\s*[-+]?\\d+\\s*$'"
+
+DAILY_STATS_COLUMNS: List[str] = ["test_count"] + [
+    f"{prefix}_{i}" for i in range(1, len(FIXED_KEYS) + 1) for prefix in ("sum", "cnt")
+]
+
+def _daily_stats_upsert_sql(source: str) -> str:
+    """INSERT, прибавляющий к дневным корзинам user_daily_stats тесты из source
+    (таблицы или CTE со столбцами user_id, created_at, answers)."""
+    values = ["COUNT(*)"]
+    for key in FIXED_KEYS:
+        values.append(f"COALESCE(SUM((answers->>'{key}')::int) FILTER (WHERE {_answer_filter_sql(key)}), 0)")
+        values.append(f"COUNT(*) FILTER (WHERE {_answer_filter_sql(key)})")
+    columns = ", ".join(DAILY_STATS_COLUMNS)
+    updates = ", ".join(f"{c} = user_daily_stats.{c} + EXCLUDED.{c}" for c in DAILY_STATS_COLUMNS)
+    return (
+        f"INSERT INTO user_daily_stats (user_id, day, {columns})\n"
+        f"SELECT user_id, (created_at AT TIME ZONE 'UTC')::date, {', '.join(values)}\n"
+        f"FROM {source} GROUP BY 1, 2\n"
+        f"ON CONFLICT (user_id, day) DO UPDATE SET {updates}"
+    )
+
+
+@_timed
+async def save_test_results(
+    pool: asyncpg.pool.Pool, user_id: int, timestamp: datetime, answers: Dict[str, Any],
+    interpretation: Optional[str] = None
+) -> bool:
+    """Сохраняет ответы пройденного теста и тем же запросом обновляет дневную корзину
+    user_daily_stats. Возвращает False, если такой тест уже был сохранён."""
+    async with _acquire(pool) as conn:
+        try:
+            inserted = await conn.fetchval(
+                f"""
+                WITH ins AS (
+                    INSERT INTO test_results (user_id, created_at, answers, interpretation)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (user_id, created_at) DO NOTHING
+                    RETURNING user_id, created_at, answers
+                ), stats AS (
+                    {_daily_stats_upsert_sql("ins")}
+                )
+                SELECT COUNT(*) FROM ins
+                """,
+                user_id, timestamp, answers, interpretation, timeout=DB_QUERY_TIMEOUT
+            )
+            logger.info(f"Результаты теста сохранены для {user_id}")
+            return inserted > 0
+        except Exception as e:
+            logger.exception(f"Ошибка в save_test_results для {user_id}")
+            raise
+
+@_timed
+async def get_test_results_for_period(
+    pool: asyncpg.pool.Pool, user_id: int, start_date: datetime, end_date: datetime
+) -> List[asyncpg.Record]:
+    """Получает тесты пользователя за период (range scan по индексу (user_id, created_at))."""
+    async with _acquire(pool) as conn:
+        return await conn.fetch(
+            """
+            SELECT created_at, answers FROM test_results
+            WHERE user_id = $1 AND created_at >= $2 AND created_at <= $3
+            ORDER BY created_at
+            """,
+            user_id, start_date, end_date, timeout=DB_QUERY_TIMEOUT
+        )
+
+@_timed
+async def get_daily_stats(pool: asyncpg.pool.Pool, user_id: int, since: date) -> List[asyncpg.Record]:
+    """Дневные корзины пользователя начиная с дня since (по UTC)."""
+    async with _acquire(pool) as conn:
+        return await conn.fetch(
+            f"SELECT day, {', '.join(DAILY_STATS_COLUMNS)} FROM user_daily_stats "
+            "WHERE user_id = $1 AND day >= $2 ORDER BY day",
+            user_id, since, timeout=DB_QUERY_TIMEOUT
+        )
+
+@_timed
+async def bulk_load_test_results(pool: asyncpg.pool.Pool, records: List[Tuple[Any, ...]]) -> int:
+    """Массовая загрузка тестов через COPY во временную таблицу и INSERT ... ON CONFLICT DO NOTHING.
+    records: (user_id, created_at, answers, interpretation). Дневные корзины user_daily_stats
+    обновляются тем же запросом. Возвращает число новых строк."""
+    async with _acquire(pool) as conn:
+        async with conn.transaction():
+            await conn.execute(
+                """
+                CREATE TEMP TABLE IF NOT EXISTS test_results_stage
+                    (user_id BIGINT, created_at TIMESTAMPTZ, answers JSONB, interpretation TEXT)
+                ON COMMIT DELETE ROWS
+                """,
+                timeout=DB_BATCH_TIMEOUT
+            )
+            await conn.copy_records_to_table("test_results_stage", records=records, timeout=DB_BATCH_TIMEOUT)
+            return await conn.fetchval(
+                f"""
+                WITH ins AS (
+                    INSERT INTO test_results (user_id, created_at, answers, interpretation)
+                    SELECT user_id, created_at, answers, interpretation FROM test_results_stage
+                    ON CONFLICT (user_id, created_at) DO NOTHING
+                    RETURNING user_id, created_at, answers
+                ), stats AS (
+                    {_daily_stats_upsert_sql("ins")}
+                )
+                SELECT COUNT(*) FROM ins
+                """,
+                timeout=DB_BATCH_TIMEOUT
+            )
+
+@_timed
+async def bulk_load_retrospective_results(pool: asyncpg.pool.Pool, records: List[Tuple[Any, ...]]) -> int:
+    """Массовая загрузка ретроспектив через COPY; уже загруженные (user_id, created_at) пропускаются.
+    records: (user_id, created_at, period_days, test_count, averages, open_answers, interpretation)."""
+    async with _acquire(pool) as conn:
+        async with conn.transaction():
+            await conn.execute(
+                """
+                CREATE TEMP TABLE IF NOT EXISTS retrospective_results_stage
+                    (user_id BIGINT, created_at TIMESTAMPTZ, period_days SMALLINT, test_count INTEGER,
+                     averages JSONB, open_answers JSONB, interpretation TEXT)
+                ON COMMIT DELETE ROWS
+                """,
+                timeout=DB_BATCH_TIMEOUT
+            )
+            await conn.copy_records_to_table("retrospective_results_stage", records=records, timeout=DB_BATCH_TIMEOUT)
+            status = await conn.execute(
+                """
+                INSERT INTO retrospective_results
+                    (user_id, created_at, period_days, test_count, averages, open_answers, interpretation)
+                SELECT DISTINCT ON (s.user_id, s.created_at)
+                    s.user_id, s.created_at, s.period_days, s.test_count, s.averages, s.open_answers, s.interpretation
+                FROM retrospective_results_stage s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM retrospective_results r
+                    WHERE r.user_id = s.user_id AND r.created_at = s.created_at
+                )
+                """,
+                timeout=DB_BATCH_TIMEOUT
+            )
+    return int(status.split()[-1])
+
+@_timed
+async def save_retrospective_results(
+    pool: asyncpg.pool.Pool, user_id: int, timestamp: datetime, period_days: int, test_count: int,
+    averages: Dict[str, Any], open_answers: Dict[str, Any], interpretation: Optional[str]
+) -> None:
+    """Сохраняет результаты ретроспективы."""
+    async with _acquire(pool) as conn:
+        try:
+            await conn.execute(
+                """
+                INSERT INTO retrospective_results
+                    (user_id, created_at, period_days, test_count, averages, open_answers, interpretation)
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+                """,
+                user_id, timestamp, period_days, test_count, averages, open_answers, interpretation,
+                timeout=DB_QUERY_TIMEOUT
+            )
+            logger.info(f"Результаты ретроспективы сохранены для {user_id}")
+        except Exception as e:
+            logger.exception(f"Ошибка в save_retrospective_results для {user_id}")
+            raise
@@ -0,0 +1,96 @@
+# file_store.py
+# Запасное хранилище результатов в JSON-файлах data/ — используется, когда БД недоступна.
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from statistics import fmean
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiofiles
+
+from db import RETRO_SCALES
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR: str = "data"
+FILENAME_TIME_FORMAT: str = "%Y%m%d_%H%M%S"
+TIMESTAMP_FORMAT: str = "%Y-%m-%d %H:%M:%S"
+
+
+def test_filename(user_id: int, test_start_time: str) -> str:
+    return os.path.join(DATA_DIR, f"{user_id}_{test_start_time}.json")
+
+
+def retro_filename(user_id: int, timestamp: datetime) -> str:
+    return os.path.join(DATA_DIR, f"{user_id}_retro_{timestamp.strftime(FILENAME_TIME_FORMAT)}.json")
+
+
+async def save_test_results_file(user_id: int, test_start_time: str, test_data: Dict[str, Any]) -> str:
+    """Сохраняет тест в data/{user_id}_{время начала}.json и возвращает имя файла."""
+    filename = test_filename(user_id, test_start_time)
+    async with aiofiles.open(filename, "w", encoding="utf-8") as f:
+        await f.write(json.dumps(test_data, ensure_ascii=False, indent=4))
+    return filename
+
+
+async def save_retrospective_results_file(user_id: int, timestamp: datetime, retro_data: Dict[str, Any]) -> str:
+    filename = retro_filename(user_id, timestamp)
+    async with aiofiles.open(filename, "w", encoding="utf-8") as f:
+        await f.write(json.dumps(retro_data, ensure_ascii=False, indent=4))
+    return filename
+
+
+async def get_test_results_for_period_file(
+    user_id: int, start_date: datetime, end_date: datetime
+) -> List[Dict[str, Any]]:
+    """Читает тесты пользователя за период. Файлы вне периода и файлы ретроспектив
+    отсекаются по имени, без открытия и разбора JSON."""
+    prefix = f"{user_id}_"
+    # Время начала теста в имени файла не позже времени сохранения, поэтому берём запас в сутки
+    earliest = (start_date.replace(tzinfo=None) - timedelta(days=1)).strftime(FILENAME_TIME_FORMAT)
+    tests: List[Dict[str, Any]] = []
+    with os.scandir(DATA_DIR) as entries:
+        candidates = [
+            entry.path for entry in entries
+            if entry.name.startswith(prefix)
+            and entry.name.endswith(".json")
+            and not entry.name.startswith(f"{prefix}retro_")
+            and entry.name[len(prefix):-len(".json")] >= earliest
+        ]
+    naive_start = start_date.replace(tzinfo=None)
+    naive_end = end_date.replace(tzinfo=None)
+    for file_path in candidates:
+        try:
+            async with aiofiles.open(file_path, "r", encoding="utf-8") as f:
+                data = json.loads(await f.read())
+            ts_str: str = data.get("timestamp", "")
+            if ts_str and naive_start <= datetime.strptime(ts_str, TIMESTAMP_FORMAT) <= naive_end:
+                tests.append(data)
+        except Exception as e:
+            logger.exception(f"Ошибка чтения файла {file_path}:")
+    return tests
+
+
+def _int_or_none(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+async def get_test_averages_for_period_file(
+    user_id: int, start_date: datetime, end_date: datetime
+) -> Tuple[int, Dict[str, Optional[float]]]:
+    """Файловый аналог DailyStatsCache.averages: ответы раскладываются по столбцам
+    fixed_N, и среднее каждого столбца считается одним проходом."""
+    answers = [test.get("test_answers", {}) for test in await get_test_results_for_period_file(user_id, start_date, end_date)]
+    means: Dict[str, Optional[float]] = {}
+    for pair in RETRO_SCALES.values():
+        for key in pair:
+            column = [v for v in map(_int_or_none, (a.get(key) for a in answers)) if v is not None]
+            means[key] = fmean(column) if column else None
+    averages: Dict[str, Optional[float]] = {}
+    for scale, (a, b) in RETRO_SCALES.items():
+        averages[scale] = round((means[a] + means[b]) / 2, 2) if means[a] is not None and means[b] is not None else None
+    return len(answers), averages
@@ -0,0 +1,159 @@
+# gemini_cache.py
+# Кэш ответов Gemini для промптов, которые целиком определяются данными запроса (интерпретация теста:
+# вопросы дня, шесть оценок и два открытых ответа). Одинаковые промпты повторяются часто, особенно
+# с пустыми открытыми ответами, и каждый раньше стоил полного запроса к модели.
+# Два уровня: LRU в памяти процесса и таблица gemini_response_cache в PostgreSQL (общая для воркеров)
+# с TTL и ограничением числа строк.
+import hashlib
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import FrozenSet, Optional
+
+import asyncpg
+
+import metrics
+from db import evict_gemini_response_cache, get_cached_gemini_response, put_cached_gemini_response
+from gemini_client import GeminiClient
+
+logger = logging.getLogger(__name__)
+
+# Назначения запросов, ответы на которые можно переиспользовать (чат зависит от истории диалога — не кэшируется)
+GEMINI_CACHE_PURPOSES: FrozenSet[str] = frozenset(
+    purpose.strip() for purpose in os.getenv("GEMINI_CACHE_PURPOSES", "test").split(",") if purpose.strip()
+)
+GEMINI_CACHE_MEMORY_ENTRIES: int = int(os.getenv("GEMINI_CACHE_MEMORY_ENTRIES", "1000"))
+GEMINI_CACHE_TTL_HOURS: int = int(os.getenv("GEMINI_CACHE_TTL_HOURS", "168"))
+GEMINI_CACHE_MAX_ROWS: int = int(os.getenv("GEMINI_CACHE_MAX_ROWS", "50000"))
+# Очистка таблицы запускается после каждых столько записей в неё
+EVICT_EVERY_WRITES: int = 200
+
+HITS = {
+    tier: metrics.counter("gemini_cache_hits_total", "Ответы Gemini, взятые из кэша", {"tier": tier})
+    for tier in ("memory", "db")
+}
+MISSES = metrics.counter("gemini_cache_misses_total", "Запросы к Gemini, не найденные в кэше")
+SAVED_SECONDS = metrics.counter(
+    "gemini_cache_saved_seconds_total", "Время генерации, которое не пришлось ждать благодаря кэшу"
+)
+
+
+# Строка ответа без букв и цифр («-», «.», пустая): для ключа она равносильна отсутствию ответа
+EMPTY_ANSWER_RE = re.compile(r"^(\s*Ответ:)(?:[^\w\n]|_)*$", re.MULTILINE)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Регистр, юникодные варианты символов, пробелы и ответы без букв и цифр не влияют на ключ кэша.
+    Сам промпт, отправляемый модели, не меняется."""
+    prompt = EMPTY_ANSWER_RE.sub(r"\1 не указано", unicodedata.normalize("NFKC", prompt))
+    return " ".join(prompt.casefold().split())
+
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    generation_seconds: float
+    expires_at: float
+
+
+class GeminiResponseCache:
+    def __init__(
+        self,
+        client: GeminiClient,
+        pool: Optional[asyncpg.pool.Pool],
+        purposes: FrozenSet[str] = GEMINI_CACHE_PURPOSES,
+        memory_entries: int = GEMINI_CACHE_MEMORY_ENTRIES,
+        ttl_hours: int = GEMINI_CACHE_TTL_HOURS,
+        max_rows: int = GEMINI_CACHE_MAX_ROWS,
+    ) -> None:
+        self.client = client
+        self.pool = pool
+        self.purposes = purposes
+        self.memory_entries = memory_entries
+        self.ttl = timedelta(hours=ttl_hours)
+        self.max_rows = max_rows
+        self._memory: "OrderedDict[bytes, CachedAnswer]" = OrderedDict()
+        self._writes = 0
+
+    def key(self, prompt: str, purpose: str, max_tokens: Optional[int]) -> bytes:
+        """Ключ зависит от модели и параметров генерации: при их смене старые ответы не используются."""
+        settings = self.client.settings(purpose, max_tokens)
+        digest = hashlib.sha256(f"{self.client.model}\n{purpose}\n{settings!r}\n".encode("utf-8"))
+        digest.update(normalize_prompt(prompt).encode("utf-8"))
+        return digest.digest()
+
+    def _remember(self, key: bytes, entry: CachedAnswer) -> None:
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _hit(self, tier: str, entry: CachedAnswer, purpose: str) -> str:
+        HITS[tier].inc()
+        SAVED_SECONDS.inc(entry.generation_seconds)
+        logger.info(f"Ответ Gemini ({purpose}) взят из кэша ({tier}), сэкономлено {entry.generation_seconds:.2f} с")
+        return entry.answer
+
+    async def get(self, prompt: str, purpose: str, max_tokens: Optional[int] = None) -> Optional[str]:
+        """Сохранённый ответ на такой же промпт или None (для некэшируемых назначений — всегда None)."""
+        if purpose not in self.purposes:
+            return None
+        key = self.key(prompt, purpose, max_tokens)
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry.expires_at > time.time():
+                self._memory.move_to_end(key)
+                return self._hit("memory", entry, purpose)
+            del self._memory[key]
+        if self.pool is not None:
+            try:
+                record = await get_cached_gemini_response(self.pool, key, datetime.now(timezone.utc) - self.ttl)
+            except Exception:
+                logger.exception("Ошибка чтения кэша ответов Gemini:")
+                record = None
+            if record is not None:
+                entry = CachedAnswer(
+                    record["answer"], record["generation_seconds"],
+                    (record["created_at"] + self.ttl).timestamp(),
+                )
+                self._remember(key, entry)
+                return self._hit("db", entry, purpose)
+        MISSES.inc()
+        return None
+
+    async def put(
+        self, prompt: str, purpose: str, max_tokens: Optional[int], answer: str, generation_seconds: float
+    ) -> None:
+        """Сохраняет успешный ответ модели и время, которое на него ушло."""
+        if purpose not in self.purposes or not answer:
+            return
+        key = self.key(prompt, purpose, max_tokens)
+        self._remember(key, CachedAnswer(answer, generation_seconds, time.time() + self.ttl.total_seconds()))
+        if self.pool is None:
+            return
+        try:
+            await put_cached_gemini_response(self.pool, key, answer, generation_seconds)
+            self._writes += 1
+            if self._writes % EVICT_EVERY_WRITES == 0:
+                removed = await evict_gemini_response_cache(
+                    self.pool, datetime.now(timezone.utc) - self.ttl, self.max_rows
+                )
+                if removed:
+                    logger.info(f"Из кэша ответов Gemini удалено устаревших записей: {removed}")
+        except Exception:
+            logger.exception("Ошибка записи в кэш ответов Gemini:")
+
+    def log_summary(self) -> None:
+        hits = sum(counter.value for counter in HITS.values())
+        total = hits + MISSES.value
+        if not total:
+            return
+        logger.info(
+            f"Кэш ответов Gemini: попаданий {hits:.0f} из {total:.0f} ({hits / total:.0%}; в памяти "
+            f"{HITS['memory'].value:.0f}, в БД {HITS['db'].value:.0f}), сэкономлено {SAVED_SECONDS.value:.1f} с генерации"
+        )
@@ -0,0 +1,231 @@
+# gemini_client.py
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Any, AsyncIterator, Dict, Optional, Protocol, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+GEMINI_MODEL: str = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+# "http" — REST API через пул соединений httpx, "sdk" — асинхронный вызов google-generativeai
+GEMINI_BACKEND: str = os.getenv("GEMINI_BACKEND", "http")
+# Для бенчмарков можно указать адрес локального фейкового сервера (benchmarks/fake_gemini.py)
+GEMINI_BASE_URL: str = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com")
+GEMINI_MAX_CONNECTIONS: int = int(os.getenv("GEMINI_MAX_CONNECTIONS", "20"))
+GEMINI_SDK_WORKERS: int = int(os.getenv("GEMINI_SDK_WORKERS", "4"))
+# Грубая оценка для русского текста: один токен Gemini — около трёх символов
+CHARS_PER_TOKEN: int = 3
+
+
+@dataclass(frozen=True)
+class GenerationSettings:
+    """Параметры генерации для одного сценария использования модели."""
+    max_output_tokens: int = 600
+    temperature: float = 0.4
+    top_p: float = 1.0
+    top_k: int = 40
+    candidate_count: int = 1
+
+
+# Профили генерации по назначению запроса
+GENERATION_PROFILES: Dict[str, GenerationSettings] = {
+    "test": GenerationSettings(),
+    "retro": GenerationSettings(),
+    "chat": GenerationSettings(),
+    "retro_chat": GenerationSettings(),
+    # Краткое содержание беседы для памяти чата: короткий и предсказуемый ответ
+    "summary": GenerationSettings(max_output_tokens=300, temperature=0.2),
+}
+
+
+class GeminiBackend(Protocol):
+    """Транспорт до модели: реальный API, SDK или локальный фейковый сервер."""
+
+    def build_config(self, settings: GenerationSettings) -> Any: ...
+
+    async def generate(self, prompt: str, config: Any) -> str: ...
+
+    def stream(self, prompt: str, config: Any) -> AsyncIterator[str]: ...
+
+    async def aclose(self) -> None: ...
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка числа токенов без запроса countTokens."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def extract_text(payload: Dict[str, Any]) -> str:
+    """Достаёт текст первого кандидата из JSON-ответа generateContent."""
+    for candidate in payload.get("candidates", []):
+        parts = candidate.get("content", {}).get("parts", [])
+        text = "".join(part.get("text", "") for part in parts)
+        if text:
+            return text
+    return ""
+
+
+class HttpGeminiBackend:
+    """REST-транспорт поверх httpx.AsyncClient с пулом keep-alive соединений."""
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str = GEMINI_MODEL,
+        base_url: str = GEMINI_BASE_URL,
+        max_connections: int = GEMINI_MAX_CONNECTIONS,
+        timeout: float = 60.0,
+    ) -> None:
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"x-goog-api-key": api_key},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout, connect=10.0),
+        )
+        self._generate_path = f"/v1beta/models/{model}:generateContent"
+        self._stream_path = f"/v1beta/models/{model}:streamGenerateContent"
+
+    def build_config(self, settings: GenerationSettings) -> Dict[str, Any]:
+        return {
+            "candidateCount": settings.candidate_count,
+            "maxOutputTokens": settings.max_output_tokens,
+            "temperature": settings.temperature,
+            "topP": settings.top_p,
+            "topK": settings.top_k,
+        }
+
+    @staticmethod
+    def _body(prompt: str, config: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "generationConfig": config,
+        }
+
+    async def generate(self, prompt: str, config: Dict[str, Any]) -> str:
+        response = await self._client.post(self._generate_path, json=self._body(prompt, config))
+        response.raise_for_status()
+        return extract_text(response.json())
+
+    async def stream(self, prompt: str, config: Dict[str, Any]) -> AsyncIterator[str]:
+        """Потоковая генерация: читает server-sent events и отдаёт текст по кускам."""
+        async with self._client.stream(
+            "POST", self._stream_path, params={"alt": "sse"}, json=self._body(prompt, config)
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                text = extract_text(json.loads(line[5:]))
+                if text:
+                    yield text
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+class SdkGeminiBackend:
+    """Транспорт через google-generativeai: нативный async, с ограниченным пулом потоков как запасным путём."""
+
+    def __init__(self, api_key: str, model: str = GEMINI_MODEL, max_workers: int = GEMINI_SDK_WORKERS) -> None:
+        from google.generativeai import GenerativeModel, configure
+
+        configure(api_key=api_key)
+        self._model = GenerativeModel(model)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if not hasattr(self._model, "generate_content_async"):
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gemini")
+
+    def build_config(self, settings: GenerationSettings) -> Any:
+        from google.generativeai import types
+
+        return types.GenerationConfig(
+            candidate_count=settings.candidate_count,
+            max_output_tokens=settings.max_output_tokens,
+            temperature=settings.temperature,
+            top_p=settings.top_p,
+            top_k=settings.top_k,
+        )
+
+    async def generate(self, prompt: str, config: Any) -> str:
+        if self._executor is None:
+            response = await self._model.generate_content_async([prompt], generation_config=config)
+        else:
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(
+                self._executor, lambda: self._model.generate_content([prompt], generation_config=config)
+            )
+        return getattr(response, "text", "") or ""
+
+    async def stream(self, prompt: str, config: Any) -> AsyncIterator[str]:
+        if self._executor is not None:
+            # Без нативного async отдаём ответ одним куском
+            yield await self.generate(prompt, config)
+            return
+        response = await self._model.generate_content_async([prompt], generation_config=config, stream=True)
+        async for chunk in response:
+            text = getattr(chunk, "text", "")
+            if text:
+                yield text
+
+    async def aclose(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+class GeminiClient:
+    """Долгоживущий клиент Gemini: один транспорт и кэш конфигураций генерации на всё приложение."""
+
+    def __init__(
+        self,
+        backend: GeminiBackend,
+        profiles: Optional[Dict[str, GenerationSettings]] = None,
+        model: str = GEMINI_MODEL,
+    ) -> None:
+        self.backend = backend
+        self.model = model
+        self._profiles = profiles or GENERATION_PROFILES
+        self._configs: Dict[Tuple[str, Optional[int]], Any] = {}
+
+    def settings(self, purpose: str, max_tokens: Optional[int] = None) -> GenerationSettings:
+        """Параметры генерации для назначения запроса с учётом лимита токенов."""
+        settings = self._profiles.get(purpose, GenerationSettings())
+        if max_tokens is not None and max_tokens != settings.max_output_tokens:
+            settings = replace(settings, max_output_tokens=max_tokens)
+        return settings
+
+    def generation_config(self, purpose: str, max_tokens: Optional[int] = None) -> Any:
+        """Возвращает закэшированную конфигурацию генерации для назначения запроса."""
+        key = (purpose, max_tokens)
+        config = self._configs.get(key)
+        if config is None:
+            config = self.backend.build_config(self.settings(purpose, max_tokens))
+            self._configs[key] = config
+        return config
+
+    async def generate(self, prompt: str, purpose: str = "chat", max_tokens: Optional[int] = None) -> str:
+        return await self.backend.generate(prompt, self.generation_config(purpose, max_tokens))
+
+    def stream(self, prompt: str, purpose: str = "chat", max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        return self.backend.stream(prompt, self.generation_config(purpose, max_tokens))
+
+    async def aclose(self) -> None:
+        await self.backend.aclose()
+
+
+def create_gemini_client() -> Optional[GeminiClient]:
+    """Создаёт клиент Gemini по переменным окружения (вызывается один раз в main())."""
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        logger.error("GEMINI_API_KEY не задан в переменных окружения.")
+        return None
+    if GEMINI_BACKEND == "sdk":
+        backend: GeminiBackend = SdkGeminiBackend(api_key)
+    else:
+        backend = HttpGeminiBackend(api_key)
+    logger.info(f"Клиент Gemini создан (backend: {GEMINI_BACKEND}, модель: {GEMINI_MODEL}).")
+    return GeminiClient(backend)
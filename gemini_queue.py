@@ -0,0 +1,366 @@
+# gemini_queue.py
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import metrics
+from gemini_client import GeminiClient, estimate_tokens
+from gemini_resilience import (
+    BREAKER_REJECTED,
+    GEMINI_ATTEMPT_TIMEOUT,
+    GEMINI_HEDGE_MIN_DELAY,
+    GEMINI_HEDGING,
+    GEMINI_MAX_ATTEMPTS,
+    HEDGE_WINS,
+    HEDGES,
+    RETRIES,
+    TIMEOUTS,
+    CircuitBreaker,
+    GeminiUnavailable,
+    LatencyTracker,
+    backoff_delay,
+    is_retryable,
+)
+from ratelimit import TokenBucket, worker_share
+
+logger = logging.getLogger(__name__)
+
+GEMINI_CONCURRENCY: int = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+# Квота ключа API делится между воркерами бота
+GEMINI_RATE_PER_SEC: float = worker_share(float(os.getenv("GEMINI_RATE_PER_SEC", "10")))
+GEMINI_RATE_BURST: float = max(1.0, worker_share(float(os.getenv("GEMINI_RATE_BURST", "10"))))
+GEMINI_MAX_QUEUE: int = int(os.getenv("GEMINI_MAX_QUEUE", "500"))
+
+# Чем меньше число, тем выше приоритет: интерпретация теста важнее свободного чата
+PURPOSE_PRIORITY: Dict[str, int] = {
+    "test": 0,
+    "retro": 1,
+    "chat": 2,
+    "retro_chat": 2,
+    # Фоновая свёртка истории чата (chat_memory.py) уступает всем запросам пользователей
+    "summary": 3,
+}
+LOWEST_PRIORITY: int = max(PURPOSE_PRIORITY.values())
+
+QUEUE_DEPTH = metrics.gauge("gemini_queue_depth", "Запросы к Gemini, ожидающие в очереди")
+QUEUE_WAIT = metrics.histogram("gemini_queue_wait_seconds", "Время ожидания запроса в очереди Gemini")
+QUEUE_REJECTED = metrics.counter("gemini_queue_rejected_total", "Запросы, отклонённые из-за переполнения очереди")
+IN_FLIGHT = metrics.gauge("gemini_in_flight", "Запросы к Gemini, выполняющиеся прямо сейчас")
+REQUEST_LATENCY = {
+    purpose: metrics.histogram("gemini_request_seconds", "Полное время ответа Gemini", {"purpose": purpose})
+    for purpose in PURPOSE_PRIORITY
+}
+TIME_TO_FIRST_TOKEN = {
+    purpose: metrics.histogram("gemini_ttft_seconds", "Время до первого куска потокового ответа", {"purpose": purpose})
+    for purpose in PURPOSE_PRIORITY
+}
+
+
+class GeminiQueueFull(Exception):
+    """Очередь запросов к Gemini переполнена — клиенту нужно повторить позже."""
+
+
+@dataclass
+class GeminiRequest:
+    user_id: int
+    prompt: str
+    purpose: str
+    max_tokens: Optional[int]
+    # Если задан — запрос выполняется потоково, и каждый кусок текста передаётся в колбэк
+    on_chunk: Optional[Callable[[str], None]] = None
+    # Сколько кусков уже показано пользователю: после первого потоковый запрос не повторяется
+    chunks_delivered: int = 0
+    # Неудачные попытки; повтор ставится обратно в очередь после задержки, не занимая воркер
+    attempt: int = 0
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # Начало первой попытки: от него считаются полное время ответа и время до первого куска
+    started: Optional[float] = None
+    # Метка CircuitBreaker.allow() для текущей попытки, с ней исход попытки передаётся в record()
+    breaker_token: int = 0
+    future: "asyncio.Future[str]" = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+
+class GeminiRequestScheduler:
+    """Очередь запросов к Gemini: общий лимит параллельности, token bucket,
+    приоритеты по назначению и честная очередь по пользователям (round-robin)."""
+
+    def __init__(
+        self,
+        client: GeminiClient,
+        concurrency: int = GEMINI_CONCURRENCY,
+        rate_per_sec: float = GEMINI_RATE_PER_SEC,
+        burst: float = GEMINI_RATE_BURST,
+        max_queue: int = GEMINI_MAX_QUEUE,
+        attempt_timeout: float = GEMINI_ATTEMPT_TIMEOUT,
+        max_attempts: int = GEMINI_MAX_ATTEMPTS,
+        hedging: bool = GEMINI_HEDGING,
+        breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        self.client = client
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.hedging = hedging
+        self.breaker = breaker or CircuitBreaker()
+        self._latency: Dict[str, LatencyTracker] = {}
+        self._bucket = TokenBucket(rate_per_sec, burst)
+        # Для каждого приоритета: user_id -> очередь его запросов; порядок ключей задаёт round-robin
+        self._queues: List["OrderedDict[int, Deque[GeminiRequest]]"] = [
+            OrderedDict() for _ in range(LOWEST_PRIORITY + 1)
+        ]
+        self._size = 0
+        self._available = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+        # Запросы, ждущие повтора: id(запроса) -> (таймер возврата в очередь, запрос)
+        self._delayed: Dict[int, Tuple[asyncio.TimerHandle, GeminiRequest]] = {}
+
+    @property
+    def depth(self) -> int:
+        return self._size
+
+    def start(self) -> None:
+        for i in range(self.concurrency):
+            self._workers.append(asyncio.create_task(self._worker(), name=f"gemini-worker-{i}"))
+        logger.info(f"Очередь Gemini запущена: {self.concurrency} воркеров, {self._bucket.rate} запросов/с.")
+
+    async def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        for handle, request in self._delayed.values():
+            handle.cancel()
+            if not request.future.done():
+                request.future.cancel()
+        self._delayed.clear()
+        for queues in self._queues:
+            for user_queue in queues.values():
+                for request in user_queue:
+                    if not request.future.done():
+                        request.future.cancel()
+            queues.clear()
+        self._size = 0
+        QUEUE_DEPTH.set(0)
+
+    def submit(
+        self,
+        user_id: int,
+        prompt: str,
+        purpose: str = "chat",
+        max_tokens: Optional[int] = None,
+        on_chunk: Optional[Callable[[str], None]] = None,
+    ) -> "asyncio.Future[str]":
+        """Ставит запрос в очередь и возвращает future с полным текстом ответа."""
+        if self.breaker.is_open:
+            BREAKER_REJECTED.inc()
+            raise GeminiUnavailable()
+        if self._size >= self.max_queue:
+            QUEUE_REJECTED.inc()
+            raise GeminiQueueFull()
+        request = GeminiRequest(user_id, prompt, purpose, max_tokens, on_chunk)
+        self._push(request)
+        return request.future
+
+    def _push(self, request: GeminiRequest, front: bool = False) -> None:
+        queues = self._queues[PURPOSE_PRIORITY.get(request.purpose, LOWEST_PRIORITY)]
+        user_queue = queues.get(request.user_id)
+        if user_queue is None:
+            user_queue = queues[request.user_id] = deque()
+        if front:
+            user_queue.appendleft(request)
+        else:
+            user_queue.append(request)
+        self._size += 1
+        QUEUE_DEPTH.set(self._size)
+        self._available.set()
+
+    def _retry_later(self, delay: float, request: GeminiRequest) -> None:
+        handle = asyncio.get_running_loop().call_later(delay, self._requeue, request)
+        self._delayed[id(request)] = (handle, request)
+
+    def _requeue(self, request: GeminiRequest) -> None:
+        """Повтор встаёт первым в очередь пользователя: его запросы по-прежнему выполняются по порядку."""
+        self._delayed.pop(id(request), None)
+        if not request.future.done():
+            self._push(request, front=True)
+
+    def _next_request(self) -> Optional[GeminiRequest]:
+        for queues in self._queues:
+            while queues:
+                user_id, user_queue = queues.popitem(last=False)
+                request = user_queue.popleft()
+                if user_queue:
+                    # Остальные запросы пользователя — в конец круга, после других пользователей
+                    queues[user_id] = user_queue
+                self._size -= 1
+                QUEUE_DEPTH.set(self._size)
+                if request.future.cancelled():
+                    continue
+                return request
+        return None
+
+    async def _admit(self) -> Optional[int]:
+        """Метка breaker для попытки или None, если отправлять нельзя. Пока выполняется пробный запрос
+        разомкнутого breaker, воркер ждёт его исхода: в это время к Gemini всё равно ничего,
+        кроме пробного, не уходит."""
+        while True:
+            token = self.breaker.allow()
+            if token is not None:
+                return token
+            if self.breaker.is_open:
+                return None
+            await self.breaker.wait_probe()
+
+    async def _worker(self) -> None:
+        while True:
+            request = self._next_request()
+            if request is None:
+                self._available.clear()
+                await self._available.wait()
+                continue
+            token = await self._admit()
+            if token is None:
+                # Пока запрос ждал в очереди, breaker разомкнулся (или пробный запрос не удался)
+                BREAKER_REJECTED.inc()
+                if not request.future.done():
+                    request.future.set_exception(GeminiUnavailable())
+                continue
+            if request.future.cancelled():
+                continue
+            request.breaker_token = token
+            await self._bucket.acquire()
+            if request.started is None:
+                request.started = time.monotonic()
+                QUEUE_WAIT.observe(request.started - request.enqueued_at)
+            IN_FLIGHT.inc()
+            try:
+                result = await self._execute(request)
+                latency = time.monotonic() - request.started
+                histogram = REQUEST_LATENCY.get(request.purpose)
+                if histogram is not None:
+                    histogram.observe(latency)
+                logger.info(
+                    f"Ответ Gemini ({request.purpose}) для {request.user_id} получен за {latency:.2f} с",
+                    extra={
+                        "user_id": request.user_id,
+                        "purpose": request.purpose,
+                        "latency_s": round(latency, 3),
+                        "queue_wait_s": round(request.started - request.enqueued_at, 3),
+                        "prompt_tokens_est": estimate_tokens(request.prompt),
+                        "answer_tokens_est": estimate_tokens(result),
+                        "streaming": request.on_chunk is not None,
+                    },
+                )
+            except asyncio.CancelledError:
+                if not request.future.done():
+                    request.future.cancel()
+                raise
+            except Exception as e:
+                delay = self._retry_delay(request, e)
+                if delay is not None:
+                    self._retry_later(delay, request)
+                elif not request.future.done():
+                    request.future.set_exception(e)
+            else:
+                if not request.future.done():
+                    request.future.set_result(result)
+            finally:
+                IN_FLIGHT.dec()
+
+    async def _execute(self, request: GeminiRequest) -> str:
+        """Одна попытка запроса с дедлайном (непотоковая — с хеджированием)."""
+        if request.on_chunk is None:
+            result = await self._generate_hedged(request)
+        else:
+            result = await asyncio.wait_for(self._run_streaming(request), self.attempt_timeout)
+        self.breaker.record(True, request.breaker_token)
+        return result
+
+    def _retry_delay(self, request: GeminiRequest, error: Exception) -> Optional[float]:
+        """Через сколько секунд повторить неудавшуюся попытку; None — ошибка уходит вызывающему."""
+        if isinstance(error, asyncio.TimeoutError):
+            TIMEOUTS.inc()
+        retryable = is_retryable(error)
+        # Ошибки самого запроса (400, неверный ключ) о здоровье Gemini не говорят
+        if retryable:
+            self.breaker.record(False, request.breaker_token)
+        request.attempt += 1
+        if (
+            request.attempt >= self.max_attempts
+            or not retryable
+            or request.chunks_delivered
+            or request.future.cancelled()
+            # allow() здесь не подходит: он занял бы место пробного запроса
+            or self.breaker.is_open
+        ):
+            return None
+        delay = backoff_delay(request.attempt - 1)
+        RETRIES.inc()
+        logger.warning(
+            f"Запрос Gemini ({request.purpose}) для {request.user_id} не удался ({error!r}), "
+            f"попытка {request.attempt + 1} из {self.max_attempts} через {delay:.2f} с"
+        )
+        return delay
+
+    async def _attempt(self, request: GeminiRequest) -> str:
+        started = time.monotonic()
+        result = await asyncio.wait_for(
+            self.client.generate(request.prompt, purpose=request.purpose, max_tokens=request.max_tokens),
+            self.attempt_timeout,
+        )
+        tracker = self._latency.get(request.purpose)
+        if tracker is None:
+            tracker = self._latency[request.purpose] = LatencyTracker()
+        tracker.observe(time.monotonic() - started)
+        return result
+
+    async def _generate_hedged(self, request: GeminiRequest) -> str:
+        """Если ответа нет дольше p95, отправляет дубль и берёт первый успешный ответ.
+        Дубль уходит, только если есть свободный токен квоты."""
+        tracker = self._latency.get(request.purpose)
+        p95 = tracker.quantile(0.95) if tracker is not None and self.hedging else None
+        if p95 is None:
+            return await self._attempt(request)
+        primary = asyncio.ensure_future(self._attempt(request))
+        hedge: Optional["asyncio.Future[str]"] = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=max(GEMINI_HEDGE_MIN_DELAY, p95))
+            if done or self._bucket.try_acquire() > 0:
+                return await primary
+            HEDGES.inc()
+            hedge = asyncio.ensure_future(self._attempt(request))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            HEDGE_WINS.inc()
+                        return task.result()
+            raise primary.exception()
+        finally:
+            primary.cancel()
+            if hedge is not None:
+                hedge.cancel()
+
+    async def _run_streaming(self, request: GeminiRequest) -> str:
+        parts: List[str] = []
+        async for chunk in self.client.stream(request.prompt, purpose=request.purpose, max_tokens=request.max_tokens):
+            if not parts:
+                ttft = time.monotonic() - request.started
+                histogram = TIME_TO_FIRST_TOKEN.get(request.purpose)
+                if histogram is not None:
+                    histogram.observe(ttft)
+                logger.info(
+                    f"Первый кусок ответа Gemini ({request.purpose}) для {request.user_id} за {ttft:.2f} с",
+                    extra={"user_id": request.user_id, "purpose": request.purpose, "ttft_s": round(ttft, 3)},
+                )
+            parts.append(chunk)
+            request.chunks_delivered += 1
+            request.on_chunk(chunk)
+        return "".join(parts)
@@ -0,0 +1,192 @@
+# gemini_resilience.py
+# Защита бота от замедлений и сбоев Gemini. У каждой попытки есть дедлайн; временные ошибки
+# (таймауты, обрывы соединения, 429/5xx) повторяются с экспоненциальной задержкой; медленный запрос
+# может продублироваться («хеджирование»), если ответа нет дольше p95; circuit breaker при всплеске
+# ошибок сразу отвечает пользователю отказом, не занимая очередь и квоту.
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Дедлайн одной попытки (для потокового ответа — на весь поток)
+GEMINI_ATTEMPT_TIMEOUT: float = float(os.getenv("GEMINI_ATTEMPT_TIMEOUT", "30"))
+GEMINI_MAX_ATTEMPTS: int = int(os.getenv("GEMINI_MAX_ATTEMPTS", "3"))
+GEMINI_RETRY_BASE_DELAY: float = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5"))
+GEMINI_RETRY_MAX_DELAY: float = 8.0
+# Хеджирование непотоковых запросов: дубль уходит, если ответа нет дольше p95 недавних запросов
+# того же назначения (но не раньше GEMINI_HEDGE_MIN_DELAY секунд)
+GEMINI_HEDGING: bool = os.getenv("GEMINI_HEDGING", "0") == "1"
+GEMINI_HEDGE_MIN_DELAY: float = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "1.0"))
+# Circuit breaker: доля ошибок за окно, при которой запросы перестают отправляться, и пауза до пробного запроса
+GEMINI_BREAKER_ERROR_RATE: float = float(os.getenv("GEMINI_BREAKER_ERROR_RATE", "0.5"))
+GEMINI_BREAKER_MIN_CALLS: int = int(os.getenv("GEMINI_BREAKER_MIN_CALLS", "10"))
+GEMINI_BREAKER_WINDOW: float = float(os.getenv("GEMINI_BREAKER_WINDOW", "30"))
+GEMINI_BREAKER_COOLDOWN: float = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+
+BREAKER_STATE = metrics.gauge("gemini_breaker_open", "1 — circuit breaker Gemini разомкнут, запросы не отправляются")
+BREAKER_REJECTED = metrics.counter("gemini_breaker_rejected_total", "Запросы, отклонённые разомкнутым circuit breaker")
+RETRIES = metrics.counter("gemini_retries_total", "Повторные попытки запросов к Gemini")
+TIMEOUTS = metrics.counter("gemini_timeouts_total", "Попытки, не уложившиеся в GEMINI_ATTEMPT_TIMEOUT")
+HEDGES = metrics.counter("gemini_hedges_total", "Дублирующие запросы к Gemini после порога p95")
+HEDGE_WINS = metrics.counter("gemini_hedge_wins_total", "Дублирующие запросы, ответившие раньше основного")
+
+
+class GeminiUnavailable(Exception):
+    """Circuit breaker разомкнут: Gemini сейчас отвечает ошибками, запрос не отправляется."""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Временная ошибка, которую имеет смысл повторить."""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS
+    # Исключения google-generativeai (google.api_core.exceptions) хранят HTTP-статус в code
+    code = getattr(error, "code", None)
+    return isinstance(code, int) and code in RETRYABLE_STATUS
+
+
+def backoff_delay(attempt: int, base: float = GEMINI_RETRY_BASE_DELAY, cap: float = GEMINI_RETRY_MAX_DELAY) -> float:
+    """Экспоненциальная задержка с полным джиттером: повторы разных пользователей не приходят волной."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LatencyTracker:
+    """Скользящее окно последних задержек для оценки квантилей."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20) -> None:
+        self._samples: Deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class CircuitBreaker:
+    """Размыкается, когда доля ошибок за окно превышает порог; через cooldown пропускает
+    один пробный запрос и по его исходу замыкается или снова размыкается. Остальные запросы
+    на это время ждут исхода пробного (wait_probe), а не получают отказ.
+    allow() выдаёт запросу метку, которую вызывающий возвращает в record(): пробный запрос
+    получает свой номер, и пока breaker разомкнут, учитывается исход только запроса с этим номером."""
+
+    def __init__(
+        self,
+        error_rate: float = GEMINI_BREAKER_ERROR_RATE,
+        min_calls: int = GEMINI_BREAKER_MIN_CALLS,
+        window: float = GEMINI_BREAKER_WINDOW,
+        cooldown: float = GEMINI_BREAKER_COOLDOWN,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self._clock = clock
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_at: Optional[float] = None
+        # Номер текущего пробного запроса; 0 — метка обычного запроса при замкнутом breaker
+        self._probe = 0
+        self._probes = 0
+        self._probe_done: Optional[asyncio.Event] = None
+
+    @property
+    def is_open(self) -> bool:
+        """Разомкнут и пауза ещё не прошла — новые запросы даже не стоит ставить в очередь."""
+        return self._opened_at is not None and self._clock() - self._opened_at < self.cooldown
+
+    def allow(self) -> Optional[int]:
+        """Метка для record(), если запрос можно отправить прямо сейчас, иначе None. После паузы
+        пропускает по одному пробному запросу (следующий — если пробный не завершился за cooldown,
+        например был отменён)."""
+        if self._opened_at is None:
+            return 0
+        now = self._clock()
+        if now - self._opened_at < self.cooldown:
+            return None
+        if self._probe_at is not None and now - self._probe_at < self.cooldown:
+            return None
+        self._probe_at = now
+        self._probes += 1
+        self._probe = self._probes
+        self._probe_done = asyncio.Event()
+        return self._probe
+
+    async def wait_probe(self) -> None:
+        """Ждёт исхода пробного запроса. Не дольше, чем до момента, когда allow() пропустит
+        следующий пробный (если этот был отменён или завершился ошибкой самого запроса)."""
+        if self._probe_at is None or self._probe_done is None:
+            return
+        remaining = self.cooldown - (self._clock() - self._probe_at)
+        if remaining <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._probe_done.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+    def record(self, ok: bool, token: int = 0) -> None:
+        """Исход запроса; token — метка, выданная ему allow()."""
+        now = self._clock()
+        if self._opened_at is not None:
+            # Учитываем только исход текущего пробного запроса; запоздавшие ответы запросов, начатых
+            # до размыкания, и прежних пробных не в счёт
+            if not token or token != self._probe:
+                return
+            if ok:
+                self._close()
+            else:
+                self._open(now)
+            return
+        self._outcomes.append((now, ok))
+        if not ok:
+            self._failures += 1
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            _, old_ok = self._outcomes.popleft()
+            if not old_ok:
+                self._failures -= 1
+        if len(self._outcomes) >= self.min_calls and self._failures / len(self._outcomes) >= self.error_rate:
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        if self._opened_at is None:
+            logger.warning(
+                f"Circuit breaker Gemini разомкнут: ошибок {self._failures} из {len(self._outcomes)} "
+                f"за {self.window:.0f} с, пауза {self.cooldown:.0f} с"
+            )
+        self._opened_at = now
+        self._settle_probe()
+        self._outcomes.clear()
+        self._failures = 0
+        BREAKER_STATE.set(1)
+
+    def _close(self) -> None:
+        logger.info("Circuit breaker Gemini замкнут: пробный запрос успешен")
+        self._opened_at = None
+        self._settle_probe()
+        BREAKER_STATE.set(0)
+
+    def _settle_probe(self) -> None:
+        self._probe_at = None
+        self._probe = 0
+        if self._probe_done is not None:
+            self._probe_done.set()
+            self._probe_done = None
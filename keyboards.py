@@ -0,0 +1,50 @@
+# keyboards.py
+# Готовые клавиатуры и тексты меню. Клавиатуры PTB неизменяемы, поэтому одни и те же объекты
+# используются во всех ответах, а их to_dict() считается один раз при импорте: при каждой отправке
+# PTB больше не создаёт заново кнопки и не обходит их дерево атрибутов.
+from typing import Any, Dict, List, Sequence
+
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove
+
+
+class CachedReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    """ReplyKeyboardMarkup, сериализованный один раз. Возвращаемый to_dict() словарь общий — не изменять."""
+
+    __slots__ = ("_cached_dict",)
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        with self._unfrozen():
+            self._cached_dict: Dict[str, Any] = super().to_dict()
+
+    def to_dict(self, recursive: bool = True) -> Dict[str, Any]:
+        if recursive:
+            return self._cached_dict
+        return super().to_dict(recursive=recursive)
+
+
+def menu_keyboard(rows: Sequence[Sequence[str]]) -> CachedReplyKeyboardMarkup:
+    """Клавиатура в стиле бота: подгоняется по размеру и скрывается после нажатия."""
+    keyboard: List[List[str]] = [list(row) for row in rows]
+    return CachedReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+
+
+MAIN_MENU_KEYBOARD = menu_keyboard([["Тест", "Ретроспектива"], ["Напоминание", "Помощь"]])
+BACK_TO_MENU_KEYBOARD = menu_keyboard([["Главное меню"]])
+# Оценка вопроса дня от 1 до 7
+SCORE_KEYBOARD = menu_keyboard([[str(i) for i in range(1, 8)], ["Главное меню"]])
+RETRO_CHOICE_KEYBOARD = menu_keyboard([["Ретроспектива сейчас", "Запланировать ретроспективу", "Главное меню"]])
+RETRO_PERIOD_KEYBOARD = menu_keyboard([["Ретроспектива за 1 неделю", "Ретроспектива за 2 недели"], ["Главное меню"]])
+WEEKDAY_KEYBOARD = menu_keyboard(
+    [["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье", "Главное меню"]]
+)
+RETRO_MODE_KEYBOARD = menu_keyboard([["Еженедельная", "Двухнедельная", "Главное меню"]])
+# После планирования ретроспективы и в уведомлении о ней
+RETRO_SCHEDULED_KEYBOARD = menu_keyboard([["Пройти ретроспективу", "Главное меню"]])
+REMINDER_CHOICE_KEYBOARD = menu_keyboard([["Ежедневный тест", "Ретроспектива"], ["Главное меню"]])
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+MAIN_MENU_TEXT = "Добро пожаловать! Выберите действие:"
+RETURN_TO_MAIN_TEXT = "Возвращаемся в главное меню.\n\n" + MAIN_MENU_TEXT
+CHOOSE_OPTION_TEXT = "Пожалуйста, выберите один из предложенных вариантов."
+INVALID_TIME_TEXT = "Неверный формат времени. Пожалуйста, введите время в формате ЧЧ:ММ."
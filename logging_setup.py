@@ -0,0 +1,126 @@
+# logging_setup.py
+# Логирование без ввода-вывода в event loop: обработчики пишут запись в очередь (QueueHandler),
+# а форматирование в JSON и запись в файл или stderr выполняет отдельный поток (QueueListener).
+# Поля, переданные через extra= (user_id, purpose, latency_s, токены), становятся ключами JSON —
+# по ним удобно считать агрегаты без разбора текста сообщений.
+# Тексты промптов и ответов содержат ответы пользователей, поэтому по умолчанию в лог попадают только
+# их длина и хэш; полный текст — для доли вызовов (LOG_PAYLOADS=sample) или всегда (full, для отладки).
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO").upper()
+# json — одна запись JSON в строке, text — прежний человекочитаемый формат
+LOG_FORMAT: str = os.getenv("LOG_FORMAT", "json")
+# Пусто — stderr; иначе файл с ротацией, например logs/bot.log
+LOG_FILE: str = os.getenv("LOG_FILE", "")
+LOG_FILE_MAX_MB: int = int(os.getenv("LOG_FILE_MAX_MB", "50"))
+LOG_FILE_BACKUPS: int = int(os.getenv("LOG_FILE_BACKUPS", "5"))
+# redact — только длина и хэш текста, sample — полный текст для доли вызовов, full — всегда
+LOG_PAYLOADS: str = os.getenv("LOG_PAYLOADS", "redact")
+LOG_PAYLOAD_SAMPLE_RATE: float = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+LOG_PAYLOAD_MAX_CHARS: int = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+
+_TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Атрибуты, которые есть у любой LogRecord; всё остальное пришло из extra=
+_STANDARD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+_TRACEBACK_FORMATTER = logging.Formatter()
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _extra_fields(record: logging.LogRecord) -> Dict[str, Any]:
+    return {key: value for key, value in vars(record).items() if key not in _STANDARD_ATTRS}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(_extra_fields(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний формат; поля из extra= дописываются в конец строки."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += " " + json.dumps(fields, ensure_ascii=False, default=str)
+        return line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """В потоке event loop — только подстановка аргументов и текст исключения (пока оно ещё доступно);
+    запись не копируется и не форматируется, как в стандартном QueueHandler.prepare()."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _TRACEBACK_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def sample_payload() -> bool:
+    """Решение о полном тексте принимается один раз на вызов, чтобы промпт и ответ логировались вместе."""
+    if LOG_PAYLOADS == "full":
+        return True
+    return LOG_PAYLOADS == "sample" and random.random() < LOG_PAYLOAD_SAMPLE_RATE
+
+
+def payload_fields(text: str, sampled: bool = False) -> Dict[str, Any]:
+    """Описание текста промпта или ответа для extra=: длина и хэш, текст — только для выбранных вызовов."""
+    fields: Dict[str, Any] = {
+        "chars": len(text),
+        "sha256": hashlib.sha256(text.encode("utf-8")).hexdigest()[:16],
+    }
+    if sampled:
+        fields["text"] = text[:LOG_PAYLOAD_MAX_CHARS]
+    return fields
+
+
+def setup_logging() -> None:
+    """Вызывается один раз при старте процесса (bot.py, router.py)."""
+    global _listener
+    if _listener is not None:
+        return
+    if LOG_FILE:
+        os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+        handler: logging.Handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_FILE_MAX_MB * 1024 * 1024, backupCount=LOG_FILE_BACKUPS, encoding="utf-8"
+        )
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(_TEXT_FORMAT))
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [_QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет каждый запрос на INFO, а в адресе Bot API есть токен бота
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    # Дописываем очередь до конца при выходе из процесса
+    atexit.register(_listener.stop)
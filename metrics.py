@@ -0,0 +1,230 @@
+# metrics.py
+# Счётчики, gauge и гистограммы процесса и их выдача в текстовом формате Prometheus на /metrics.
+# Метрики обновляются только из event loop, поэтому без блокировок; объекты метрик создаются один раз
+# при импорте модулей, и горячий путь сводится к сложению чисел без поиска по меткам.
+import asyncio
+import functools
+import logging
+import os
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar, Union
+
+logger = logging.getLogger(__name__)
+
+# Порт локального HTTP-эндпоинта /metrics; 0 — выключен. У каждого воркера бота должен быть свой порт
+METRICS_PORT: int = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN: str = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+# Границы корзин гистограмм задержек по умолчанию (секунды)
+DEFAULT_LATENCY_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    """Монотонный счётчик. Обновляется только из event loop, поэтому без блокировок."""
+    __slots__ = ("name", "help", "labels", "value")
+
+    def __init__(self, name: str, help: str, labels: LabelsKey = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class Gauge:
+    """Текущее значение (глубина очереди, занятые соединения и т.п.)."""
+    __slots__ = ("name", "help", "labels", "value")
+
+    def __init__(self, name: str, help: str, labels: LabelsKey = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: observe() не выделяет память."""
+    __slots__ = ("name", "help", "labels", "buckets", "counts", "sum", "count")
+
+    def __init__(
+        self, name: str, help: str, labels: LabelsKey = (), buckets: Iterable[float] = DEFAULT_LATENCY_BUCKETS
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # Последняя ячейка — корзина +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+# Реестр всех метрик процесса: (имя, метки) -> метрика
+REGISTRY: Dict[Tuple[str, LabelsKey], Metric] = {}
+
+
+def _labels_key(labels: Optional[Dict[str, str]]) -> LabelsKey:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def counter(name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+    key = (name, _labels_key(labels))
+    metric = REGISTRY.get(key)
+    if metric is None:
+        metric = REGISTRY[key] = Counter(name, help, key[1])
+    return metric  # type: ignore[return-value]
+
+
+def gauge(name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Gauge:
+    key = (name, _labels_key(labels))
+    metric = REGISTRY.get(key)
+    if metric is None:
+        metric = REGISTRY[key] = Gauge(name, help, key[1])
+    return metric  # type: ignore[return-value]
+
+
+def histogram(
+    name: str,
+    help: str,
+    labels: Optional[Dict[str, str]] = None,
+    buckets: Iterable[float] = DEFAULT_LATENCY_BUCKETS,
+) -> Histogram:
+    key = (name, _labels_key(labels))
+    metric = REGISTRY.get(key)
+    if metric is None:
+        metric = REGISTRY[key] = Histogram(name, help, key[1], buckets)
+    return metric  # type: ignore[return-value]
+
+
+# Функции, обновляющие gauge непосредственно перед выдачей (размер пула БД и т.п.)
+COLLECTORS: List[Callable[[], None]] = []
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+
+def add_collector(collect: Callable[[], None]) -> None:
+    COLLECTORS.append(collect)
+
+
+def instrument(func: F, seconds: Histogram, errors: Counter) -> F:
+    """Оборачивает корутинную функцию: время выполнения — в seconds, исключения — в errors."""
+    perf_counter = time.perf_counter
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        started = perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            seconds.observe(perf_counter() - started)
+
+    return wrapper  # type: ignore[return-value]
+
+
+_INF_LABEL = 'le="+Inf"'
+
+
+def _format_labels(labels: LabelsKey, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus 0.0.4."""
+    for collect in COLLECTORS:
+        try:
+            collect()
+        except Exception:
+            logger.exception("Ошибка сборщика метрик:")
+    by_name: Dict[str, List[Metric]] = {}
+    for metric in REGISTRY.values():
+        by_name.setdefault(metric.name, []).append(metric)
+    lines: List[str] = []
+    for name, family in by_name.items():
+        first = family[0]
+        kind = "counter" if isinstance(first, Counter) else "gauge" if isinstance(first, Gauge) else "histogram"
+        lines.append(f"# HELP {name} {first.help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for metric in family:
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                for bound, count in zip(metric.buckets, metric.counts):
+                    cumulative += count
+                    le = _format_labels(metric.labels, f'le="{bound}"')
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(metric.labels, _INF_LABEL)} {metric.count}")
+                lines.append(f"{name}_sum{_format_labels(metric.labels)} {_format_value(metric.sum)}")
+                lines.append(f"{name}_count{_format_labels(metric.labels)} {metric.count}")
+            else:
+                lines.append(f"{name}{_format_labels(metric.labels)} {_format_value(metric.value)}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Заголовки запроса не нужны, но их надо дочитать
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_http_server(host: str = METRICS_LISTEN, port: int = METRICS_PORT) -> Optional[asyncio.AbstractServer]:
+    """Поднимает /metrics в текущем event loop. Занятый порт не мешает работе бота."""
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(_serve_metrics, host, port)
+    except OSError as e:
+        logger.warning(f"Не удалось открыть /metrics на {host}:{port}: {e}")
+        return None
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,207 @@
+# migrate_data.py
+"""Одноразовый перенос архива data/*.json в PostgreSQL.
+
+Запуск: DATABASE_URL=... python migrate_data.py [--data-dir data] [--batch-size 5000] [--workers 4]
+
+Файлы data/{user_id}_{время}.json попадают в test_results, data/{user_id}_retro_{время}.json —
+в retrospective_results. Разбор JSON идёт в пуле процессов, загрузка — пачками через COPY.
+Уже загруженные файлы записываются в файл контрольной точки, поэтому прерванный перенос
+можно просто запустить снова; повторная загрузка тех же строк ничего не дублирует.
+Файлы, которые не удалось разобрать, в контрольную точку не попадают: они перечисляются в конце
+и разбираются заново при следующем запуске.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Iterator, List, Set, Tuple
+
+from db import bulk_load_retrospective_results, bulk_load_test_results, create_db_pool
+
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+logger = logging.getLogger("migrate_data")
+
+TIMESTAMP_FORMAT: str = "%Y-%m-%d %H:%M:%S"
+FILENAME_TIME_FORMAT: str = "%Y%m%d_%H%M%S"
+PARSE_CHUNK_SIZE: int = 500
+# Сколько неразобранных файлов перечислить в итоговом отчёте
+FAILED_REPORT_LIMIT: int = 20
+
+# (строки test_results, строки retrospective_results, разобранные файлы, [(файл, ошибка)])
+ParsedChunk = Tuple[List[Tuple[Any, ...]], List[Tuple[Any, ...]], List[str], List[Tuple[str, str]]]
+
+
+def _created_at(data: dict, name_time: str) -> datetime:
+    ts_str = data.get("timestamp", "")
+    if ts_str:
+        created = datetime.strptime(ts_str, TIMESTAMP_FORMAT)
+    else:
+        created = datetime.strptime(name_time, FILENAME_TIME_FORMAT)
+    # В архиве записано локальное время сервера, на котором работал бот
+    return created.astimezone()
+
+
+def parse_files(data_dir: str, names: List[str]) -> ParsedChunk:
+    """Разбирает пачку файлов (выполняется в дочернем процессе)."""
+    tests: List[Tuple[Any, ...]] = []
+    retros: List[Tuple[Any, ...]] = []
+    parsed: List[str] = []
+    failed: List[Tuple[str, str]] = []
+    for name in names:
+        user_part, _, rest = name[: -len(".json")].partition("_")
+        try:
+            user_id = int(user_part)
+            with open(os.path.join(data_dir, name), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if rest.startswith("retro_"):
+                retros.append((
+                    user_id,
+                    _created_at(data, rest[len("retro_"):]),
+                    int(data.get("period_days", 7)),
+                    int(data.get("test_count", 0)),
+                    data.get("averages", {}),
+                    data.get("open_answers", {}),
+                    data.get("interpretation"),
+                ))
+            else:
+                tests.append((user_id, _created_at(data, rest), data.get("test_answers", {}), None))
+        except Exception as e:
+            failed.append((name, repr(e)))
+        else:
+            parsed.append(name)
+    return tests, retros, parsed, failed
+
+
+def scan_archive(data_dir: str, done: Set[str]) -> Iterator[str]:
+    """Потоково перечисляет файлы архива, пропуская уже перенесённые."""
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.endswith(".json") and name.split("_", 1)[0].isdigit() and name not in done:
+                yield name
+
+
+def chunked(names: Iterator[str], size: int) -> Iterator[List[str]]:
+    chunk: List[str] = []
+    for name in names:
+        chunk.append(name)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_checkpoint(path: str) -> Set[str]:
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r", encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+class Migration:
+    def __init__(self, pool, checkpoint_path: str, batch_size: int) -> None:
+        self.pool = pool
+        self.batch_size = batch_size
+        self._checkpoint = open(checkpoint_path, "a", encoding="utf-8")
+        self._tests: List[Tuple[Any, ...]] = []
+        self._retros: List[Tuple[Any, ...]] = []
+        self._names: List[str] = []
+        self.files = 0
+        self.failed: List[Tuple[str, str]] = []
+        self.inserted = 0
+        self.started = time.monotonic()
+
+    async def add(self, parsed: ParsedChunk) -> None:
+        tests, retros, names, failed = parsed
+        self._tests.extend(tests)
+        self._retros.extend(retros)
+        self._names.extend(names)
+        self.failed.extend(failed)
+        if len(self._tests) + len(self._retros) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._names:
+            return
+        if self._tests:
+            self.inserted += await bulk_load_test_results(self.pool, self._tests)
+        if self._retros:
+            self.inserted += await bulk_load_retrospective_results(self.pool, self._retros)
+        # Контрольная точка пишется только после успешной загрузки пачки
+        self._checkpoint.write("\n".join(self._names) + "\n")
+        self._checkpoint.flush()
+        os.fsync(self._checkpoint.fileno())
+        self.files += len(self._names)
+        elapsed = time.monotonic() - self.started
+        logger.info(
+            f"Перенесено файлов: {self.files} ({self.files / elapsed:.0f} файлов/с), "
+            f"новых строк: {self.inserted}, ошибок разбора: {len(self.failed)}"
+        )
+        self._tests, self._retros, self._names = [], [], []
+
+    def close(self) -> None:
+        self._checkpoint.close()
+
+    def report_failed(self) -> None:
+        if not self.failed:
+            return
+        lines = [f"  {name}: {error}" for name, error in self.failed[:FAILED_REPORT_LIMIT]]
+        if len(self.failed) > FAILED_REPORT_LIMIT:
+            lines.append(f"  … и ещё {len(self.failed) - FAILED_REPORT_LIMIT}")
+        logger.warning(
+            f"Не удалось разобрать файлов: {len(self.failed)}. Они не записаны в контрольную точку "
+            "и будут разобраны заново при следующем запуске:\n" + "\n".join(lines)
+        )
+
+
+async def migrate(data_dir: str, checkpoint_path: str, batch_size: int, workers: int) -> None:
+    pool = await create_db_pool()
+    if pool is None:
+        logger.error("Не удалось подключиться к БД, перенос невозможен.")
+        return
+    done = load_checkpoint(checkpoint_path)
+    if done:
+        logger.info(f"Продолжаем с контрольной точки: {len(done)} файлов уже перенесено.")
+    migration = Migration(pool, checkpoint_path, batch_size)
+    loop = asyncio.get_running_loop()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending: Set[asyncio.Future] = set()
+            for chunk in chunked(scan_archive(data_dir, done), PARSE_CHUNK_SIZE):
+                pending.add(loop.run_in_executor(executor, parse_files, data_dir, chunk))
+                # Ограничиваем число разбираемых пачек, чтобы не держать весь архив в памяти
+                if len(pending) >= workers * 2:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for future in finished:
+                        await migration.add(future.result())
+            for future in asyncio.as_completed(pending):
+                await migration.add(await future)
+        await migration.flush()
+    finally:
+        migration.close()
+        await pool.close()
+    elapsed = time.monotonic() - migration.started
+    logger.info(
+        f"Перенос завершён за {elapsed:.1f} с: файлов {migration.files}, новых строк {migration.inserted}, "
+        f"ошибок разбора {len(migration.failed)}."
+    )
+    migration.report_failed()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Перенос архива data/*.json в PostgreSQL")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--checkpoint", default=os.path.join("data", ".migration_checkpoint"))
+    parser.add_argument("--batch-size", type=int, default=5000, help="строк на одну загрузку COPY")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="процессов для разбора JSON")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.data_dir, args.checkpoint, args.batch_size, args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+# notifier.py
+# Очередь исходящих уведомлений для массовых рассылок (напоминания, ретроспективы).
+# Telegram допускает около 30 сообщений в секунду на бота и примерно одно в секунду в один чат,
+# а при превышении отвечает RetryAfter — поэтому все рассылки идут через общий token bucket.
+import asyncio
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+
+from telegram import Bot, ReplyKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+import metrics
+from ratelimit import TokenBucket, worker_share
+
+logger = logging.getLogger(__name__)
+
+# Лимиты общие на бота и делятся между воркерами
+NOTIFY_RATE_PER_SEC: float = worker_share(float(os.getenv("NOTIFY_RATE_PER_SEC", "25")))
+# Запас токенов мал: в любом окне в 1 с уходит не больше rate + burst сообщений
+NOTIFY_BURST: float = max(1.0, worker_share(float(os.getenv("NOTIFY_BURST", "5"))))
+# Минимальный интервал между сообщениями в один чат, секунды
+NOTIFY_PER_CHAT_INTERVAL: float = float(os.getenv("NOTIFY_PER_CHAT_INTERVAL", "1.0"))
+NOTIFY_WORKERS: int = int(os.getenv("NOTIFY_WORKERS", "16"))
+NOTIFY_MAX_ATTEMPTS: int = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "4"))
+NOTIFY_RETRY_BASE: float = float(os.getenv("NOTIFY_RETRY_BASE", "1.0"))
+
+DELIVERED = metrics.counter("notifications_delivered_total", "Доставленные уведомления")
+FAILED = metrics.counter("notifications_failed_total", "Уведомления, которые не удалось доставить")
+FLOOD_WAITS = metrics.counter("notifications_retry_after_total", "Ответы RetryAfter от Telegram")
+DELIVERY_LATENCY = metrics.histogram(
+    "notification_delivery_seconds", "Время от постановки уведомления в очередь до доставки"
+)
+OUTBOX_DEPTH = metrics.gauge("notification_outbox_depth", "Уведомления, ожидающие отправки")
+
+
+@dataclass
+class NotificationBatch:
+    """Одна рассылка (например, напоминания одной минуты); отчёт пишется в лог по её завершении."""
+    label: str
+    total: int
+    delivered: int = 0
+    failed: int = 0
+    started: float = field(default_factory=time.monotonic)
+    latencies: List[float] = field(default_factory=list)
+    done: "asyncio.Future[None]" = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+    def settle(self, delivered: bool, latency: float = 0.0) -> None:
+        if delivered:
+            self.delivered += 1
+            self.latencies.append(latency)
+        else:
+            self.failed += 1
+        if self.delivered + self.failed == self.total:
+            self.report()
+            if not self.done.done():
+                self.done.set_result(None)
+
+    def report(self) -> None:
+        latencies = sorted(self.latencies)
+        if latencies:
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            timing = f", задержка p50 {p50:.2f} с, p95 {p95:.2f} с, max {latencies[-1]:.2f} с"
+        else:
+            timing = ""
+        logger.info(
+            f"Рассылка «{self.label}»: доставлено {self.delivered} из {self.total}, ошибок {self.failed}, "
+            f"за {time.monotonic() - self.started:.2f} с{timing}"
+        )
+
+
+@dataclass
+class Notification:
+    chat_id: int
+    text: str
+    reply_markup: Optional[ReplyKeyboardMarkup]
+    batch: NotificationBatch
+    attempt: int = 0
+
+
+class NotificationOutbox:
+    """Очередь уведомлений: общий token bucket на бота, интервал между сообщениями в один чат,
+    глобальная пауза по RetryAfter и повторы временных ошибок с экспоненциальной задержкой и jitter."""
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate_per_sec: float = NOTIFY_RATE_PER_SEC,
+        burst: float = NOTIFY_BURST,
+        per_chat_interval: float = NOTIFY_PER_CHAT_INTERVAL,
+        workers: int = NOTIFY_WORKERS,
+        max_attempts: int = NOTIFY_MAX_ATTEMPTS,
+        retry_base: float = NOTIFY_RETRY_BASE,
+    ) -> None:
+        self.bot = bot
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self._bucket = TokenBucket(rate_per_sec, burst)
+        self._queue: "asyncio.Queue[Notification]" = asyncio.Queue()
+        self._worker_count = workers
+        self._workers: List[asyncio.Task] = []
+        # chat_id -> момент (monotonic), раньше которого в этот чат писать нельзя
+        self._chat_ready: Dict[int, float] = {}
+        self._paused_until = 0.0
+        self._pending = 0
+
+    @property
+    def depth(self) -> int:
+        return self._pending
+
+    def start(self) -> None:
+        for i in range(self._worker_count):
+            self._workers.append(asyncio.create_task(self._worker(), name=f"notifier-{i}"))
+        logger.info(f"Очередь уведомлений запущена: {self._worker_count} воркеров, {self._bucket.rate} сообщений/с.")
+
+    async def stop(self, drain_timeout: float = 5.0) -> None:
+        """Даёт очереди до drain_timeout секунд на отправку оставшегося и останавливает воркеров."""
+        deadline = time.monotonic() + drain_timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._pending:
+            logger.warning(f"Очередь уведомлений остановлена, не отправлено: {self._pending}")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def submit(
+        self, label: str, chat_ids: Iterable[int], text: str, reply_markup: Optional[ReplyKeyboardMarkup] = None
+    ) -> NotificationBatch:
+        """Ставит одинаковое сообщение для всех chat_ids в очередь и сразу возвращает рассылку."""
+        chat_ids = list(chat_ids)
+        batch = NotificationBatch(label, len(chat_ids))
+        for chat_id in chat_ids:
+            self._queue.put_nowait(Notification(chat_id, text, reply_markup, batch))
+        self._pending += len(chat_ids)
+        OUTBOX_DEPTH.set(self._pending)
+        if not chat_ids:
+            batch.done.set_result(None)
+        return batch
+
+    def _requeue_later(self, delay: float, item: Notification) -> None:
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, item)
+
+    def _finish(self, item: Notification, delivered: bool, error: Optional[Exception] = None) -> None:
+        self._pending -= 1
+        OUTBOX_DEPTH.set(self._pending)
+        if delivered:
+            latency = time.monotonic() - item.batch.started
+            DELIVERED.inc()
+            DELIVERY_LATENCY.observe(latency)
+            item.batch.settle(True, latency)
+        else:
+            FAILED.inc()
+            logger.warning(f"Не удалось доставить уведомление в чат {item.chat_id}: {error}")
+            item.batch.settle(False)
+
+    def _prune_chat_limits(self, now: float) -> None:
+        if len(self._chat_ready) > 10000:
+            self._chat_ready = {chat_id: t for chat_id, t in self._chat_ready.items() if t > now}
+
+    async def _worker(self) -> None:
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._deliver(item)
+            except Exception as e:
+                # Ошибка не от Telegram (неверная разметка, ошибка в самой очереди): уведомление считается
+                # недоставленным, чтобы рассылка завершилась, а воркер продолжает работу
+                logger.exception(f"Непредвиденная ошибка при отправке уведомления в чат {item.chat_id}:")
+                self._finish(item, False, e)
+
+    async def _deliver(self, item: Notification) -> None:
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        now = time.monotonic()
+        chat_wait = self._chat_ready.get(item.chat_id, 0.0) - now
+        if chat_wait > 0:
+            self._requeue_later(chat_wait, item)
+            return
+        await self._bucket.acquire()
+        self._chat_ready[item.chat_id] = time.monotonic() + self.per_chat_interval
+        self._prune_chat_limits(now)
+        try:
+            await self.bot.send_message(chat_id=item.chat_id, text=item.text, reply_markup=item.reply_markup)
+        except RetryAfter as e:
+            # Лимит превышен для всего бота: приостанавливаем всех воркеров и повторяем без штрафа
+            FLOOD_WAITS.inc()
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            self._requeue_later(e.retry_after, item)
+        except (Forbidden, BadRequest) as e:
+            # Пользователь заблокировал бота или чат недоступен — повтор не поможет
+            self._finish(item, False, e)
+        except (TelegramError, OSError) as e:
+            item.attempt += 1
+            if item.attempt >= self.max_attempts:
+                self._finish(item, False, e)
+            else:
+                delay = self.retry_base * 2 ** (item.attempt - 1) * random.uniform(0.5, 1.5)
+                self._requeue_later(delay, item)
+        else:
+            self._finish(item, True)
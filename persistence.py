@@ -0,0 +1,179 @@
+# persistence.py
+# Хранение состояния диалогов в PostgreSQL: context.user_data (ответы незавершённого теста,
+# вопросы дня, контекст чата с Gemini, ответы ретроспективы) и состояния ConversationHandler.
+# Запись отложенная: изменения копятся в памяти и уходят в БД пачкой после каждого прохода
+# Application.update_persistence. user_data пользователя читается из БД лениво, при его первом обновлении.
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Set, Tuple
+
+import asyncpg
+from telegram.ext import BasePersistence, PersistenceInput
+
+import metrics
+from db import get_bot_conversations, get_bot_user_data, write_bot_state
+
+logger = logging.getLogger(__name__)
+
+ConversationKey = Tuple[int, ...]
+
+# Как часто Application отдаёт изменения в persistence (и, значит, как часто идёт запись в БД), секунды
+PERSISTENCE_UPDATE_INTERVAL: float = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "5"))
+# Диалоги, не менявшиеся дольше этого срока, при запуске не восстанавливаются
+PERSISTENCE_CONVERSATION_TTL_HOURS: int = int(os.getenv("PERSISTENCE_CONVERSATION_TTL_HOURS", "48"))
+
+FLUSH_DURATION = metrics.histogram("persistence_flush_seconds", "Время записи накопленного состояния диалогов в БД")
+FLUSHED_ROWS = metrics.counter("persistence_rows_written_total", "Записи user_data и состояний диалогов, отправленные в БД")
+FLUSH_ERRORS = metrics.counter("persistence_flush_errors_total", "Неудачные попытки записи состояния диалогов")
+
+
+def _encode_key(key: ConversationKey) -> str:
+    return json.dumps(list(key))
+
+
+def _decode_key(key: str) -> ConversationKey:
+    return tuple(json.loads(key))
+
+
+class PostgresPersistence(BasePersistence[Dict[str, Any], Dict[str, Any], Dict[str, Any]]):
+    """BasePersistence поверх asyncpg. Хранит только user_data и состояния диалогов:
+    bot_data содержит пул, клиентов и очереди, а chat_data и callback_data бот не использует."""
+
+    def __init__(
+        self,
+        pool: asyncpg.pool.Pool,
+        update_interval: float = PERSISTENCE_UPDATE_INTERVAL,
+        conversation_ttl_hours: int = PERSISTENCE_CONVERSATION_TTL_HOURS,
+    ) -> None:
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.pool = pool
+        self.conversation_ttl = timedelta(hours=conversation_ttl_hours)
+        # Отложенные изменения: последнее значение на ключ, None — удалить
+        self._dirty_user_data: Dict[int, Optional[Dict[str, Any]]] = {}
+        self._dirty_conversations: Dict[Tuple[str, str], Optional[int]] = {}
+        # Пользователи, чьи user_data уже прочитаны из БД в этом процессе
+        self._restored_users: Set[int] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    # --- Загрузка ---
+
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        # При запуске ничего не читаем: данные пользователя подгружает refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        """Вызывается перед обработкой каждого обновления; в БД идёт только при первом обновлении пользователя."""
+        if user_id in self._restored_users:
+            return
+        self._restored_users.add(user_id)
+        try:
+            stored = await get_bot_user_data(self.pool, user_id)
+        except Exception:
+            self._restored_users.discard(user_id)
+            logger.exception(f"Не удалось восстановить данные диалога пользователя {user_id}:")
+            return
+        for key, value in (stored or {}).items():
+            user_data.setdefault(key, value)
+
+    async def get_conversations(self, name: str) -> Dict[ConversationKey, object]:
+        since = datetime.now(timezone.utc) - self.conversation_ttl
+        records = await get_bot_conversations(self.pool, name, since)
+        if records:
+            logger.info(f"Восстановлено незавершённых диалогов «{name}»: {len(records)}")
+        return {_decode_key(r["key"]): r["state"] for r in records}
+
+    async def get_chat_data(self) -> Dict[int, Dict[str, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    # --- Изменения ---
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        # Application передаёт глубокую копию, поэтому её можно хранить до записи как есть;
+        # пустые данные (после «Главное меню») просто удаляются
+        self._dirty_user_data[user_id] = data or None
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._dirty_user_data[user_id] = None
+        self._schedule_flush()
+
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        self._dirty_conversations[(name, _encode_key(key))] = new_state  # type: ignore[assignment]
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: Dict[str, Any]) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[str, Any]) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict[str, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[str, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    # --- Запись ---
+
+    def _schedule_flush(self) -> None:
+        # update_persistence вызывает update_* для всех изменившихся ключей через asyncio.gather;
+        # задача записи создаётся позже них и потому забирает изменения всего прохода одной пачкой
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_pending(), name="persistence-flush")
+
+    async def _write_pending(self) -> None:
+        # Изменения, пришедшие во время записи, уходят следующей пачкой в том же цикле
+        async with self._flush_lock:
+            while self._dirty_user_data or self._dirty_conversations:
+                user_data, self._dirty_user_data = self._dirty_user_data, {}
+                conversations, self._dirty_conversations = self._dirty_conversations, {}
+                started = time.monotonic()
+                try:
+                    await write_bot_state(
+                        self.pool,
+                        list(user_data.items()),
+                        [(name, key, state) for (name, key), state in conversations.items()],
+                    )
+                except Exception:
+                    FLUSH_ERRORS.inc()
+                    logger.exception("Ошибка при записи состояния диалогов, повтор через интервал обновления:")
+                    # Возвращаем неотправленное, если за время записи не появилось более новых значений
+                    for user_id, data in user_data.items():
+                        self._dirty_user_data.setdefault(user_id, data)
+                    for key, state in conversations.items():
+                        self._dirty_conversations.setdefault(key, state)
+                    asyncio.get_running_loop().call_later(self.update_interval, self._schedule_flush)
+                    return
+                FLUSH_DURATION.observe(time.monotonic() - started)
+                FLUSHED_ROWS.inc(len(user_data) + len(conversations))
+
+    async def flush(self) -> None:
+        """Вызывается Application при остановке после последнего update_persistence."""
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._write_pending()
+        if self._dirty_user_data or self._dirty_conversations:
+            logger.warning(
+                f"При остановке не записано состояние диалогов: user_data {len(self._dirty_user_data)}, "
+                f"состояний {len(self._dirty_conversations)}"
+            )
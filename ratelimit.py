@@ -0,0 +1,43 @@
+# ratelimit.py
+import asyncio
+import os
+import time
+
+# Сколько воркеров бота запущено (см. router.py). Лимиты Telegram и Gemini общие на бота и ключ API,
+# поэтому каждый воркер берёт себе свою долю
+BOT_WORKERS: int = int(os.getenv("BOT_WORKERS", "1"))
+
+
+def worker_share(limit: float) -> float:
+    """Доля общего лимита, приходящаяся на этот воркер."""
+    return limit / BOT_WORKERS
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity в запасе."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """Забирает токены, если они есть, и возвращает 0; иначе — сколько секунд подождать."""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
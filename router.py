@@ -0,0 +1,107 @@
+# router.py
+# Маршрутизатор вебхуков для запуска бота в несколько воркеров (BOT_WORKERS > 1, BOT_MODE=webhook).
+# Telegram присылает все обновления на один адрес; маршрутизатор проверяет секретный токен и пересылает
+# обновление воркеру с номером user_id % N. Все обновления пользователя обрабатывает один и тот же воркер,
+# поэтому его диалог, user_data в памяти и порядок сообщений остаются согласованными.
+# Рассылки воркеры делят через БД (FOR UPDATE SKIP LOCKED в scheduler.py), состояние диалогов — через persistence.py.
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List
+
+import httpx
+from tornado.web import Application, RequestHandler
+
+import metrics
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
+
+ROUTER_LISTEN: str = os.getenv("ROUTER_LISTEN", "0.0.0.0")
+ROUTER_PORT: int = int(os.getenv("ROUTER_PORT", "8443"))
+# Адреса вебхуков воркеров по порядку номеров, через запятую: http://worker-0:8443/telegram,...
+ROUTER_WORKER_URLS: List[str] = [url.strip() for url in os.getenv("ROUTER_WORKER_URLS", "").split(",") if url.strip()]
+WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN: str = os.getenv("WEBHOOK_SECRET_TOKEN", "")
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+FORWARDED = metrics.counter("router_updates_forwarded_total", "Обновления, переданные воркерам")
+FORWARD_ERRORS = metrics.counter("router_forward_errors_total", "Обновления, которые не удалось передать воркеру")
+FORWARD_LATENCY = metrics.histogram("router_forward_seconds", "Время передачи обновления воркеру до его ответа")
+
+
+def routing_key(update: Dict[str, Any]) -> int:
+    """Пользователь обновления, а если его нет — чат; для обновлений без них (опросы) — update_id."""
+    for field, payload in update.items():
+        if field == "update_id" or not isinstance(payload, dict):
+            continue
+        for owner in ("from", "user", "chat"):
+            if isinstance(payload.get(owner), dict) and "id" in payload[owner]:
+                return payload[owner]["id"]
+    return update.get("update_id", 0)
+
+
+def worker_for(update: Dict[str, Any], workers: int) -> int:
+    return routing_key(update) % workers
+
+
+class WebhookRouterHandler(RequestHandler):
+    def initialize(self, client: httpx.AsyncClient, worker_urls: List[str], secret_token: str) -> None:
+        self.client = client
+        self.worker_urls = worker_urls
+        self.secret_token = secret_token
+
+    async def post(self) -> None:
+        if self.request.headers.get(SECRET_HEADER) != self.secret_token:
+            self.set_status(403)
+            return
+        try:
+            update = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        index = worker_for(update, len(self.worker_urls))
+        started = time.monotonic()
+        try:
+            response = await self.client.post(
+                self.worker_urls[index],
+                content=self.request.body,
+                headers={SECRET_HEADER: self.secret_token, "Content-Type": "application/json"},
+            )
+        except httpx.HTTPError as e:
+            # Ответ не 2xx заставит Telegram повторить доставку позже
+            FORWARD_ERRORS.inc()
+            logger.warning(f"Воркер {index} недоступен: {e}")
+            self.set_status(502)
+            return
+        FORWARDED.inc()
+        FORWARD_LATENCY.observe(time.monotonic() - started)
+        self.set_status(response.status_code)
+
+
+async def serve() -> None:
+    limits = httpx.Limits(max_connections=200, max_keepalive_connections=200)
+    async with httpx.AsyncClient(limits=limits, timeout=10) as client:
+        app = Application([
+            (rf"/{WEBHOOK_PATH}", WebhookRouterHandler, {
+                "client": client, "worker_urls": ROUTER_WORKER_URLS, "secret_token": WEBHOOK_SECRET_TOKEN,
+            }),
+        ])
+        app.listen(ROUTER_PORT, address=ROUTER_LISTEN)
+        await metrics.start_http_server()
+        logger.info(f"Маршрутизатор слушает {ROUTER_LISTEN}:{ROUTER_PORT}/{WEBHOOK_PATH}, воркеров: {len(ROUTER_WORKER_URLS)}")
+        await asyncio.Event().wait()
+
+
+def main() -> None:
+    setup_logging()
+    if not ROUTER_WORKER_URLS or not WEBHOOK_SECRET_TOKEN:
+        logger.error("Для маршрутизатора нужны ROUTER_WORKER_URLS и WEBHOOK_SECRET_TOKEN.")
+        return
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+# scheduler.py
+# Расписание напоминаний и ретроспектив. Для каждой записи в БД хранится next_fire_utc —
+# ближайший момент срабатывания по UTC, посчитанный по правилам часового пояса пользователя
+# (zoneinfo, с учётом перехода на летнее время). Диспетчер раз в минуту одним запросом по индексу
+# забирает всё, что наступило, рассылает уведомления и сдвигает next_fire_utc на следующий раз.
+# В памяти процесса о пользователях ничего не хранится, поэтому число напоминаний ограничено только базой.
+import asyncio
+import logging
+import os
+import time as time_module
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+import asyncpg
+
+import metrics
+from db import (
+    claim_due_daily_reminders,
+    claim_due_scheduled_retrospectives,
+    get_unscheduled_daily_reminder_groups,
+    get_unscheduled_retrospective_groups,
+    set_daily_reminder_next_fire,
+    set_scheduled_retrospective_next_fire,
+)
+
+logger = logging.getLogger(__name__)
+
+# Сколько наступивших записей забираем из БД и отдаём на рассылку за один шаг
+REMINDER_BATCH_SIZE: int = int(os.getenv("REMINDER_BATCH_SIZE", "1000"))
+# Напоминания, опоздавшие больше чем на столько минут (бот был остановлен), не отправляются,
+# а только переносятся на следующий раз
+REMINDER_MAX_CATCH_UP: int = int(os.getenv("REMINDER_MAX_CATCH_UP", "5"))
+
+RETRO_PERIOD_DAYS: Dict[str, int] = {"weekly": 7, "biweekly": 14}
+
+TICK_DURATION = metrics.histogram("reminder_tick_seconds", "Время обработки наступивших напоминаний за минуту")
+REMINDERS_DUE = metrics.counter("reminders_due_total", "Напоминания, выбранные диспетчером к отправке")
+REMINDERS_SKIPPED = metrics.counter("reminders_skipped_total", "Просроченные напоминания, перенесённые без отправки")
+REMINDERS_DISABLED = metrics.counter(
+    "reminders_disabled_total", "Напоминания и ретроспективы, выключенные из-за настроек, по которым нельзя посчитать время"
+)
+# Опоздание отправки относительно next_fire_utc: шаг диспетчера — минута, поэтому норма до 60 с
+FIRE_LAG = metrics.histogram(
+    "reminder_fire_lag_seconds", "Опоздание рассылки напоминания относительно назначенного момента",
+    buckets=(1.0, 5.0, 15.0, 30.0, 60.0, 90.0, 120.0, 300.0),
+)
+
+DailySender = Callable[[List[int]], Awaitable[None]]
+RetroSender = Callable[[List[Tuple[int, str]]], Awaitable[None]]
+
+
+def _local_fire(on_date: date, target_local_time: time, tz: ZoneInfo) -> datetime:
+    # Неоднозначное время при переводе часов назад берётся первым (fold=0), а несуществующее
+    # при переводе вперёд zoneinfo сдвигает на величину перехода
+    return datetime.combine(on_date, target_local_time, tzinfo=tz).astimezone(timezone.utc)
+
+
+def first_fire(
+    target_local_time: time, tz_name: str, after: Optional[datetime] = None, weekday: Optional[int] = None
+) -> datetime:
+    """Первый момент (UTC) строго после after, когда в поясе tz_name наступает target_local_time
+    (и, если задан weekday, этот день недели: 0 — понедельник)."""
+    after = after or datetime.now(timezone.utc)
+    tz = ZoneInfo(tz_name or "UTC")
+    local_date = after.astimezone(tz).date()
+    if weekday is not None:
+        local_date += timedelta(days=(weekday - local_date.weekday()) % 7)
+    fire = _local_fire(local_date, target_local_time, tz)
+    if fire <= after:
+        fire = _local_fire(local_date + timedelta(days=7 if weekday is not None else 1), target_local_time, tz)
+    return fire
+
+
+def advance_fire(
+    previous: datetime, target_local_time: time, tz_name: str, period_days: int, now: Optional[datetime] = None
+) -> datetime:
+    """Следующее срабатывание после previous с шагом period_days локальных дней — за O(1),
+    даже если бот простоял много периодов: пропущенные периоды перескакиваются арифметически."""
+    now = now or datetime.now(timezone.utc)
+    tz = ZoneInfo(tz_name or "UTC")
+    previous_date = previous.astimezone(tz).date()
+    steps = 1
+    lag_days = (now.astimezone(tz).date() - previous_date).days
+    if lag_days > 0:
+        steps = max(1, lag_days // period_days)
+    fire = _local_fire(previous_date + timedelta(days=steps * period_days), target_local_time, tz)
+    if fire <= now:
+        fire = _local_fire(previous_date + timedelta(days=(steps + 1) * period_days), target_local_time, tz)
+    return fire
+
+
+def retrospective_first_fire(
+    scheduled_day: int, target_local_time: time, tz_name: str, after: Optional[datetime] = None
+) -> datetime:
+    return first_fire(target_local_time, tz_name, after, weekday=scheduled_day)
+
+
+def guarded(compute: Callable[[], datetime], what: str) -> Optional[datetime]:
+    """Момент срабатывания или None, если по сохранённым настройкам его не посчитать (например,
+    в timezone старой записи не имя пояса). Такая запись выключается, а не срывает всю пачку."""
+    try:
+        return compute()
+    except Exception as e:
+        REMINDERS_DISABLED.inc()
+        logger.warning(f"Не удалось рассчитать время срабатывания ({what}), выключено: {e!r}")
+        return None
+
+
+def observe_fire_lag(records: List[asyncpg.Record]) -> None:
+    claimed_at = datetime.now(timezone.utc)
+    for r in records:
+        FIRE_LAG.observe((claimed_at - r["next_fire_utc"]).total_seconds())
+
+
+async def assign_missing_fire_times(pool: asyncpg.pool.Pool) -> None:
+    """Считает next_fire_utc для записей, созданных до его появления. Момент зависит только
+    от настроек, поэтому считается один раз на группу одинаковых настроек."""
+    now = datetime.now(timezone.utc)
+    disabled = 0
+    daily = [
+        (
+            r["target_local_time"], r["timezone"],
+            guarded(
+                lambda: first_fire(r["target_local_time"], r["timezone"], now),
+                f"напоминания с поясом {r['timezone']!r}",
+            ),
+        )
+        for r in await get_unscheduled_daily_reminder_groups(pool)
+    ]
+    if daily:
+        disabled += await set_daily_reminder_next_fire(pool, daily)
+    retros = [
+        (
+            r["scheduled_day"], r["target_local_time"], r["timezone"], r["retrospective_type"],
+            guarded(
+                lambda: retrospective_first_fire(r["scheduled_day"], r["target_local_time"], r["timezone"], now),
+                f"ретроспективы с поясом {r['timezone']!r}",
+            ),
+        )
+        for r in await get_unscheduled_retrospective_groups(pool)
+    ]
+    if retros:
+        disabled += await set_scheduled_retrospective_next_fire(pool, retros)
+    if daily or retros:
+        logger.info(
+            f"Назначено время срабатывания: групп напоминаний {len(daily)}, групп ретроспектив {len(retros)}, "
+            f"выключено записей с неверными настройками {disabled}"
+        )
+
+
+class ReminderDispatcher:
+    """Раз в минуту забирает из БД наступившие напоминания и ретроспективы, передаёт их пачками
+    в функции рассылки и сдвигает каждой записи next_fire_utc на следующий раз."""
+
+    def __init__(
+        self,
+        pool: asyncpg.pool.Pool,
+        send_daily: DailySender,
+        send_retro: RetroSender,
+        batch_size: int = REMINDER_BATCH_SIZE,
+        max_catch_up: int = REMINDER_MAX_CATCH_UP,
+    ) -> None:
+        self.pool = pool
+        self.send_daily = send_daily
+        self.send_retro = send_retro
+        self.batch_size = batch_size
+        self.max_catch_up = max_catch_up
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name="reminder-dispatcher")
+        logger.info("Диспетчер напоминаний запущен.")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        # Первый проход сразу при запуске: он же подбирает всё, что наступило, пока бот был остановлен
+        while True:
+            now = datetime.now(timezone.utc)
+            try:
+                await self.tick(now)
+            except Exception:
+                logger.exception(f"Ошибка при обработке напоминаний за {now:%H:%M} UTC:")
+            next_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+            await asyncio.sleep(max(0.0, (next_minute - datetime.now(timezone.utc)).total_seconds()))
+
+    async def tick(self, now: datetime) -> None:
+        """Обрабатывает все записи с next_fire_utc <= now."""
+        started = time_module.monotonic()
+        stale_before = now - timedelta(minutes=self.max_catch_up)
+        daily = retros = skipped = 0
+
+        def advance_daily(r: asyncpg.Record) -> Optional[datetime]:
+            return guarded(
+                lambda: advance_fire(r["next_fire_utc"], r["target_local_time"], r["timezone"], 1, now),
+                f"напоминание пользователя {r['user_id']}",
+            )
+
+        def advance_retro(r: asyncpg.Record) -> Optional[datetime]:
+            period = RETRO_PERIOD_DAYS.get(r["retrospective_type"], 7)
+            return guarded(
+                lambda: advance_fire(r["next_fire_utc"], r["target_local_time"], r["timezone"], period, now),
+                f"ретроспектива пользователя {r['user_id']}",
+            )
+
+        while True:
+            records, claimed = await claim_due_daily_reminders(self.pool, now, advance_daily, self.batch_size)
+            due = [r for r in records if r["next_fire_utc"] >= stale_before]
+            observe_fire_lag(due)
+            user_ids = [r["user_id"] for r in due]
+            skipped += len(records) - len(user_ids)
+            if user_ids:
+                daily += len(user_ids)
+                await self.send_daily(user_ids)
+            if claimed < self.batch_size:
+                break
+        while True:
+            records, claimed = await claim_due_scheduled_retrospectives(
+                self.pool, now, advance_retro, self.batch_size
+            )
+            due = [r for r in records if r["next_fire_utc"] >= stale_before]
+            observe_fire_lag(due)
+            rows = [(r["user_id"], r["retrospective_type"]) for r in due]
+            skipped += len(records) - len(rows)
+            if rows:
+                retros += len(rows)
+                await self.send_retro(rows)
+            if claimed < self.batch_size:
+                break
+
+        elapsed = time_module.monotonic() - started
+        TICK_DURATION.observe(elapsed)
+        REMINDERS_DUE.inc(daily + retros)
+        REMINDERS_SKIPPED.inc(skipped)
+        if daily or retros or skipped:
+            logger.info(
+                f"{now:%H:%M} UTC: напоминаний {daily}, ретроспектив {retros}, "
+                f"просрочено и перенесено {skipped}, обработано за {elapsed:.2f} с"
+            )
@@ -0,0 +1,185 @@
+# settings_cache.py
+# Кэш часовых поясов пользователей в памяти процесса — единственной настройки, которую обработчики
+# читают по ходу диалога (настройки напоминаний читает только диспетчер, пачками). Чтение идёт в БД
+# только при промахе; записи живут не дольше SETTINGS_CACHE_TTL секунд, сверх SETTINGS_CACHE_ENTRIES
+# вытесняются давно не читанные (LRU). Отсутствие часового пояса тоже кэшируется.
+# Каждая запись часового пояса в db.py после COMMIT сбрасывает запись кэша (add_timezone_listener).
+# Чтобы о записи узнали и другие воркеры, задаётся SETTINGS_CACHE_CHANNEL: сброс рассылается через
+# NOTIFY, а каждый воркер слушает канал на отдельном соединении (LISTEN).
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+import metrics
+from db import DATABASE_URL, add_timezone_listener, get_user_timezone, remove_timezone_listener
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_CACHE_ENTRIES: int = int(os.getenv("SETTINGS_CACHE_ENTRIES", "10000"))
+SETTINGS_CACHE_TTL: float = float(os.getenv("SETTINGS_CACHE_TTL", "300"))
+# Канал LISTEN/NOTIFY для сброса кэша на всех воркерах; пусто — выключен (хватает при одном воркере)
+SETTINGS_CACHE_CHANNEL: str = os.getenv("SETTINGS_CACHE_CHANNEL", "")
+# Без уведомлений соединение LISTEN проверяется с таким интервалом, секунды
+LISTEN_KEEPALIVE: float = 30
+LISTEN_RECONNECT_DELAY: float = 5
+# Длина payload NOTIFY ограничена 8000 байт; id пользователя с запятой — не больше 21 символа
+NOTIFY_IDS_PER_PAYLOAD: int = 370
+
+HITS = metrics.counter("settings_cache_hits_total", "Часовые пояса пользователей, взятые из кэша")
+MISSES = metrics.counter("settings_cache_misses_total", "Чтения часового пояса пользователя из БД")
+INVALIDATIONS = {
+    source: metrics.counter(
+        "settings_cache_invalidations_total", "Записи кэша, сброшенные после изменения часового пояса",
+        {"source": source},
+    )
+    for source in ("local", "remote")
+}
+ENTRIES = metrics.gauge("settings_cache_entries", "Записей в кэше часовых поясов")
+
+
+class SettingsCache:
+    def __init__(
+        self,
+        pool: asyncpg.pool.Pool,
+        entries: int = SETTINGS_CACHE_ENTRIES,
+        ttl: float = SETTINGS_CACHE_TTL,
+        channel: str = SETTINGS_CACHE_CHANNEL,
+        dsn: str = DATABASE_URL,
+    ) -> None:
+        self.pool = pool
+        self.entries = entries
+        self.ttl = ttl
+        self.channel = channel
+        self.dsn = dsn
+        self._memory: "OrderedDict[int, Tuple[float, Optional[str]]]" = OrderedDict()
+        # Пользователи, чей часовой пояс сейчас читается из БД: [поколение, число чтений]. Сброс
+        # увеличивает поколение, и прочитанное до сброса в кэш не попадает; сброс других пользователей
+        # чтению не мешает
+        self._in_flight: Dict[int, List[int]] = {}
+        self._outgoing: "asyncio.Queue[str]" = asyncio.Queue()
+        self._listen_pid: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        add_timezone_listener(self._on_local_change)
+        if self.channel:
+            self._task = asyncio.create_task(self._listen(), name="settings-cache-listen")
+
+    async def stop(self) -> None:
+        remove_timezone_listener(self._on_local_change)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.log_summary()
+
+    async def get_user_timezone(self, user_id: int) -> Optional[str]:
+        """Часовой пояс пользователя; None — не задан или БД недоступна."""
+        entry = self._memory.get(user_id)
+        if entry is not None:
+            expires_at, timezone = entry
+            if expires_at > time.monotonic():
+                self._memory.move_to_end(user_id)
+                HITS.inc()
+                return timezone
+            del self._memory[user_id]
+        MISSES.inc()
+        flight = self._in_flight.setdefault(user_id, [0, 0])
+        generation = flight[0]
+        flight[1] += 1
+        try:
+            timezone = await get_user_timezone(self.pool, user_id)
+        except Exception:
+            logger.exception(f"Ошибка при получении часового пояса для {user_id}")
+            return None
+        finally:
+            flight[1] -= 1
+            if not flight[1]:
+                del self._in_flight[user_id]
+        # Пока шёл запрос, часовой пояс мог измениться здесь или на другом воркере — тогда
+        # прочитанное значение не запоминаем: следующее чтение пойдёт в БД
+        if flight[0] == generation:
+            self._memory[user_id] = (time.monotonic() + self.ttl, timezone)
+            self._memory.move_to_end(user_id)
+            while len(self._memory) > self.entries:
+                self._memory.popitem(last=False)
+            ENTRIES.set(len(self._memory))
+        return timezone
+
+    def invalidate(self, user_ids: Sequence[int], source: str = "local") -> None:
+        removed = 0
+        for user_id in user_ids:
+            flight = self._in_flight.get(user_id)
+            if flight is not None:
+                flight[0] += 1
+            removed += self._memory.pop(user_id, None) is not None
+        if removed:
+            INVALIDATIONS[source].inc(removed)
+            ENTRIES.set(len(self._memory))
+
+    def clear(self) -> None:
+        for flight in self._in_flight.values():
+            flight[0] += 1
+        self._memory.clear()
+        ENTRIES.set(0)
+
+    def _on_local_change(self, user_ids: Sequence[int]) -> None:
+        self.invalidate(user_ids)
+        if self.channel:
+            for start in range(0, len(user_ids), NOTIFY_IDS_PER_PAYLOAD):
+                self._outgoing.put_nowait(",".join(map(str, user_ids[start:start + NOTIFY_IDS_PER_PAYLOAD])))
+
+    def _on_notify(self, conn: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        # Свои уведомления уже применены в _on_local_change
+        if pid == self._listen_pid:
+            return
+        try:
+            user_ids = [int(user_id) for user_id in payload.split(",") if user_id]
+        except ValueError:
+            logger.warning(f"Неизвестное уведомление в канале {channel}: {payload[:100]}")
+            return
+        self.invalidate(user_ids, source="remote")
+
+    async def _listen(self) -> None:
+        """Держит соединение LISTEN и отправляет через него NOTIFY о локальных изменениях.
+        Соединение отдельное, не из пула: оно занято всё время работы, а BotConnection при возврате
+        в пул не выполняет сброс сессии (UNLISTEN)."""
+        unsent: List[str] = []
+        while True:
+            conn: Optional[asyncpg.Connection] = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                await conn.add_listener(self.channel, self._on_notify)
+                self._listen_pid = conn.get_server_pid()
+                # Уведомления, отправленные другими воркерами без нас, потеряны
+                self.clear()
+                logger.info(f"Кэш часовых поясов слушает канал {self.channel}.")
+                while True:
+                    if not unsent:
+                        try:
+                            unsent.append(await asyncio.wait_for(self._outgoing.get(), LISTEN_KEEPALIVE))
+                        except asyncio.TimeoutError:
+                            await conn.execute("SELECT 1", timeout=LISTEN_KEEPALIVE)
+                            continue
+                    await conn.execute("SELECT pg_notify($1, $2)", self.channel, unsent[0], timeout=LISTEN_KEEPALIVE)
+                    unsent.pop()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Соединение LISTEN кэша часовых поясов потеряно, переподключение через {LISTEN_RECONNECT_DELAY} с:")
+                self.clear()
+            finally:
+                self._listen_pid = None
+                if conn is not None:
+                    conn.terminate()
+            await asyncio.sleep(LISTEN_RECONNECT_DELAY)
+
+    def log_summary(self) -> None:
+        hits, total = HITS.value, HITS.value + MISSES.value
+        if total:
+            logger.info(f"Кэш часовых поясов: попаданий {hits:.0f} из {total:.0f} ({hits / total:.0%})")
@@ -0,0 +1,141 @@
+# settings_writer.py
+# Отложенная пакетная запись настроек пользователей: часовой пояс, ежедневное напоминание,
+# запланированная ретроспектива. Обработчик ставит запись в очередь и ждёт подтверждения;
+# записи, пришедшие за несколько миллисекунд (и пока идёт предыдущая запись), уходят в БД одним
+# многострочным upsert на таблицу. Подтверждение приходит после COMMIT, поэтому ответ пользователю
+# «Напоминание установлено!» по-прежнему означает, что настройка сохранена.
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, time as dt_time
+from typing import Dict, List, Optional, Tuple
+
+import asyncpg
+
+import metrics
+from db import DailyReminderRow, RetrospectiveRow, write_settings
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать попутных записей после первой, миллисекунды
+SETTINGS_BATCH_DELAY_MS: float = float(os.getenv("SETTINGS_BATCH_DELAY_MS", "5"))
+# Пакет такого размера уходит сразу, не дожидаясь задержки
+SETTINGS_BATCH_MAX: int = int(os.getenv("SETTINGS_BATCH_MAX", "1000"))
+
+BATCH_SIZE = metrics.histogram(
+    "settings_write_batch_size", "Записи настроек в одном пакете",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+BATCH_WRITE_SECONDS = metrics.histogram("settings_write_seconds", "Время записи пакета настроек в БД")
+ACK_SECONDS = metrics.histogram("settings_write_ack_seconds", "Время от постановки записи настроек до подтверждения")
+WRITE_ERRORS = metrics.counter("settings_write_errors_total", "Пакеты настроек, которые не удалось записать")
+
+Waiter = Tuple[float, "asyncio.Future[None]"]
+
+
+class SettingsWriter:
+    """Очередь записи настроек с подтверждением. Для одного пользователя в пакет попадает последнее
+    значение: upsert по одному ключу дважды в одном запросе PostgreSQL не допускает, а итог тот же."""
+
+    def __init__(
+        self, pool: asyncpg.pool.Pool, delay_ms: float = SETTINGS_BATCH_DELAY_MS, max_batch: int = SETTINGS_BATCH_MAX
+    ) -> None:
+        self.pool = pool
+        self.delay = delay_ms / 1000
+        self.max_batch = max_batch
+        self._timezones: Dict[int, str] = {}
+        self._daily: Dict[int, DailyReminderRow] = {}
+        self._retros: Dict[int, RetrospectiveRow] = {}
+        self._waiters: List[Waiter] = []
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name="settings-writer")
+
+    async def stop(self) -> None:
+        """Дописывает накопленное и останавливает запись."""
+        if self._task is None:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._full.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def set_timezone(self, user_id: int, timezone: str) -> None:
+        self._timezones[user_id] = timezone
+        await self._enqueue()
+
+    async def upsert_daily_reminder(
+        self, user_id: int, target_local_time: dt_time, timezone: str, next_fire_utc: datetime, active: bool = True
+    ) -> None:
+        self._daily[user_id] = (user_id, target_local_time, timezone, next_fire_utc, active)
+        await self._enqueue()
+
+    async def upsert_scheduled_retrospective(
+        self, user_id: int, scheduled_day: int, target_local_time: dt_time, timezone: str,
+        retrospective_type: str, next_fire_utc: datetime, active: bool = True
+    ) -> None:
+        self._retros[user_id] = (
+            user_id, scheduled_day, target_local_time, timezone, retrospective_type, next_fire_utc, active
+        )
+        await self._enqueue()
+
+    async def _enqueue(self) -> None:
+        """Ждёт COMMIT пакета с этой записью; ошибка записи пакета пробрасывается каждому ожидающему."""
+        if self._closed:
+            raise RuntimeError("Запись настроек остановлена")
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self._waiters.append((time.monotonic(), future))
+        self._wakeup.set()
+        if self._pending >= self.max_batch:
+            self._full.set()
+        await future
+
+    @property
+    def _pending(self) -> int:
+        return len(self._timezones) + len(self._daily) + len(self._retros)
+
+    async def _run(self) -> None:
+        while not self._closed or self._waiters:
+            await self._wakeup.wait()
+            # Короткая пауза собирает попутные записи; полный пакет уходит сразу.
+            # Записи, пришедшие во время _flush, попадут в следующий пакет
+            if not self._full.is_set():
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            self._full.clear()
+            await self._flush()
+
+    async def _flush(self) -> None:
+        timezones = list(self._timezones.items())
+        daily = list(self._daily.values())
+        retros = list(self._retros.values())
+        waiters = self._waiters
+        self._timezones, self._daily, self._retros, self._waiters = {}, {}, {}, []
+        if not waiters:
+            return
+        BATCH_SIZE.observe(len(timezones) + len(daily) + len(retros))
+        started = time.monotonic()
+        try:
+            await write_settings(self.pool, timezones, daily, retros)
+        except Exception as e:
+            WRITE_ERRORS.inc()
+            logger.exception(f"Ошибка записи пакета настроек ({len(waiters)} записей):")
+            for _, future in waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finished = time.monotonic()
+        BATCH_WRITE_SECONDS.observe(finished - started)
+        for enqueued, future in waiters:
+            ACK_SECONDS.observe(finished - enqueued)
+            if not future.done():
+                future.set_result(None)
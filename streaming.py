@@ -0,0 +1,110 @@
+# streaming.py
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional
+
+from telegram import Message, ReplyKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram ограничивает частоту редактирования: не чаще раза в STREAM_EDIT_INTERVAL секунд
+STREAM_EDIT_INTERVAL: float = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+# Не редактируем сообщение ради прироста меньше STREAM_MIN_DELTA символов
+STREAM_MIN_DELTA: int = int(os.getenv("STREAM_MIN_DELTA", "40"))
+TELEGRAM_MAX_MESSAGE_LENGTH: int = 4096
+STREAM_CURSOR: str = " …"
+
+
+class StreamingReply:
+    """Одно сообщение Telegram, которое прогрессивно дописывается по мере генерации ответа.
+
+    feed() вызывается синхронно из очереди Gemini; правки сообщения объединяются
+    и отправляются фоновой задачей не чаще STREAM_EDIT_INTERVAL.
+    """
+
+    def __init__(
+        self,
+        source: Message,
+        prefix: str = "",
+        suffix: str = "",
+        reply_markup: Optional[ReplyKeyboardMarkup] = None,
+        edit_interval: float = STREAM_EDIT_INTERVAL,
+        min_delta: int = STREAM_MIN_DELTA,
+    ) -> None:
+        self._source = source
+        self._prefix = prefix
+        self._suffix = suffix
+        self._reply_markup = reply_markup
+        self._edit_interval = edit_interval
+        self._min_delta = min_delta
+        self._parts: List[str] = []
+        self._length = 0
+        self._sent_length = 0
+        self._message: Optional[Message] = None
+        self._last_edit = 0.0
+        self._changed = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def feed(self, chunk: str) -> None:
+        self._parts.append(chunk)
+        self._length += len(chunk)
+        self._changed.set()
+
+    def _render(self, body: str, final: bool) -> str:
+        text = self._prefix + body + (self._suffix if final else STREAM_CURSOR)
+        if len(text) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            text = text[: TELEGRAM_MAX_MESSAGE_LENGTH - 1] + "…"
+        return text
+
+    async def _send_or_edit(self, text: str) -> None:
+        while True:
+            try:
+                if self._message is None:
+                    self._message = await self._source.reply_text(text, reply_markup=self._reply_markup)
+                else:
+                    await self._message.edit_text(text)
+                self._last_edit = time.monotonic()
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return
+                raise
+
+    async def _run(self) -> None:
+        while not self._finished.is_set():
+            await self._changed.wait()
+            self._changed.clear()
+            wait = self._edit_interval - (time.monotonic() - self._last_edit)
+            if wait > 0:
+                try:
+                    # finish() прерывает ожидание, чтобы не задерживать финальный ответ
+                    await asyncio.wait_for(self._finished.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            if self._finished.is_set():
+                return
+            if self._message is not None and self._length - self._sent_length < self._min_delta:
+                continue
+            self._sent_length = self._length
+            await self._send_or_edit(self._render("".join(self._parts), final=False))
+
+    async def finish(self, text: Optional[str] = None) -> None:
+        """Дожидается текущей правки и выводит финальный текст с подписью."""
+        self._finished.set()
+        self._changed.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception:
+                logger.exception("Ошибка при промежуточном обновлении сообщения:")
+        body = text if text is not None else "".join(self._parts)
+        await self._send_or_edit(self._render(body, final=True))
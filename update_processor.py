@@ -0,0 +1,94 @@
+# update_processor.py
+# Параллельная обработка обновлений с сохранением порядка внутри одного пользователя.
+# Разные пользователи обрабатываются одновременно (до UPDATE_CONCURRENCY), а обновления одного
+# пользователя — строго по очереди: от этого зависят состояния ConversationHandler и user_data.
+import asyncio
+import os
+import time
+from typing import Any, Dict, Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+
+# Сколько обновлений разных пользователей обрабатывается одновременно
+UPDATE_CONCURRENCY: int = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+# Сколько обновлений может одновременно ждать своей очереди или выполняться; дальше
+# Application перестаёт забирать обновления из update_queue
+UPDATE_MAX_PENDING: int = int(os.getenv("UPDATE_MAX_PENDING", "1024"))
+
+QUEUE_WAIT = metrics.histogram(
+    "update_queue_wait_seconds", "Ожидание обновления до начала обработки (очередь пользователя и общий лимит)"
+)
+PROCESSING_TIME = metrics.histogram("update_processing_seconds", "Время обработки одного обновления")
+UPDATES_PENDING = metrics.gauge("updates_pending", "Обновления, ожидающие своей очереди или обрабатываемые")
+UPDATES_RUNNING = metrics.gauge("updates_running", "Обновления, обрабатываемые прямо сейчас")
+
+
+class _UserQueue:
+    __slots__ = ("lock", "users")
+
+    def __init__(self) -> None:
+        # asyncio.Lock отдаёт управление ожидающим в порядке FIFO, поэтому порядок обновлений сохраняется
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+def ordering_key(update: object) -> Optional[int]:
+    """Ключ упорядочивания: пользователь, а если его нет — чат. None — порядок не важен."""
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+    return None
+
+
+class OrderedConcurrentApplication(Application):
+    """Application, который обрабатывает обновления параллельно, но по одному на пользователя.
+
+    Подключается через ApplicationBuilder.application_class вместе с concurrent_updates:
+    Application создаёт задачу на каждое обновление, а process_update выстраивает задачи одного
+    пользователя в очередь и ограничивает общее число одновременно выполняемых.
+    """
+
+    def __init__(self, max_concurrency: int = UPDATE_CONCURRENCY, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.max_concurrency = max_concurrency
+        self._processing_slots = asyncio.Semaphore(max_concurrency)
+        self._user_queues: Dict[int, _UserQueue] = {}
+
+    async def process_update(self, update: object) -> None:
+        queued = time.monotonic()
+        key = ordering_key(update)
+        UPDATES_PENDING.inc()
+        try:
+            if key is None:
+                async with self._processing_slots:
+                    await self._process_measured(update, queued)
+                return
+            user_queue = self._user_queues.get(key)
+            if user_queue is None:
+                user_queue = self._user_queues[key] = _UserQueue()
+            user_queue.users += 1
+            try:
+                async with user_queue.lock:
+                    async with self._processing_slots:
+                        await self._process_measured(update, queued)
+            finally:
+                user_queue.users -= 1
+                if not user_queue.users:
+                    del self._user_queues[key]
+        finally:
+            UPDATES_PENDING.dec()
+
+    async def _process_measured(self, update: object, queued: float) -> None:
+        started = time.monotonic()
+        QUEUE_WAIT.observe(started - queued)
+        UPDATES_RUNNING.inc()
+        try:
+            await super().process_update(update)
+        finally:
+            UPDATES_RUNNING.dec()
+            PROCESSING_TIME.observe(time.monotonic() - started)